@@ -0,0 +1,78 @@
+import argparse
+
+from dotenv import load_dotenv
+from itakello_logging import ItakelloLogging
+
+from src.components.llm.fake_server import FakeLLM, FakeServer
+
+logger = ItakelloLogging.get_logger(__name__)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Serve deterministic fake LLMs through the Ollama and OpenAI APIs"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument(
+        "--models",
+        default="llama3:latest",
+        help="comma-separated models installed at start, others are pulled on demand",
+    )
+    parser.add_argument(
+        "--latency",
+        default=None,
+        help="time to the first token in seconds: fixed:MEAN, uniform:LOW:HIGH, "
+        + "exponential:MEAN or lognormal:MEAN:SIGMA (FAKE_LLM_LATENCY)",
+    )
+    parser.add_argument(
+        "--tokens-per-second",
+        type=float,
+        default=None,
+        help="generation speed of the replies (FAKE_LLM_TOKENS_PER_SECOND)",
+    )
+    parser.add_argument(
+        "--reply-tokens",
+        type=int,
+        default=None,
+        help="minimum length of the replies (FAKE_LLM_REPLY_TOKENS)",
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=None,
+        help="share of the chat requests that fail (FAKE_LLM_ERROR_RATE)",
+    )
+    parser.add_argument("--seed", type=int, default=None, help="(FAKE_LLM_SEED)")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    llm = FakeLLM.from_env()
+    overrides = {
+        "latency": args.latency,
+        "tokens_per_second": args.tokens_per_second,
+        "reply_tokens": args.reply_tokens,
+        "error_rate": args.error_rate,
+        "seed": args.seed,
+    }
+    llm = FakeLLM(
+        **{
+            name: getattr(llm, name) if value is None else value
+            for name, value in overrides.items()
+        }
+    )
+    server = FakeServer(
+        llm=llm, host=args.host, port=args.port, models=args.models.split(",")
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Fake LLM server stopped")
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    ItakelloLogging(debug=False, excluded_modules=["asyncio"])
+    main()
@@ -0,0 +1,194 @@
+import argparse
+import json
+import sys
+import time
+from collections import Counter
+
+from dotenv import load_dotenv
+from itakello_logging import ItakelloLogging
+from pymongo.errors import PyMongoError
+
+from src.components.experiment.experiment import Experiment
+from src.components.sweep.sweep import Sweep
+from src.components.sweep.sweep_config import SweepConfig
+from src.components.sweep.sweep_estimator import SweepEstimator
+from src.components.sweep.sweep_executor import SweepExecutor
+from src.core.database_manager import DatabaseManager
+from src.utility.custom_os import EnvironmentError as MissingVariableError
+
+logger = ItakelloLogging.get_logger(__name__)
+
+EXIT_OK = 0
+EXIT_FAILED_CONVERSATIONS = 1
+EXIT_INVALID_SPEC = 2
+EXIT_DATABASE_ERROR = 3
+EXIT_SWEEP_ERROR = 4
+EXIT_INTERRUPTED = 130
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Perform a sweep of conversations described by a YAML/JSON spec, without prompts"
+    )
+    parser.add_argument("spec", help="path of the sweep spec (.yaml, .yml or .json)")
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only estimate tokens, cost and time of the sweep, without saving it",
+    )
+    parser.add_argument(
+        "--report", help="also write the summary report as JSON to this path"
+    )
+    return parser.parse_args()
+
+
+def get_sweep(
+    db_m: DatabaseManager, config: SweepConfig, experiment: Experiment
+) -> Sweep:
+    if config.sweep_id is None:
+        sweep = config.to_sweep(experiment, db_m.username)
+        SweepEstimator(db_m=db_m).size_context(experiment, sweep)
+        db_m.save_sweep(sweep)
+        logger.info(f"Created sweep {sweep.id} with {len(sweep.specs)} conversations")
+        return sweep
+    sweep = db_m.get_sweeps(experiment.id).get(str(config.sweep_id))
+    if sweep is None:
+        raise ValueError(f"Sweep {config.sweep_id} does not exist in the experiment")
+    # Sweeps created before their context was sized
+    if SweepEstimator(db_m=db_m).size_context(experiment, sweep):
+        db_m.set_sweep_num_ctx(sweep)
+    logger.info(
+        f"Resuming sweep {sweep.id}: {len(sweep.missing_specs)}/{len(sweep.specs)} conversations missing"
+    )
+    return sweep
+
+
+def dry_run(
+    db_m: DatabaseManager,
+    config: SweepConfig,
+    experiment: Experiment,
+    report_path: str | None,
+) -> int:
+    if config.sweep_id is None:
+        specs = config.to_sweep(experiment, db_m.username).specs
+    else:
+        specs = get_sweep(db_m, config, experiment).missing_specs
+    estimator = SweepEstimator(db_m=db_m)
+    report = estimator.log_estimates(
+        estimator.estimate(experiment, specs), config.max_workers
+    )
+    if report_path:
+        write_report(report_path, report)
+    return EXIT_OK
+
+
+def build_report(sweep: Sweep, specs_count: int, saved: int, elapsed: float) -> dict:
+    completed_llms = Counter(sweep.specs[index].llm_name for index in sweep.completed)
+    total_llms = Counter(spec.llm_name for spec in sweep.specs)
+    return {
+        "sweep_id": str(sweep.id),
+        "experiment_id": str(sweep.experiment_id),
+        "performed": saved,
+        "failed": specs_count - saved,
+        "completed": len(sweep.completed),
+        "total": len(sweep.specs),
+        "elapsed_seconds": round(elapsed, 1),
+        "llms": {
+            llm_name: {"completed": completed_llms[llm_name], "total": total}
+            for llm_name, total in total_llms.items()
+        },
+    }
+
+
+def log_report(report: dict) -> None:
+    logger.info(
+        f"Sweep {report['sweep_id']}: performed {report['performed']}, "
+        + f"failed {report['failed']} in {report['elapsed_seconds']}s "
+        + f"[{report['completed']}/{report['total']} completed]"
+    )
+    for llm_name, counts in report["llms"].items():
+        logger.info(f"- {llm_name}: {counts['completed']}/{counts['total']} completed")
+
+
+def write_report(path: str, report: dict) -> None:
+    with open(path, "w") as file:
+        json.dump(report, file, indent=4)
+
+
+def main() -> int:
+    args = parse_args()
+    try:
+        config = SweepConfig.from_file(args.spec)
+    except (OSError, ValueError) as e:
+        logger.error(f"Cannot read the sweep spec: {e}")
+        return EXIT_INVALID_SPEC
+    try:
+        # The credentials and the database name (DB_NAME) are read from the environment
+        db_m = DatabaseManager(input_m=None)
+        experiment = db_m.get_experiment(config.experiment_id)
+    except (MissingVariableError, ConnectionError, PyMongoError) as e:
+        logger.error(f"Cannot connect to the database: {e}")
+        return EXIT_DATABASE_ERROR
+    if experiment is None:
+        logger.error(f"Experiment {config.experiment_id} does not exist")
+        return EXIT_INVALID_SPEC
+    try:
+        config.validate(experiment)
+        if args.dry_run:
+            return dry_run(db_m, config, experiment, args.report)
+        sweep = get_sweep(db_m, config, experiment)
+    except ValueError as e:
+        logger.error(str(e))
+        return EXIT_INVALID_SPEC
+    except PyMongoError as e:
+        logger.error(f"Cannot read or save the sweep: {e}")
+        return EXIT_DATABASE_ERROR
+    specs = sweep.missing_specs
+    executor = SweepExecutor(
+        db_m=db_m,
+        max_workers=config.max_workers,
+        executor_type=config.executor_type,
+        engine=config.engine,
+        adaptive=config.adaptive,
+        use_cache=config.cache,
+        batch=config.batch,
+    )
+    completed = len(sweep.completed)
+    exit_code = None
+    start_time = time.monotonic()
+    try:
+        if specs:
+            executor.run(experiment, specs, sweep)
+    except KeyboardInterrupt:
+        logger.warning("Sweep interrupted")
+        exit_code = EXIT_INTERRUPTED
+    except Exception as e:
+        logger.error(f"Sweep stopped: {e}")
+        exit_code = EXIT_SWEEP_ERROR
+    # The conversations saved before an interruption are reported too
+    saved = len(sweep.completed) - completed
+    report = build_report(sweep, len(specs), saved, time.monotonic() - start_time)
+    log_report(report)
+    if args.report:
+        write_report(args.report, report)
+    if exit_code is not None:
+        return exit_code
+    return EXIT_OK if not sweep.missing_specs else EXIT_FAILED_CONVERSATIONS
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    ItakelloLogging(
+        debug=False,
+        excluded_modules=[
+            "docker.utils.config",
+            "docker.auth",
+            "httpx",
+            "httpcore.connection",
+            "httpcore.http11",
+            "autogen.io.base",
+            "asyncio",
+            "openai._base_client",
+        ],
+    )
+    sys.exit(main())
@@ -2,16 +2,16 @@ import random
 import string
 from dataclasses import InitVar, dataclass
 from typing import Any, Dict, List, Optional, Union
-import time
-import openai
-import httpx
-import ollama
 
 from autogen import ConversableAgent
 from autogen.agentchat.agent import Agent
 from itakello_logging import ItakelloLogging
 
+from ..llm.call_ledger import call_scope
+from ..llm.context_window import ContextWindow, Fold
 from ..llm.llm import LLM
+from ..llm.rate_limiter import RateLimiter
+from ..llm.retry_policy import RetryPolicy
 from ..section.section import Section
 
 logger = ItakelloLogging().get_logger(__name__)
@@ -25,15 +25,22 @@ class CustomAgent(ConversableAgent):
 
     placeholders: InitVar[dict[str, str]]
     sections: InitVar[list[Section]]
+    # Reused when a conversation is resumed, so that speakers keep their names
+    agent_name: InitVar[str] = ""
+    # Shared by the agents of a conversation, see Conversation.perform
+    context_window: ContextWindow | None = None
+    fold: Fold | None = None
 
     def __post_init__(
-        self, placeholders: dict[str, str], sections: list[Section]
+        self, placeholders: dict[str, str], sections: list[Section], agent_name: str
     ) -> None:
-        name = self.role.capitalize() + "_" + self._get_random_numeric_string()
+        name = agent_name or (
+            self.role.capitalize() + "_" + self._get_random_numeric_string()
+        )
         system_message = self._generate_system_message(sections, placeholders)
         super().__init__(
             name=name,
-            llm_config=self.llm.config,
+            llm_config=self.llm.client_config,
             system_message=system_message,
             human_input_mode="NEVER",
             code_execution_config=False,
@@ -62,66 +69,56 @@ class CustomAgent(ConversableAgent):
         **kwargs: Any,
     ) -> Union[str, Dict, None]:
         """
-        Generate a reply with retry logic for transient LLM errors.
+        Generate a reply, retried on transient LLM errors (see RetryPolicy).
+        Its LLM calls are recorded in the ledger of the conversation.
         """
-        MAX_RETRIES = 3
-        attempts = 0
-        while True:
-            try:
-                reply = super().generate_reply(messages=messages, sender=sender, **kwargs)
-                break
-            except (openai.error.OpenAIError, httpx.HTTPError, ollama.ResponseError) as e:
-                attempts += 1
-                if attempts >= MAX_RETRIES:
-                    logger.error(f"LLM generation failed after {attempts} attempts: {e}")
-                    raise
-                logger.warning(f"Error generating reply (attempt {attempts}/{MAX_RETRIES}): {e}. Retrying...")
-                time.sleep(2 ** attempts)
-            except Exception as e:
-                attempts += 1
-                if attempts >= MAX_RETRIES:
-                    logger.error(f"Unexpected error generating reply after {attempts} attempts: {e}")
-                    raise
-                logger.warning(f"Unexpected error generating reply (attempt {attempts}/{MAX_RETRIES}): {e}. Retrying...")
-                time.sleep(2 ** attempts)
-        # Log token usage if available
-        logger.debug(str(self.client.total_usage_summary))  # type: ignore
+        # Index of the reply within the day, the messages of the group chat
+        turn = len(self._get_prompt(messages, sender)) - len(self._oai_system_message)
+        with call_scope(turn=turn, agent=self.name, call_type="reply"):
+            messages = self._fit_context(messages, sender)
+            reply = self.retry_policy.call(
+                lambda: self._generate_reply_once(messages, sender, **kwargs),
+                "generating reply",
+            )
         # Clean up reply text
         reply = str(reply).strip()
         return reply
 
-    def send(
+    def _generate_reply_once(
         self,
-        message: Union[Dict, str],
-        recipient: Agent,
-        request_reply: Optional[bool] = None,
-        silent: Optional[bool] = False,
-    ) -> None:
-        super().send(message, recipient, request_reply, silent)
-        token_summary = self.client.total_usage_summary  # type: ignore
-        if token_summary:
-            # Determine token-usage key. Start with the configured model identifier
-            model_key = self.llm.model
-            # If exact key not found, try to match any summary key that starts with the model id
-            if model_key not in token_summary:
-                for key in token_summary:
-                    if key.startswith(f"{self.llm.model}"):
-                        model_key = key
-                        break
-            # Next, fallback to custom model name
-            if model_key not in token_summary and getattr(self.llm, "name", None) in token_summary:
-                model_key = self.llm.name
-            # If still not found, log a warning and skip
-            if model_key not in token_summary:
-                available = list(token_summary.keys())
-                logger.warning(
-                    f"Token usage summary keys {available} do not include model '{self.llm.model}' or name '{getattr(self.llm, 'name', None)}'"
-                )
-                return
-            usage = token_summary[model_key]
-            logger.info(
-                f"Previous tokens: {usage.get('prompt_tokens')} | New tokens: {usage.get('completion_tokens')} | Total tokens: {usage.get('total_tokens')}"
-            )
+        messages: Optional[List[Dict[str, Any]]],
+        sender: Optional[Agent],
+        **kwargs: Any,
+    ) -> Union[str, Dict, None]:
+        with self.rate_limiter.limit(self._get_prompt(messages, sender)) as call:
+            reply = super().generate_reply(messages=messages, sender=sender, **kwargs)
+            call.record_reply(str(reply))
+        return reply
+
+    @property
+    def rate_limiter(self) -> RateLimiter:
+        return RateLimiter.for_config(self.llm.config)
+
+    @property
+    def retry_policy(self) -> RetryPolicy:
+        return RetryPolicy.for_config(self.llm.config)
+
+    def _get_prompt(
+        self, messages: Optional[List[Dict[str, Any]]], sender: Optional[Agent]
+    ) -> List[Dict[str, Any]]:
+        # Same messages autogen sends, used to size the request for the limiter
+        if messages is None:
+            messages = self._oai_messages[sender] if sender is not None else []
+        return self._oai_system_message + messages
+
+    def _fit_context(
+        self, messages: Optional[List[Dict[str, Any]]], sender: Optional[Agent]
+    ) -> Optional[List[Dict[str, Any]]]:
+        # autogen adds the system message itself, it is only counted here
+        if self.context_window is None:
+            return messages
+        prompt = self.context_window.fit(self._get_prompt(messages, sender), self.fold)
+        return prompt[len(self._oai_system_message) :]
 
     def __hash__(self) -> int:
         return hash(self.name)
@@ -0,0 +1,188 @@
+import time
+from dataclasses import dataclass, field
+
+from autogen import Agent
+from itakello_logging import ItakelloLogging
+from openai import AsyncOpenAI
+
+from ..llm.backend import Backend
+from ..llm.batch_client import BatchClient, alimit
+from ..llm.call_ledger import call_scope
+from ..llm.context_window import AsyncFold, ContextWindow
+from ..llm.hedger import Hedger
+from ..llm.llm import LLM
+from ..llm.rate_limiter import RateLimiter
+from ..llm.retry_policy import RetryPolicy
+from .agent import CustomAgent
+from .chat import Chat
+from .researcher import Researcher
+
+logger = ItakelloLogging().get_logger(__name__)
+
+# Name of autogen's GroupChatManager, which selects the speakers on the
+# other engine
+SELECTOR_NAME = "chat_manager"
+
+
+@dataclass
+class AsyncChat:
+    """
+    Asyncio counterpart of the Researcher -> Manager -> Chat pipeline.
+
+    It reuses the speaker selection logic of the autogen ``Chat`` but performs
+    every LLM call with an ``AsyncOpenAI`` client, so that a single event loop
+    can keep many conversations in flight. The raw messages of a day have the
+    same shape as ``Chat.messages`` after ``Researcher.initiate_chat``.
+    """
+
+    agents: list[CustomAgent]
+    llm: LLM
+    client: AsyncOpenAI | BatchClient
+    selection_method: str = "auto"
+    round_number: int = 10
+    # Folds the turns that no longer fit in the context, see ContextWindow
+    fold: AsyncFold | None = None
+
+    group_chat: Chat = field(init=False)
+    researcher: Researcher = field(init=False)
+    context_window: ContextWindow = field(init=False)
+
+    def __post_init__(self) -> None:
+        assert self.selection_method in (
+            "auto",
+            "random",
+            "round_robin",
+        ), logger.error(f"Invalid mode for the async engine [{self.selection_method}]")
+        self.group_chat = Chat(
+            agents=self.agents,
+            selection_method=self.selection_method,
+            round_number=self.round_number,
+        )
+        self.researcher = Researcher()
+        self.context_window = self.llm.create_context_window()
+
+    @property
+    def rate_limiter(self) -> RateLimiter:
+        return RateLimiter.for_config(self.llm.config)
+
+    async def run_day(self, start_message: str) -> list[dict]:
+        self.group_chat.reset()
+        message = {"content": start_message, "role": "user"}
+        speaker: Agent = self.researcher
+        for i in range(self.group_chat.max_round):
+            self.group_chat.append(message, speaker)
+            if i == self.group_chat.max_round - 1:
+                break
+            turn = len(self.group_chat.messages)
+            with call_scope(turn=turn, agent=SELECTOR_NAME, call_type="speaker-selection"):
+                speaker = await self._select_speaker(speaker)
+            with call_scope(turn=turn, agent=speaker.name, call_type="reply"):
+                reply = await self._generate_reply(speaker)
+            message = {"content": reply, "role": "user"}
+        return self.group_chat.messages
+
+    async def _select_speaker(self, last_speaker: Agent) -> CustomAgent:
+        selected_agent, agents, messages = (
+            self.group_chat._prepare_and_select_agents(last_speaker)
+        )
+        if selected_agent:
+            return selected_agent  # type: ignore
+        # No graph of allowed transitions (e.g. after the Researcher): any agent
+        if agents is None:
+            agents = self.group_chat.agents
+        return await self._auto_select_speaker(last_speaker, agents, messages)  # type: ignore
+
+    async def _auto_select_speaker(
+        self, last_speaker: Agent, agents: list[Agent], messages: list[dict]
+    ) -> CustomAgent:
+        select_messages = (
+            [{"content": self.group_chat.select_speaker_msg(agents), "role": "system"}]
+            + messages
+            + [
+                {
+                    "content": self.group_chat.select_speaker_prompt(agents),
+                    "role": self.group_chat.role_for_select_speaker_messages,
+                }
+            ]
+        )
+        max_attempts = 1 + self.group_chat.max_retries_for_selecting_speaker
+        for _ in range(max_attempts):
+            name = await self._create(select_messages)
+            mentions = self.group_chat._mentioned_agents(name, agents)
+            if len(mentions) == 1:
+                return self.group_chat.agent_by_name(next(iter(mentions)))  # type: ignore
+            if len(mentions) > 1:
+                requery = self.group_chat.select_speaker_auto_multiple_template
+            else:
+                requery = self.group_chat.select_speaker_auto_none_template.format(
+                    agentlist=f"{[agent.name for agent in agents]}"
+                )
+            select_messages = select_messages + [
+                {"content": name, "role": "assistant"},
+                {
+                    "content": requery,
+                    "role": self.group_chat.role_for_select_speaker_messages,
+                },
+            ]
+        logger.warning(
+            f"Speaker selection failed after {max_attempts} attempts, using the next agent"
+        )
+        return self.group_chat.next_agent(last_speaker, agents)  # type: ignore
+
+    async def _generate_reply(self, speaker: CustomAgent) -> str:
+        messages = [{"content": speaker.system_message, "role": "system"}]
+        for message in self.group_chat.messages:
+            if message["name"] == speaker.name:
+                role = "assistant"
+            else:
+                role = "user"
+            messages.append(
+                {"content": message["content"], "role": role, "name": message["name"]}
+            )
+        reply = await self._create(messages)
+        return reply.strip()
+
+    async def _create(self, messages: list[dict]) -> str:
+        """
+        Perform a chat completion, retried on transient LLM errors (see
+        RetryPolicy) and bounded by the deadline of the backend, hedged when
+        it is slow (see Hedger).
+        """
+        messages = await self.context_window.afit(messages, self.fold)
+        hedger = Hedger.for_config(self.llm.config)
+        return await RetryPolicy.for_config(self.llm.config).acall(
+            lambda: hedger.arun(
+                lambda: self._create_once(messages), messages, self.client
+            ),
+            "generating reply",
+        )
+
+    async def _create_once(self, messages: list[dict]) -> str:
+        async with alimit(self.rate_limiter, self.client, messages) as call:
+            start_time = time.monotonic()
+            response = await self.client.chat.completions.create(
+                model=self.llm.config["model"],
+                messages=messages,  # type: ignore
+                **self.llm.request_params,
+            )
+            if response.usage is not None:
+                call.record_usage(response.usage.total_tokens)
+        logger.debug(
+            f"[{self.llm.config['model']}] completion in {time.monotonic() - start_time:.2f}s: {response.usage}"
+        )
+        return str(response.choices[0].message.content)
+
+    @classmethod
+    def create_client(cls, llm: LLM) -> AsyncOpenAI | BatchClient:
+        # Called from the event loop the client will be used in
+        backend = Backend.for_config(llm.backend, llm.config["base_url"])
+        client = AsyncOpenAI(
+            base_url=llm.config["base_url"],
+            api_key=llm.config["api_key"],
+            http_client=backend.get_async_client(),
+            # Retried by the RetryPolicy of the backend instead
+            max_retries=0,
+        )
+        if BatchClient.is_enabled():
+            return BatchClient.for_client(client)
+        return client
@@ -1,9 +1,11 @@
 from dataclasses import dataclass
 from typing import cast
 
-from autogen import Agent, GroupChat
+from autogen import Agent, ConversableAgent, GroupChat
 from itakello_logging import ItakelloLogging
 
+from ..llm.call_ledger import call_scope
+from ..llm.rate_limiter import RateLimiter
 from .agent import CustomAgent
 
 logger = ItakelloLogging().get_logger(__name__)
@@ -34,3 +36,16 @@ class Chat(GroupChat):
         logger.debug(
             f"GroupChat created with {len(agents)} agents.\nSelection method: {selection_method}\nRounds number: {round_number}"
         )
+
+    def select_speaker(self, last_speaker: Agent, selector: ConversableAgent) -> Agent:
+        # Only the auto method asks the manager's LLM, through the shared limiter
+        if self.speaker_selection_method != "auto" or not isinstance(
+            selector.llm_config, dict
+        ):
+            return super().select_speaker(last_speaker, selector)
+        with RateLimiter.for_config(selector.llm_config).limit(
+            self.messages
+        ), call_scope(
+            turn=len(self.messages), agent=selector.name, call_type="speaker-selection"
+        ):
+            return super().select_speaker(last_speaker, selector)
@@ -1,18 +1,23 @@
+import functools
 from dataclasses import dataclass, field
 from datetime import datetime
+from typing import Callable
 
 from bson.objectid import ObjectId
 from itakello_logging import ItakelloLogging
 
 from ...interfaces.mongo_model import MongoModel
 from ...utility.consts import TIME_FORMAT
+from ...utility.enums import ConversationStatus
 from ..conversation.chat import Chat
 from ..conversation.manager import Manager
 from ..conversation.researcher import Researcher
 from ..experiment.experiment import Experiment
+from ..llm.call_ledger import CallLedger, call_scope
 from ..llm.llm import LLM
 from ..section.section import Section
 from .agent import CustomAgent
+from .async_chat import AsyncChat
 from .message import Message
 from .summarizer import Summarizer
 
@@ -32,6 +37,11 @@ class Conversation(MongoModel):
     id: ObjectId = field(default_factory=ObjectId)
     creation_date: datetime = field(default_factory=datetime.now)
     messages_ids: list[ObjectId] = field(default_factory=list)
+    status: ConversationStatus = ConversationStatus.IN_PROGRESS
+    summaries: list[str] = field(default_factory=list)
+    agent_names: list[str] = field(default_factory=list)
+    # LLM calls not saved yet, stored apart from the conversation
+    ledger: CallLedger = field(init=False, default_factory=CallLedger)
 
     def __post_init__(self) -> None:
         logger.debug(f"Created a new Conversation:\n{self}")
@@ -44,16 +54,27 @@ class Conversation(MongoModel):
             + f"- starting message: {self.starting_message}\n"
             + f"- creator: {self.creator}\n"
             + f"- favourite: {self.favourite}\n"
+            + f"- status: {self._status_label()}\n"
             + f"- messages: {self.messages_ids}\n"
         )
         return output
 
+    @property
+    def completed_days(self) -> int:
+        return len(self.summaries)
+
+    def _status_label(self) -> str:
+        if self.status == ConversationStatus.IN_PROGRESS:
+            return f"{self.status.value} ({self.completed_days}/{self.days} days)"
+        return self.status.value
+
     def generate_agents(
         self,
         experiment: Experiment,
         placeholders: dict[str, str],
     ) -> list[CustomAgent]:
         agents = []
+        agent_names = iter(self.agent_names)
         # full_roles = [f"{role.capitalize()}:" for role, _ in self.agent_combination]
         for role, num in self.agent_combination:
             for _ in range(num):
@@ -65,37 +86,119 @@ class Conversation(MongoModel):
                         sections=list(experiment.shared_sections.values())
                         + list(experiment.roles[role].sections.values()),
                         llm=self.llm,
+                        agent_name=next(agent_names, ""),
                     )
                 )
+        self.agent_names = [agent.name for agent in agents]
         return agents
 
     def perform(
-        self, agents: list[CustomAgent], summarizer: Summarizer, llm_manager: LLM
+        self,
+        agents: list[CustomAgent],
+        summarizer: Summarizer,
+        llm_manager: LLM,
+        silent: bool = False,
+        checkpoint: Callable[["Conversation", list[Message]], None] | None = None,
     ) -> list[Message]:
-        start_message = self.starting_message
+        """
+        Perform the missing days of the conversation, starting after the last
+        completed one. If given, checkpoint is called with the messages of
+        each day as soon as the day (and its summary) is over.
+        """
+        start_message = self._get_resume_message()
         researcher = Researcher()
         group_chat = Chat(
             agents=agents,
             selection_method=self.speaker_selection_method,
             round_number=self.n_messages // self.days,
         )
-        manager = Manager(groupchat=group_chat, llm_config=llm_manager.config)
+        manager = Manager(
+            groupchat=group_chat, llm_config=llm_manager.client_config, silent=silent
+        )
+        # The agents see the same turns, they share their folded summary
+        context_window = llm_manager.create_context_window()
+        for agent in agents:
+            agent.context_window = context_window
+            agent.fold = summarizer.fold
         messages = []
-        for i in range(int(self.days)):
-            researcher.initiate_chat(
-                recipient=manager, clear_history=True, message=start_message
-            )
-            raw_conversation = group_chat.messages
-            summary = summarizer.generate_summary(
-                previous_conversation=raw_conversation[1:], round_number=i + 1
-            )
+        for i in range(self.completed_days, int(self.days)):
+            with self.ledger.bind(self.id), call_scope(day=i + 1):
+                researcher.initiate_chat(
+                    recipient=manager,
+                    clear_history=True,
+                    silent=silent,
+                    message=start_message,
+                )
+                raw_conversation = group_chat.messages
+                summary = summarizer.generate_summary(
+                    previous_conversation=raw_conversation[1:], round_number=i + 1
+                )
             start_message += "\n" + summary
-            new_messages = self.add_daily_conversation(raw_conversation, day=i + 1)
+            new_messages = self._end_day(raw_conversation, summary, i + 1, checkpoint)
             messages.extend(new_messages)
-        self.messages_ids = [message.id for message in messages]
+        self.status = ConversationStatus.COMPLETED
         logger.confirmation("Conversation complete")
         return messages
 
+    async def aperform(
+        self,
+        agents: list[CustomAgent],
+        summarizer: Summarizer,
+        llm_manager: LLM,
+        checkpoint: Callable[["Conversation", list[Message]], None] | None = None,
+    ) -> list[Message]:
+        start_message = self._get_resume_message()
+        client = AsyncChat.create_client(llm_manager)
+        async_chat = AsyncChat(
+            agents=agents,
+            llm=llm_manager,
+            client=client,
+            selection_method=self.speaker_selection_method,
+            round_number=self.n_messages // self.days,
+            fold=functools.partial(summarizer.afold, client=client),
+        )
+        # The client shares the pooled connections of the backend, it stays open
+        messages = []
+        for i in range(self.completed_days, int(self.days)):
+            with self.ledger.bind(self.id), call_scope(day=i + 1):
+                raw_conversation = await async_chat.run_day(start_message)
+                summary = await summarizer.agenerate_summary(
+                    previous_conversation=raw_conversation[1:],
+                    round_number=i + 1,
+                    client=client,
+                )
+            start_message += "\n" + summary
+            new_messages = self._end_day(
+                raw_conversation, summary, i + 1, checkpoint
+            )
+            messages.extend(new_messages)
+        self.status = ConversationStatus.COMPLETED
+        logger.confirmation("Conversation complete")
+        return messages
+
+    def _get_resume_message(self) -> str:
+        # Same message the researcher would send after the completed days.
+        # Summaries are only ever appended, so the prompts of every day start
+        # with the same system message and starting message, and the server
+        # can reuse their KV cache
+        return "".join(
+            [self.starting_message] + ["\n" + summary for summary in self.summaries]
+        )
+
+    def _end_day(
+        self,
+        raw_conversation: list[dict],
+        summary: str,
+        day: int,
+        checkpoint: Callable[["Conversation", list[Message]], None] | None,
+    ) -> list[Message]:
+        new_messages = self.add_daily_conversation(raw_conversation, day=day)
+        self.summaries.append(summary)
+        if checkpoint is not None:
+            checkpoint(self, new_messages)
+            logger.debug(f"Conversation {self.id}: day {day}/{self.days} checkpointed")
+        return new_messages
+
     def to_selection(self) -> str:
         agent_combinations = ", ".join(
             f"{role.capitalize()}:{num}" for role, num in self.agent_combination
@@ -108,6 +211,8 @@ class Conversation(MongoModel):
             + f"LLM: {self.llm}\t"
             + f"Agent combination: {agent_combinations}\t"
         )
+        if self.status == ConversationStatus.IN_PROGRESS:
+            selection += f" [{self._status_label()}]"
         if self.favourite:
             selection += " ⭐"
         return selection
@@ -120,6 +225,7 @@ class Conversation(MongoModel):
             + f"\033[1mStarting message\033[0m: {self.starting_message}\n\n"
             + f"\033[1mCreator\033[0m: {self.creator}\n\n"
             + f"\033[1mFavourite\033[0m: {self.favourite}\n\n"
+            + f"\033[1mStatus\033[0m: {self._status_label()}\n\n"
             + f"\033[1mNum messages\033[0m: {len(self.messages_ids)}\n\n"
         )
         return output
@@ -138,7 +244,6 @@ class Conversation(MongoModel):
                     content=message["content"],
                 )
             )
-        self.messages_ids.extend(messages)
         return messages
 
     @classmethod
@@ -155,6 +260,12 @@ class Conversation(MongoModel):
             favourite=doc["favourite"],
             creation_date=doc["creation_date"],
             messages_ids=doc["messages_ids"],
+            # Conversations stored before checkpointing are always complete
+            status=ConversationStatus(
+                doc.get("status", ConversationStatus.COMPLETED.value)
+            ),
+            summaries=doc.get("summaries", []),
+            agent_names=doc.get("agent_names", []),
         )
 
     def to_document(self) -> dict:
@@ -170,4 +281,7 @@ class Conversation(MongoModel):
             "favourite": self.favourite,
             "creation_date": self.creation_date,
             "messages_ids": self.messages_ids,
+            "status": self.status.value,
+            "summaries": self.summaries,
+            "agent_names": self.agent_names,
         }
@@ -10,10 +10,15 @@ from ...utility.custom_os import CustomOS
 from ..experiment.experiment import Experiment
 from ..llm.llm import LLM
 from ..llm.llm_manager import LLMManager
+from ..llm.response_cache import ResponseCache
 from ..role.role import Role
 from ..section.section_manager import SectionManager
+from ..sweep.conversation_spec import ConversationSpec
+from ..sweep.job import Job
+from ..sweep.sweep import Sweep
+from ..sweep.sweep_estimator import SweepEstimator
+from ..sweep.sweep_executor import ENGINE_TYPES, EXECUTOR_TYPES, SweepExecutor
 from .conversation import Conversation
-from .summarizer import Summarizer
 
 logger = ItakelloLogging().get_logger(__name__)
 
@@ -31,6 +36,106 @@ class ConversationManager(BaseManager):
         self.llm_m = LLMManager(input_m=self.input_m)
 
     def perform_conversations(self, experiment: Experiment) -> None:
+        sweep = self._ask_sweep(experiment)
+        self._run_sweep(experiment, sweep, new_sweep=True)
+
+    def resume_sweep(self, experiment: Experiment) -> None:
+        # The sweeps enqueued for workers are resumed by them
+        queued = self.db_m.get_queued_sweep_ids(experiment.id)
+        sweeps = [
+            sweep
+            for sweep in self.db_m.get_sweeps(experiment.id).values()
+            if sweep.missing_specs and sweep.id not in queued
+        ]
+        if not sweeps:
+            logger.warning("No interrupted sweeps for this experiment.")
+            return
+        choices = [(sweep.to_selection(), str(sweep.id)) for sweep in sweeps]
+        if CustomOS.getenv("APP_MODE", "") == DEV_MODE:
+            selected_id = CustomOS.getenv("SWEEP_ID", str(sweeps[-1].id))
+        else:
+            selected_id = self.input_m.select_one(
+                message="Select a sweep to resume:", choices=choices
+            )
+        sweep = next(sweep for sweep in sweeps if str(sweep.id) == selected_id)
+        logger.info(
+            f"Resuming sweep {sweep.id}: {len(sweep.missing_specs)}/{len(sweep.specs)} conversations missing"
+        )
+        self._run_sweep(experiment, sweep)
+
+    def enqueue_conversations(self, experiment: Experiment) -> None:
+        sweep = self._ask_sweep(experiment)
+        if sweep.specs[0].speaker_selection_method == "manual":
+            logger.error("Manual speaker selection cannot be performed by workers")
+            return
+        SweepEstimator(db_m=self.db_m).size_context(experiment, sweep)
+        self.db_m.save_sweep(sweep)
+        jobs = [
+            Job(
+                experiment_id=experiment.id,
+                spec=spec,
+                sweep_id=sweep.id,
+                sweep_index=index,
+                num_ctx=sweep.num_ctx.get(experiment.llms[spec.llm_name].resolved_model),
+            )
+            for index, spec in enumerate(sweep.specs)
+        ]
+        self.db_m.save_jobs(jobs)
+        logger.confirmation(
+            f"Enqueued {len(jobs)} conversations. Start workers with `python worker.py`"
+        )
+
+    def _run_sweep(
+        self, experiment: Experiment, sweep: Sweep, new_sweep: bool = False
+    ) -> None:
+        specs = sweep.missing_specs
+        engine = self._ask_engine(specs[0].speaker_selection_method)
+        max_workers = self._ask_max_workers()
+        if engine == "autogen" and max_workers > 1:
+            executor_type = self._ask_executor_type()
+        else:
+            executor_type = "thread"
+        # Process workers have their own limiters, so they cannot adapt together
+        if max_workers > 1 and executor_type == "thread":
+            adaptive = self._ask_adaptive_concurrency()
+        else:
+            adaptive = False
+        use_cache = self._ask_use_cache() if ResponseCache.is_enabled() else False
+        batch = self._ask_batch() if engine == "async" else False
+        if not self._confirm_estimate(experiment, specs, max_workers):
+            return
+        sized = SweepEstimator(db_m=self.db_m).size_context(experiment, sweep)
+        if new_sweep:
+            self.db_m.save_sweep(sweep)
+        elif sized:
+            self.db_m.set_sweep_num_ctx(sweep)
+
+        executor = SweepExecutor(
+            db_m=self.db_m,
+            max_workers=max_workers,
+            executor_type=executor_type,
+            engine=engine,
+            adaptive=adaptive,
+            use_cache=use_cache,
+            batch=batch,
+        )
+        saved = executor.run(experiment, specs, sweep)
+        logger.confirmation(
+            f"Performed and saved {saved}/{len(specs)} conversations "
+            + f"[sweep {sweep.id}: {len(sweep.completed)}/{len(sweep.specs)} completed]"
+        )
+
+    def _confirm_estimate(
+        self, experiment: Experiment, specs: list[ConversationSpec], max_workers: int
+    ) -> bool:
+        logger.info("Estimated tokens, cost and time of the conversations:")
+        estimator = SweepEstimator(db_m=self.db_m)
+        estimator.log_estimates(estimator.estimate(experiment, specs), max_workers)
+        if CustomOS.getenv("APP_MODE", "") == DEV_MODE:
+            return True
+        return self.input_m.confirm("Do you want to perform these conversations?")
+
+    def _ask_sweep(self, experiment: Experiment) -> Sweep:
         n_conversations = self._ask_n_conversations()
         llms = self._ask_llms(available_llms=list(experiment.llms.values()))
         total_messages = self._ask_total_messages()
@@ -39,54 +144,16 @@ class ConversationManager(BaseManager):
             available_roles=list(experiment.roles.values())
         )
         speaker_selection_method = self._ask_for_speaker_selection_method()
-
-        total_conversations = (
-            n_conversations * len(llms) * len(days_list) * len(agent_combinations)
+        return Sweep.from_grid(
+            experiment_id=experiment.id,
+            creator=self.db_m.username,
+            llm_names=llms,
+            n_messages=total_messages,
+            days_list=days_list,
+            agent_combinations=agent_combinations,
+            speaker_selection_method=speaker_selection_method,
+            n_replicates=n_conversations,
         )
-        index_conv = 1
-        for llm in llms:
-            for days in days_list:
-                for agent_combination in agent_combinations:
-                    for _ in range(n_conversations):
-                        logger.info(
-                            f"--- Performing conversation [{index_conv}/{total_conversations}] ---\n"
-                        )
-                        index_conv += 1
-                        conv_llm = experiment.llms[llm]
-                        logger.info(
-                            f"\033[1mLLM\033[0m: {conv_llm}\n\033[1mDays\033[0m: {days}\n\033[1mAgents\033[0m: {agent_combination}\n"
-                        )
-                        conversation = Conversation(
-                            n_messages=total_messages,
-                            speaker_selection_method=speaker_selection_method,
-                            starting_message=experiment.starting_message,
-                            creator=self.db_m.username,
-                            days=days,
-                            llm=conv_llm,
-                            agent_combination=agent_combination,
-                        )
-                        placeholders = experiment.compose_placeholders(
-                            agent_combination
-                        )
-                        conv_agents = conversation.generate_agents(
-                            experiment, placeholders
-                        )
-                        summarizer = Summarizer(
-                            sections=list(experiment.summarizer_sections.values()),
-                            placeholders=placeholders,
-                            llm=conv_llm,
-                        )
-                        messages = conversation.perform(
-                            agents=conv_agents,
-                            summarizer=summarizer,
-                            llm_manager=conv_llm,
-                        )
-                        self.db_m.save_conversation(
-                            experiment=experiment,
-                            conversation=conversation,
-                            messages=messages,
-                        )
-        logger.confirmation(f"Performed and saved {total_conversations} conversations")
 
     def select_conversation(self, experiment: Experiment) -> Conversation | None:
         conversations = self.db_m.get_conversations(experiment.conversation_ids)
@@ -129,7 +196,7 @@ class ConversationManager(BaseManager):
         self, experiment: Experiment, conversation: Conversation
     ) -> None:
         experiment.conversation_ids.remove(conversation.id)
-        self.db_m.update_experiment(experiment)
+        self.db_m.remove_conversation(experiment.id, conversation.id)
         self.db_m.delete_conversation(conversation)
 
     def _ask_for_speaker_selection_method(self) -> str:
@@ -168,6 +235,80 @@ class ConversationManager(BaseManager):
             )
         return n_conversations
 
+    def _ask_engine(self, speaker_selection_method: str) -> str:
+        if speaker_selection_method == "manual":
+            # The async engine cannot prompt the user for the next speaker
+            return "autogen"
+        choices = [
+            ("Autogen: the GroupChat engine, one LLM request at a time per worker", "autogen"),
+            ("Async: a single event loop that multiplexes the conversations", "async"),
+        ]
+        if CustomOS.getenv("APP_MODE", "") == DEV_MODE:
+            engine = CustomOS.getenv("ENGINE", "autogen")
+        else:
+            engine = self.input_m.select_one(
+                message="Select the conversation engine",
+                choices=choices,
+            )
+        assert engine in ENGINE_TYPES, logger.error(f"Invalid engine [{engine}]")
+        return engine
+
+    def _ask_max_workers(self) -> int:
+        if CustomOS.getenv("APP_MODE", "") == DEV_MODE:
+            max_workers = CustomOS.getenv("MAX_WORKERS", "1")
+            max_workers = int(max_workers)
+        else:
+            max_workers = self.input_m.input_int(
+                "Enter the number of conversations to perform in parallel (1 to run them one at a time)",
+                positive_requirement=True,
+                default="1",
+            )
+        return max_workers
+
+    def _ask_executor_type(self) -> str:
+        choices = [
+            ("Thread pool: workers share this process (recommended)", "thread"),
+            ("Process pool: each worker runs in its own process", "process"),
+        ]
+        if CustomOS.getenv("APP_MODE", "") == DEV_MODE:
+            executor_type = CustomOS.getenv("EXECUTOR_TYPE", "thread")
+        else:
+            executor_type = self.input_m.select_one(
+                message="Select how the parallel workers are run",
+                choices=choices,
+            )
+        assert executor_type in EXECUTOR_TYPES, logger.error(
+            f"Invalid executor type [{executor_type}]"
+        )
+        return executor_type
+
+    def _ask_adaptive_concurrency(self) -> bool:
+        if CustomOS.getenv("APP_MODE", "") == DEV_MODE:
+            adaptive = CustomOS.getenv("ADAPTIVE_CONCURRENCY", "n") == "y"
+        else:
+            adaptive = self.input_m.confirm(
+                "Do you want to adapt the LLM calls in flight per backend to the observed latency?"
+            )
+        return adaptive
+
+    def _ask_use_cache(self) -> bool:
+        if CustomOS.getenv("APP_MODE", "") == DEV_MODE:
+            use_cache = CustomOS.getenv("USE_CACHE", "y") == "y"
+        else:
+            use_cache = self.input_m.confirm(
+                "Do you want to reuse the cached LLM responses for this sweep?"
+            )
+        return use_cache
+
+    def _ask_batch(self) -> bool:
+        if CustomOS.getenv("APP_MODE", "") == DEV_MODE:
+            batch = CustomOS.getenv("BATCH_MODE", "n") == "y"
+        else:
+            batch = self.input_m.confirm(
+                "Do you want to submit the LLM calls as batches (cheaper, results within hours)?"
+            )
+        return batch
+
     def _ask_llms(self, available_llms: list[LLM]) -> list[str]:
         if CustomOS.getenv("APP_MODE", "") == DEV_MODE:
             llms = CustomOS.getenv("LLMS").split(",")
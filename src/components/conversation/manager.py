@@ -10,8 +10,10 @@ logger = ItakelloLogging().get_logger(__name__)
 
 @dataclass
 class Manager(autogen.GroupChatManager):
-    def __init__(self, groupchat: Chat, llm_config: dict) -> None:
-        super().__init__(groupchat=groupchat, llm_config=llm_config)
+    def __init__(
+        self, groupchat: Chat, llm_config: dict, silent: bool = False
+    ) -> None:
+        super().__init__(groupchat=groupchat, llm_config=llm_config, silent=silent)
         logger.debug("Manager created")
 
     def __hash__(self) -> int:
@@ -16,16 +16,19 @@ class Message(MongoModel):
 
     @classmethod
     def from_document(cls, doc: dict) -> "Message":
-        return cls(
+        message = cls(
             index=doc["index"],
             day=doc["day"],
             role=doc["role"],
             speaker=doc["speaker"],
             content=doc["content"],
         )
+        message.id = doc["_id"]
+        return message
 
     def to_document(self) -> dict:
         return {
+            "_id": self.id,
             "index": self.index,
             "day": self.day,
             "role": self.role,
@@ -1,12 +1,17 @@
-from dataclasses import InitVar, dataclass, field
-import time
-import openai
-import httpx
+from dataclasses import InitVar, dataclass, field, replace
+import functools
 
 from autogen import OpenAIWrapper
 from itakello_logging import ItakelloLogging
+from openai import AsyncOpenAI
 
+from ..llm.batch_client import BatchClient, alimit
+from ..llm.call_ledger import call_scope
+from ..llm.context_window import FOLDED_PREFIX, ContextWindow
+from ..llm.hedger import Hedger
 from ..llm.llm import LLM
+from ..llm.rate_limiter import RateLimiter
+from ..llm.retry_policy import RetryPolicy
 from ..section.section import Section
 
 logger = ItakelloLogging().get_logger(__name__)
@@ -16,17 +21,23 @@ logger = ItakelloLogging().get_logger(__name__)
 class Summarizer:
     system_message_dict: dict = field(init=False)
     model: OpenAIWrapper = field(init=False)
+    config: dict = field(init=False)
+    context_window: ContextWindow = field(init=False)
+    _fold_window: ContextWindow = field(init=False)
 
     sections: InitVar[list[Section]]
     placeholders: InitVar[dict[str, str]]
-    llm: InitVar[LLM]
+    llm: LLM
 
     def __post_init__(
-        self, sections: list[Section], placeholders: dict[str, str], llm: LLM
+        self, sections: list[Section], placeholders: dict[str, str]
     ) -> None:
         system_message = self._generate_system_message(sections, placeholders)
         self.system_message_oai = {"content": system_message, "role": "system"}
-        self.model = OpenAIWrapper(config_list=[llm.config])
+        self.model = OpenAIWrapper(config_list=[self.llm.client_config])
+        self.config = self.llm.config
+        self.context_window = self.llm.create_context_window()
+        self._fold_window = replace(self.context_window, policy="truncate")
         logger.debug(f"Summarizer created")
 
     def _generate_system_message(
@@ -42,35 +53,104 @@ class Summarizer:
         return system_message
 
     def generate_summary(self, previous_conversation, round_number: int) -> str:
+        messages = self.context_window.fit(
+            [self.system_message_oai] + previous_conversation, self.fold
+        )
+        summary_text = self._create(messages)
+        summary = f"Day {round_number} summary:\n {summary_text}"
+        return summary
+
+    async def agenerate_summary(
+        self,
+        previous_conversation,
+        round_number: int,
+        client: AsyncOpenAI | BatchClient,
+    ) -> str:
         """
-        Generate a summary with retry logic for transient LLM errors.
+        Asynchronous version of generate_summary, used by the async engine.
         """
-        MAX_RETRIES = 3
-        attempts = 0
-        while True:
-            try:
-                summary_obj = self.model.create(
-                    messages=[self.system_message_oai] + previous_conversation
-                )
-                break
-            except (openai.error.OpenAIError, httpx.HTTPError) as e:
-                attempts += 1
-                if attempts >= MAX_RETRIES:
-                    logger.error(f"Summary generation failed after {attempts} attempts: {e}")
-                    raise
-                logger.warning(f"Error generating summary (attempt {attempts}/{MAX_RETRIES}): {e}. Retrying...")
-                time.sleep(2 ** attempts)
-            except Exception as e:
-                attempts += 1
-                if attempts >= MAX_RETRIES:
-                    logger.error(f"Unexpected error generating summary after {attempts} attempts: {e}")
-                    raise
-                logger.warning(f"Unexpected error generating summary (attempt {attempts}/{MAX_RETRIES}): {e}. Retrying...")
-                time.sleep(2 ** attempts)
-        summary_text = summary_obj.choices[0].message.content
+        messages = await self.context_window.afit(
+            [self.system_message_oai] + previous_conversation,
+            functools.partial(self.afold, client=client),
+        )
+        summary_text = await self._acreate(messages, client)
         summary = f"Day {round_number} summary:\n {summary_text}"
         return summary
 
+    def fold(self, messages: list[dict], previous_summary: str) -> str:
+        """
+        Summary of the older turns of a day that no longer fit in the context,
+        continuing the previous one.
+        """
+        return self._create(self._get_fold_messages(messages, previous_summary))
+
+    async def afold(
+        self,
+        messages: list[dict],
+        previous_summary: str,
+        client: AsyncOpenAI | BatchClient,
+    ) -> str:
+        return await self._acreate(
+            self._get_fold_messages(messages, previous_summary), client
+        )
+
+    def _get_fold_messages(
+        self, messages: list[dict], previous_summary: str
+    ) -> list[dict]:
+        previous = (
+            [{"content": FOLDED_PREFIX + previous_summary, "role": "user"}]
+            if previous_summary
+            else []
+        )
+        # Never folded again, the oldest turns are dropped if they do not fit
+        return self._fold_window.fit([self.system_message_oai] + previous + messages)
+
+    def _create(self, messages: list[dict]) -> str:
+        """
+        Generate a summary, retried on transient LLM errors (see RetryPolicy).
+        """
+        with call_scope(agent=self._get_name(), call_type="summary", turn=None):
+            return self.retry_policy.call(
+                lambda: self._create_once(messages), "generating summary"
+            )
+
+    def _create_once(self, messages: list[dict]) -> str:
+        with RateLimiter.for_config(self.config).limit(messages) as call:
+            summary_obj = self.model.create(messages=messages)
+            if summary_obj.usage is not None:
+                call.record_usage(summary_obj.usage.total_tokens)
+        return summary_obj.choices[0].message.content
+
+    async def _acreate(
+        self, messages: list[dict], client: AsyncOpenAI | BatchClient
+    ) -> str:
+        hedger = Hedger.for_config(self.config)
+        with call_scope(agent=self._get_name(), call_type="summary", turn=None):
+            return await self.retry_policy.acall(
+                lambda: hedger.arun(
+                    lambda: self._acreate_once(messages, client), messages, client
+                ),
+                "generating summary",
+            )
+
+    async def _acreate_once(
+        self, messages: list[dict], client: AsyncOpenAI | BatchClient
+    ) -> str:
+        limiter = RateLimiter.for_config(self.config)
+        async with alimit(limiter, client, messages) as call:
+            summary_obj = await client.chat.completions.create(
+                model=self.config["model"],
+                messages=messages,
+                **self.llm.request_params,
+            )
+            if summary_obj.usage is not None:
+                call.record_usage(summary_obj.usage.total_tokens)
+        return str(summary_obj.choices[0].message.content)
+
+    @property
+    def retry_policy(self) -> RetryPolicy:
+        return RetryPolicy.for_config(self.config)
+
     @classmethod
     def _get_name(cls) -> str:
         return "Summarizer"
@@ -0,0 +1,446 @@
+import asyncio
+import functools
+import json
+import threading
+import time
+import weakref
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from typing import ClassVar
+
+import httpx
+from itakello_logging import ItakelloLogging
+
+from ...utility.custom_os import CustomOS
+from .call_ledger import AsyncLedgerTransport, LedgerTransport
+from .endpoint_pool import Endpoint, EndpointPool
+from .fake_server import FakeLLM
+from .prompt_stats import PromptStats
+from .response_cache import AsyncCachingTransport, CachingTransport
+
+logger = ItakelloLogging().get_logger(__name__)
+
+BACKEND_TYPES = ("openai", "ollama", "fake")
+# OpenAI request fields with a native Ollama option of their own
+OLLAMA_OPTIONS = {
+    "temperature": "temperature",
+    "top_p": "top_p",
+    "max_tokens": "num_predict",
+    "seed": "seed",
+    "stop": "stop",
+    "frequency_penalty": "frequency_penalty",
+    "presence_penalty": "presence_penalty",
+}
+
+
+class SharedClient(httpx.Client):
+    # autogen deep-copies the llm_config of every agent, the pool must survive it
+    def __deepcopy__(self, memo: dict) -> "SharedClient":
+        return self
+
+
+class SharedAsyncClient(httpx.AsyncClient):
+    def __deepcopy__(self, memo: dict) -> "SharedAsyncClient":
+        return self
+
+
+@dataclass
+class Backend(ABC):
+    """
+    Transport of the LLM requests to one server (base_url).
+
+    Agents, managers and summarizers keep using the OpenAI client, but every
+    one of them gets the same pooled keep-alive HTTP client of the backend,
+    shared by all the conversations of the process. Backends that do not
+    speak the OpenAI API translate the requests in their transport. On top
+    of every transport, the prompt tokens the server evaluated are counted,
+    the response cache answers the requests it already knows and the calls
+    of the conversations are added to their ledger.
+    The async clients are bound to an event loop, so there is one per loop.
+    When the base_url is the one of a pool of Ollama servers, the requests
+    are routed to its servers right before they are sent (see EndpointPool).
+    """
+
+    base_url: str
+    timeout: float = 600.0
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+
+    http_client: SharedClient = field(init=False)
+    pool: EndpointPool | None = field(init=False, default=None)
+    _async_clients: weakref.WeakKeyDictionary = field(
+        init=False, default_factory=weakref.WeakKeyDictionary
+    )
+
+    _registry: ClassVar[dict[tuple[str, str], "Backend"]] = {}
+    _lock: ClassVar[threading.Lock] = threading.Lock()
+
+    def __post_init__(self) -> None:
+        self.pool = EndpointPool.for_url(self.base_url)
+        stats = PromptStats.for_url(self.base_url)
+        self.http_client = SharedClient(
+            transport=LedgerTransport(
+                CachingTransport(UsageTransport(self._create_transport(), stats))
+            ),
+            timeout=self.timeout,
+        )
+        logger.debug(f"Created backend {self}")
+
+    def __str__(self) -> str:
+        return (
+            f"[{self.base_url}] ({type(self).__name__}, timeout: {self.timeout}s, "
+            + f"connections: {self.max_connections}/{self.max_keepalive_connections} keep-alive)"
+        )
+
+    @property
+    def limits(self) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections,
+        )
+
+    def get_async_client(self) -> SharedAsyncClient:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if loop not in self._async_clients:
+                stats = PromptStats.for_url(self.base_url)
+                self._async_clients[loop] = SharedAsyncClient(
+                    transport=AsyncLedgerTransport(
+                        AsyncCachingTransport(
+                            AsyncUsageTransport(self._create_async_transport(), stats)
+                        )
+                    ),
+                    timeout=self.timeout,
+                )
+            return self._async_clients[loop]
+
+    def _create_http_transport(self) -> httpx.BaseTransport:
+        transport = httpx.HTTPTransport(limits=self.limits)
+        if self.pool is None:
+            return transport
+        return PoolTransport(transport, self.pool)
+
+    def _create_async_http_transport(self) -> httpx.AsyncBaseTransport:
+        transport = httpx.AsyncHTTPTransport(limits=self.limits)
+        if self.pool is None:
+            return transport
+        return AsyncPoolTransport(transport, self.pool)
+
+    @abstractmethod
+    def _create_transport(self) -> httpx.BaseTransport:
+        pass
+
+    @abstractmethod
+    def _create_async_transport(self) -> httpx.AsyncBaseTransport:
+        pass
+
+    @classmethod
+    def for_config(cls, backend_type: str, base_url: str) -> "Backend":
+        assert backend_type in BACKEND_TYPES, logger.error(
+            f"Invalid LLM backend [{backend_type}], expected one of {BACKEND_TYPES}"
+        )
+        key = (backend_type, base_url)
+        with cls._lock:
+            if key not in cls._registry:
+                backend_cls = {
+                    "openai": OpenAIBackend,
+                    "ollama": OllamaBackend,
+                    "fake": FakeBackend,
+                }[backend_type]
+                cls._registry[key] = backend_cls(base_url=base_url, **cls._from_env())
+            return cls._registry[key]
+
+    @classmethod
+    def _from_env(cls) -> dict:
+        """
+        LLM_TIMEOUT sets the timeout of every request in seconds (600) and
+        LLM_MAX_CONNECTIONS / LLM_MAX_KEEPALIVE the size of the connection
+        pool of each backend (100 / 20).
+        """
+        return {
+            "timeout": float(CustomOS.getenv("LLM_TIMEOUT", "600")),
+            "max_connections": int(CustomOS.getenv("LLM_MAX_CONNECTIONS", "100")),
+            "max_keepalive_connections": int(
+                CustomOS.getenv("LLM_MAX_KEEPALIVE", "20")
+            ),
+        }
+
+
+@dataclass
+class OpenAIBackend(Backend):
+    """Any server with an OpenAI compatible API, including Ollama's /v1."""
+
+    def _create_transport(self) -> httpx.BaseTransport:
+        return self._create_http_transport()
+
+    def _create_async_transport(self) -> httpx.AsyncBaseTransport:
+        return self._create_async_http_transport()
+
+
+@dataclass
+class OllamaBackend(Backend):
+    """
+    Ollama through its native API, which also honours the options the
+    OpenAI compatible one ignores (``top_k``, ``num_ctx``, ``keep_alive``).
+    """
+
+    def _create_transport(self) -> httpx.BaseTransport:
+        return OllamaTransport(self._create_http_transport())
+
+    def _create_async_transport(self) -> httpx.AsyncBaseTransport:
+        return AsyncOllamaTransport(self._create_async_http_transport())
+
+
+class OllamaTransport(httpx.BaseTransport):
+    def __init__(self, transport: httpx.BaseTransport) -> None:
+        self._transport = transport
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        if not _is_chat_completion(request):
+            return self._transport.handle_request(request)
+        body = json.loads(request.read())
+        response = self._transport.handle_request(_to_native_request(request, body))
+        response.read()
+        return _from_native_response(request, body, response)
+
+    def close(self) -> None:
+        self._transport.close()
+
+
+class AsyncOllamaTransport(httpx.AsyncBaseTransport):
+    def __init__(self, transport: httpx.AsyncBaseTransport) -> None:
+        self._transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if not _is_chat_completion(request):
+            return await self._transport.handle_async_request(request)
+        body = json.loads(await request.aread())
+        response = await self._transport.handle_async_request(
+            _to_native_request(request, body)
+        )
+        await response.aread()
+        return _from_native_response(request, body, response)
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+class PoolTransport(httpx.BaseTransport):
+    def __init__(self, transport: httpx.BaseTransport, pool: EndpointPool) -> None:
+        self._transport = transport
+        self._pool = pool
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        endpoint = self._pool.acquire(_get_model(request.read()))
+        try:
+            response = self._transport.handle_request(
+                _to_endpoint_request(request, self._pool, endpoint)
+            )
+        except httpx.TransportError:
+            self._pool.release(endpoint, success=False)
+            raise
+        except BaseException:
+            self._pool.release(endpoint, success=True)
+            raise
+        self._pool.release(endpoint, success=response.status_code < 500)
+        return response
+
+    def close(self) -> None:
+        self._transport.close()
+
+
+class AsyncPoolTransport(httpx.AsyncBaseTransport):
+    def __init__(self, transport: httpx.AsyncBaseTransport, pool: EndpointPool) -> None:
+        self._transport = transport
+        self._pool = pool
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        endpoint = self._pool.acquire(_get_model(await request.aread()))
+        try:
+            response = await self._transport.handle_async_request(
+                _to_endpoint_request(request, self._pool, endpoint)
+            )
+        except httpx.TransportError:
+            self._pool.release(endpoint, success=False)
+            raise
+        except BaseException:
+            # e.g. the cancelled loser of a hedge, not a failure of the server
+            self._pool.release(endpoint, success=True)
+            raise
+        self._pool.release(endpoint, success=response.status_code < 500)
+        return response
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+class UsageTransport(httpx.BaseTransport):
+    def __init__(self, transport: httpx.BaseTransport, stats: PromptStats) -> None:
+        self._transport = transport
+        self._stats = stats
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        response = self._transport.handle_request(request)
+        if _is_chat_completion(request) and response.status_code == 200:
+            response.read()
+            _record_usage(self._stats, request, response)
+        return response
+
+    def close(self) -> None:
+        self._transport.close()
+
+
+class AsyncUsageTransport(httpx.AsyncBaseTransport):
+    def __init__(self, transport: httpx.AsyncBaseTransport, stats: PromptStats) -> None:
+        self._transport = transport
+        self._stats = stats
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        response = await self._transport.handle_async_request(request)
+        if _is_chat_completion(request) and response.status_code == 200:
+            await response.aread()
+            _record_usage(self._stats, request, response)
+        return response
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+@dataclass
+class FakeBackend(Backend):
+    """
+    In-process backend that answers without any server, to try sweeps and
+    the conversation flow for free. The replies are the ones of the fake
+    server (see FakeLLM), without its latency and errors.
+    """
+
+    def _create_transport(self) -> httpx.BaseTransport:
+        return httpx.MockTransport(_fake_chat_completion)
+
+    def _create_async_transport(self) -> httpx.AsyncBaseTransport:
+        return httpx.MockTransport(_fake_chat_completion)
+
+
+def _is_chat_completion(request: httpx.Request) -> bool:
+    return request.method == "POST" and request.url.path.endswith("/chat/completions")
+
+
+def _record_usage(
+    stats: PromptStats, request: httpx.Request, response: httpx.Response
+) -> None:
+    usage = response.json().get("usage")
+    if usage is None:
+        return
+    body = json.loads(request.read())
+    stats.record(body["model"], body["messages"], usage)
+
+
+def _get_model(content: bytes) -> str | None:
+    # Model of a chat request, for routing; the other requests have none
+    try:
+        body = json.loads(content) if content else None
+    except ValueError:
+        return None
+    return body.get("model") if isinstance(body, dict) else None
+
+
+def _to_endpoint_request(
+    request: httpx.Request, pool: EndpointPool, endpoint: Endpoint
+) -> httpx.Request:
+    if endpoint.url == pool.url:
+        return request
+    url = endpoint.url + str(request.url).removeprefix(pool.url)
+    headers = request.headers.copy()
+    # Set again by httpx from the new url
+    del headers["host"]
+    return httpx.Request(
+        request.method,
+        url,
+        headers=headers,
+        content=request.content,
+        extensions=request.extensions,
+    )
+
+
+def _to_native_request(request: httpx.Request, body: dict) -> httpx.Request:
+    options = dict(body.get("options", {}))
+    for field_name, option in OLLAMA_OPTIONS.items():
+        if body.get(field_name) is not None:
+            options[option] = body[field_name]
+    native_body = {
+        "model": body["model"],
+        "messages": body["messages"],
+        "stream": False,
+        "options": options,
+    }
+    if "keep_alive" in body:
+        native_body["keep_alive"] = body["keep_alive"]
+    # The OpenAI API is served under /v1, the native one under /api
+    path = request.url.path.removesuffix("/chat/completions").removesuffix("/v1")
+    return httpx.Request(
+        "POST",
+        request.url.copy_with(path=f"{path}/api/chat"),
+        json=native_body,
+        extensions=request.extensions,
+    )
+
+
+def _from_native_response(
+    request: httpx.Request, body: dict, response: httpx.Response
+) -> httpx.Response:
+    if response.status_code != 200:
+        # The OpenAI client raises the error, with Ollama's message and headers
+        # (Retry-After...), but the body is already decoded
+        headers = [
+            (name, value)
+            for name, value in response.headers.items()
+            if name not in ("content-encoding", "content-length", "transfer-encoding")
+        ]
+        return httpx.Response(
+            response.status_code,
+            headers=headers,
+            content=response.content,
+            request=request,
+        )
+    native = response.json()
+    prompt_tokens = native.get("prompt_eval_count", 0)
+    completion_tokens = native.get("eval_count", 0)
+    return httpx.Response(
+        200,
+        json={
+            "id": f"chatcmpl-{time.time_ns()}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": native.get("model", body["model"]),
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {
+                        "role": "assistant",
+                        "content": native["message"]["content"],
+                    },
+                    "finish_reason": (
+                        "length" if native.get("done_reason") == "length" else "stop"
+                    ),
+                }
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        },
+        request=request,
+    )
+
+
+def _fake_chat_completion(request: httpx.Request) -> httpx.Response:
+    if not _is_chat_completion(request):
+        return httpx.Response(404, json={"error": "not found"}, request=request)
+    body = json.loads(request.read())
+    return httpx.Response(200, json=_get_fake_llm().chat_completion(body), request=request)
+
+
+@functools.lru_cache(maxsize=1)
+def _get_fake_llm() -> FakeLLM:
+    return FakeLLM.from_env()
@@ -0,0 +1,344 @@
+import asyncio
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+import weakref
+from abc import ABC, abstractmethod
+from contextlib import AbstractAsyncContextManager, nullcontext
+from dataclasses import dataclass, field
+from typing import ClassVar
+
+import openai
+from itakello_logging import ItakelloLogging
+from openai import AsyncOpenAI
+from openai.types.chat import ChatCompletion
+
+from ...utility.custom_os import CustomOS
+from .call_ledger import record_call
+from .rate_limiter import LimitedCall, RateLimiter
+
+logger = ItakelloLogging().get_logger(__name__)
+
+BATCH_API_TYPES = ("openai", "local")
+BATCH_ENDPOINT = "/v1/chat/completions"
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+class BatchRequestError(openai.OpenAIError):
+    pass
+
+
+class BatchAPI(ABC):
+    """Submission of a JSONL batch file and retrieval of its results."""
+
+    @abstractmethod
+    async def submit(self, path: str) -> str:
+        pass
+
+    @abstractmethod
+    async def get_status(self, batch_id: str) -> str:
+        pass
+
+    @abstractmethod
+    async def get_results(self, batch_id: str) -> list[dict]:
+        pass
+
+
+@dataclass
+class OpenAIBatchAPI(BatchAPI):
+    """The Batch API of OpenAI, or of any server that implements it."""
+
+    client: AsyncOpenAI
+
+    _batches: dict = field(init=False, default_factory=dict)
+
+    async def submit(self, path: str) -> str:
+        with open(path, "rb") as file:
+            input_file = await self.client.files.create(file=file, purpose="batch")
+        batch = await self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window="24h",
+        )
+        return batch.id
+
+    async def get_status(self, batch_id: str) -> str:
+        batch = await self.client.batches.retrieve(batch_id)
+        self._batches[batch_id] = batch
+        return batch.status
+
+    async def get_results(self, batch_id: str) -> list[dict]:
+        batch = self._batches.pop(batch_id)
+        lines = []
+        # Failed requests are in the error file instead of the output one
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id is None:
+                continue
+            content = await self.client.files.content(file_id)
+            lines.extend(content.text.splitlines())
+        return [json.loads(line) for line in lines if line.strip()]
+
+
+@dataclass
+class LocalBatchAPI(BatchAPI):
+    """
+    File-backed stand-in of the Batch API, for servers without one and for
+    testing. The requests of a batch are sent one by one with the regular
+    client, in the background, and the results are written next to the
+    input file in the same format as OpenAI's.
+    """
+
+    client: AsyncOpenAI
+    directory: str
+
+    _tasks: dict[str, asyncio.Task] = field(init=False, default_factory=dict)
+
+    async def submit(self, path: str) -> str:
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        self._tasks[batch_id] = asyncio.create_task(self._process(batch_id, path))
+        return batch_id
+
+    async def get_status(self, batch_id: str) -> str:
+        if os.path.exists(self._get_output_path(batch_id)):
+            return "completed"
+        task = self._tasks.get(batch_id)
+        if task is not None and task.done() and task.exception() is not None:
+            return "failed"
+        return "in_progress"
+
+    async def get_results(self, batch_id: str) -> list[dict]:
+        self._tasks.pop(batch_id, None)
+        output_path = self._get_output_path(batch_id)
+        with open(output_path, "r") as file:
+            results = [json.loads(line) for line in file if line.strip()]
+        os.remove(output_path)
+        return results
+
+    async def _process(self, batch_id: str, path: str) -> None:
+        with open(path, "r") as file:
+            requests = [json.loads(line) for line in file if line.strip()]
+        results = []
+        for request in requests:
+            try:
+                # Sent as is, the body may hold options of other servers
+                response = await self.client.post(
+                    "/chat/completions", body=request["body"], cast_to=ChatCompletion
+                )
+                result = {
+                    "custom_id": request["custom_id"],
+                    "response": {"status_code": 200, "body": response.model_dump()},
+                    "error": None,
+                }
+            except openai.OpenAIError as e:
+                result = {
+                    "custom_id": request["custom_id"],
+                    "response": None,
+                    "error": {"message": str(e)},
+                }
+            results.append(result)
+        # Written under another name first, so that it appears complete
+        output_path = self._get_output_path(batch_id)
+        with open(f"{output_path}.tmp", "w") as file:
+            file.writelines(json.dumps(result) + "\n" for result in results)
+        os.replace(f"{output_path}.tmp", output_path)
+
+    def _get_output_path(self, batch_id: str) -> str:
+        return os.path.join(self.directory, f"{batch_id}_output.jsonl")
+
+
+@dataclass
+class BatchClient:
+    """
+    Stands in for the ``AsyncOpenAI`` client of the async engine and turns
+    chat completions into batch requests.
+
+    The requests made by the concurrent conversations within
+    ``window_seconds`` of each other (usually the turns at the same depth)
+    are written to one JSONL file and submitted together, up to
+    ``max_batch_size`` requests per batch. Every request waits for the
+    result of its batch, then its conversation goes on with the next turn.
+    """
+
+    api: BatchAPI
+    directory: str
+    max_batch_size: int = 1000
+    window_seconds: float = 5.0
+    poll_seconds: float = 30.0
+
+    batches: int = field(init=False, default=0)
+    _pending: list[tuple[str, dict, asyncio.Future]] = field(
+        init=False, default_factory=list
+    )
+    _timer: asyncio.TimerHandle | None = field(init=False, default=None)
+    _tasks: set[asyncio.Task] = field(init=False, default_factory=set)
+
+    # Event loop -> base_url -> client, like the async clients of the backends
+    _clients: ClassVar[weakref.WeakKeyDictionary] = weakref.WeakKeyDictionary()
+    _settings: ClassVar[dict | None] = None
+    _lock: ClassVar[threading.Lock] = threading.Lock()
+
+    def __post_init__(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+
+    @property
+    def chat(self) -> "BatchClient":
+        # Same calls as the OpenAI client: client.chat.completions.create
+        return self
+
+    @property
+    def completions(self) -> "BatchClient":
+        return self
+
+    async def create(
+        self, model: str, messages: list[dict], **params
+    ) -> ChatCompletion:
+        body = {"model": model, "messages": messages, **params}
+        # Fields the OpenAI client would merge into the request body
+        body.update(body.pop("extra_body", None) or {})
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((uuid.uuid4().hex, body, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(
+                self.window_seconds, self._flush
+            )
+        start_time = time.monotonic()
+        response = await future
+        # Recorded here, in the task of the conversation, with its latency
+        # in the batch
+        usage = response.usage.model_dump() if response.usage is not None else {}
+        record_call(
+            model, messages, usage, time.monotonic() - start_time, cache_hit=False
+        )
+        return response
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        requests, self._pending = self._pending, []
+        if not requests:
+            return
+        # Started in an empty context: the batch belongs to no conversation,
+        # its requests are recorded in the ledgers of their callers
+        task = contextvars.Context().run(
+            asyncio.create_task, self._run_batch(requests)
+        )
+        # Keeps a reference, the loop only holds weak ones
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, requests: list[tuple[str, dict, asyncio.Future]]) -> None:
+        futures = {custom_id: future for custom_id, _, future in requests}
+        path = None
+        try:
+            path = self._write_batch_file(requests)
+            batch_id = await self.api.submit(path)
+            self.batches += 1
+            logger.info(f"Submitted batch {batch_id} with {len(requests)} requests")
+            status = await self.api.get_status(batch_id)
+            while status not in TERMINAL_STATUSES:
+                await asyncio.sleep(self.poll_seconds)
+                status = await self.api.get_status(batch_id)
+            if status != "completed":
+                raise BatchRequestError(f"Batch {batch_id} {status}")
+            for result in await self.api.get_results(batch_id):
+                future = futures.pop(result["custom_id"], None)
+                if future is None or future.done():
+                    continue
+                response = result.get("response") or {}
+                if response.get("status_code") == 200:
+                    future.set_result(ChatCompletion.model_validate(response["body"]))
+                else:
+                    error = result.get("error") or response.get("body")
+                    future.set_exception(BatchRequestError(f"Batch request failed: {error}"))
+            logger.debug(f"Batch {batch_id} completed")
+        except Exception as e:
+            for future in futures.values():
+                if not future.done():
+                    future.set_exception(
+                        e if isinstance(e, openai.OpenAIError) else BatchRequestError(str(e))
+                    )
+            return
+        finally:
+            # The batch is over, its requests are not needed anymore
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+        for future in futures.values():
+            if not future.done():
+                future.set_exception(BatchRequestError("Missing from the batch results"))
+
+    def _write_batch_file(self, requests: list[tuple[str, dict, asyncio.Future]]) -> str:
+        path = os.path.join(self.directory, f"requests_{uuid.uuid4().hex}.jsonl")
+        with open(path, "w") as file:
+            for custom_id, body, _ in requests:
+                line = {
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": BATCH_ENDPOINT,
+                    "body": body,
+                }
+                file.write(json.dumps(line) + "\n")
+        return path
+
+    @classmethod
+    def enable(cls) -> None:
+        """
+        BATCH_API selects the Batch API (openai, or local for the file-backed
+        stand-in) and BATCH_DIR where the batch files are written
+        (.cache/batches). BATCH_MAX_SIZE, BATCH_WINDOW_SECONDS and
+        BATCH_POLL_SECONDS tune the batches (1000, 5 and 30).
+        """
+        api_type = CustomOS.getenv("BATCH_API", "openai")
+        assert api_type in BATCH_API_TYPES, logger.error(
+            f"BATCH_API must be one of {BATCH_API_TYPES} [{api_type}]"
+        )
+        with cls._lock:
+            cls._settings = {
+                "api_type": api_type,
+                "directory": CustomOS.getenv("BATCH_DIR", ".cache/batches"),
+                "max_batch_size": int(CustomOS.getenv("BATCH_MAX_SIZE", "1000")),
+                "window_seconds": float(CustomOS.getenv("BATCH_WINDOW_SECONDS", "5")),
+                "poll_seconds": float(CustomOS.getenv("BATCH_POLL_SECONDS", "30")),
+            }
+
+    @classmethod
+    def disable(cls) -> None:
+        with cls._lock:
+            cls._settings = None
+
+    @classmethod
+    def is_enabled(cls) -> bool:
+        return cls._settings is not None
+
+    @classmethod
+    def for_client(cls, client: AsyncOpenAI) -> "BatchClient":
+        # Called from the event loop the batches will be run in
+        loop = asyncio.get_running_loop()
+        base_url = str(client.base_url)
+        with cls._lock:
+            assert cls._settings is not None, logger.error("Batch mode is not enabled")
+            settings = dict(cls._settings)
+            clients = cls._clients.setdefault(loop, {})
+            if base_url not in clients:
+                api_type = settings.pop("api_type")
+                api: BatchAPI
+                if api_type == "local":
+                    api = LocalBatchAPI(client=client, directory=settings["directory"])
+                else:
+                    api = OpenAIBatchAPI(client=client)
+                clients[base_url] = cls(api=api, **settings)
+            return clients[base_url]
+
+
+def alimit(
+    limiter: RateLimiter, client: "AsyncOpenAI | BatchClient", messages: list[dict]
+) -> AbstractAsyncContextManager[LimitedCall]:
+    # Batches wait in the Batch API queue, holding a slot would only cap them
+    if isinstance(client, BatchClient):
+        return nullcontext(LimitedCall(prompt_tokens=0))
+    return limiter.alimit(messages)
@@ -0,0 +1,248 @@
+import json
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field, replace
+from datetime import datetime
+from typing import Iterator
+
+import httpx
+from bson.objectid import ObjectId
+from itakello_logging import ItakelloLogging
+
+from ...interfaces.mongo_model import MongoModel
+from .prompt_stats import split_prompt_tokens
+
+logger = ItakelloLogging().get_logger(__name__)
+
+CALL_TYPES = ("reply", "summary", "speaker-selection")
+
+
+@dataclass
+class LLMCall(MongoModel):
+    """
+    One LLM call of a conversation: who made it, when in the conversation,
+    and what it cost. A turn is the index of the message the call is for
+    within its day (None for the summaries). Of the prompt tokens, the
+    server evaluated ``evaluated_tokens`` and served ``cached_tokens`` from
+    its prefix cache (both 0 when the response cache answered). When the
+    server does not report its cached tokens (Ollama), ``estimated`` is set:
+    the prompt was counted with a local tokenizer, so ``prompt_tokens`` and
+    ``cached_tokens`` are approximations rather than measured reuse.
+    """
+
+    conversation_id: ObjectId
+    day: int
+    turn: int | None
+    agent: str
+    call_type: str
+    model: str
+    prompt_tokens: int
+    completion_tokens: int
+    evaluated_tokens: int
+    cached_tokens: int
+    latency: float
+    cache_hit: bool
+    estimated: bool = False
+    experiment_id: ObjectId | None = None
+    sweep_id: ObjectId | None = None
+    id: ObjectId = field(default_factory=ObjectId)
+    creation_date: datetime = field(default_factory=datetime.now)
+
+    @classmethod
+    def from_document(cls, doc: dict) -> "LLMCall":
+        return cls(
+            id=doc["_id"],
+            conversation_id=doc["conversation_id"],
+            experiment_id=doc.get("experiment_id"),
+            sweep_id=doc.get("sweep_id"),
+            day=doc["day"],
+            turn=doc["turn"],
+            agent=doc["agent"],
+            call_type=doc["call_type"],
+            model=doc["model"],
+            prompt_tokens=doc["prompt_tokens"],
+            completion_tokens=doc["completion_tokens"],
+            evaluated_tokens=doc["evaluated_tokens"],
+            cached_tokens=doc["cached_tokens"],
+            latency=doc["latency"],
+            cache_hit=doc["cache_hit"],
+            estimated=doc.get("estimated", False),
+            creation_date=doc["creation_date"],
+        )
+
+    def to_document(self) -> dict:
+        return {
+            "_id": self.id,
+            "conversation_id": self.conversation_id,
+            "experiment_id": self.experiment_id,
+            "sweep_id": self.sweep_id,
+            "day": self.day,
+            "turn": self.turn,
+            "agent": self.agent,
+            "call_type": self.call_type,
+            "model": self.model,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "evaluated_tokens": self.evaluated_tokens,
+            "cached_tokens": self.cached_tokens,
+            "latency": self.latency,
+            "cache_hit": self.cache_hit,
+            "estimated": self.estimated,
+            "creation_date": self.creation_date,
+        }
+
+
+@dataclass
+class CallLedger:
+    """
+    The LLM calls of one conversation, kept until they are saved with it.
+
+    While the conversation runs (see ``bind``), every chat completion that
+    goes through a backend is added to its ledger, tagged with the day,
+    turn, agent and call type set by ``call_scope`` around the call. The
+    tags live in a context variable, so they follow the conversation into
+    its thread or its asyncio task without being passed along.
+    """
+
+    _calls: list[LLMCall] = field(init=False, default_factory=list)
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    @contextmanager
+    def bind(self, conversation_id: ObjectId) -> Iterator[None]:
+        token = _scope.set(CallScope(ledger=self, conversation_id=conversation_id))
+        try:
+            yield
+        finally:
+            _scope.reset(token)
+
+    def add(self, call: LLMCall) -> None:
+        self._calls.append(call)
+
+    def drain(self) -> list[LLMCall]:
+        # The calls not saved yet, the ledger is emptied
+        calls, self._calls = self._calls, []
+        return calls
+
+
+@dataclass(frozen=True)
+class CallScope:
+    ledger: CallLedger
+    conversation_id: ObjectId
+    day: int = 0
+    turn: int | None = None
+    agent: str = ""
+    call_type: str = "reply"
+
+
+_scope: ContextVar[CallScope | None] = ContextVar("llm_call_scope", default=None)
+
+
+@contextmanager
+def call_scope(**tags) -> Iterator[None]:
+    # Tags the LLM calls made inside, outside of a conversation it does nothing
+    scope = _scope.get()
+    if scope is None:
+        yield
+        return
+    assert tags.get("call_type", scope.call_type) in CALL_TYPES, logger.error(
+        f"Invalid LLM call type [{tags['call_type']}]"
+    )
+    token = _scope.set(replace(scope, **tags))
+    try:
+        yield
+    finally:
+        _scope.reset(token)
+
+
+def record_call(
+    model: str, messages: list[dict], usage: dict, latency: float, cache_hit: bool
+) -> None:
+    scope = _scope.get()
+    if scope is None:
+        return
+    prompt_tokens, evaluated, estimated = split_prompt_tokens(model, messages, usage)
+    if cache_hit:
+        # Not sent to the server at all
+        evaluated, cached = 0, 0
+    else:
+        cached = prompt_tokens - evaluated
+    call = LLMCall(
+        conversation_id=scope.conversation_id,
+        day=scope.day,
+        turn=scope.turn,
+        agent=scope.agent,
+        call_type=scope.call_type,
+        model=model,
+        prompt_tokens=prompt_tokens,
+        completion_tokens=usage.get("completion_tokens") or 0,
+        evaluated_tokens=evaluated,
+        cached_tokens=cached,
+        latency=latency,
+        cache_hit=cache_hit,
+        estimated=estimated,
+    )
+    scope.ledger.add(call)
+    logger.debug(
+        f"[{model}] {call.call_type} of {call.agent} (day {call.day}, turn {call.turn}): "
+        + f"{call.prompt_tokens} prompt ({call.evaluated_tokens} evaluated, "
+        + f"{call.cached_tokens} from cache{', estimated' if estimated else ''}) + "
+        + f"{call.completion_tokens} completion "
+        + f"tokens in {latency:.2f}s{' (cached response)' if cache_hit else ''}"
+    )
+
+
+class LedgerTransport(httpx.BaseTransport):
+    def __init__(self, transport: httpx.BaseTransport) -> None:
+        self._transport = transport
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        if _scope.get() is None or not _is_chat_completion(request):
+            return self._transport.handle_request(request)
+        start_time = time.monotonic()
+        response = self._transport.handle_request(request)
+        if response.status_code == 200:
+            response.read()
+            _record_response(request, response, time.monotonic() - start_time)
+        return response
+
+    def close(self) -> None:
+        self._transport.close()
+
+
+class AsyncLedgerTransport(httpx.AsyncBaseTransport):
+    def __init__(self, transport: httpx.AsyncBaseTransport) -> None:
+        self._transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if _scope.get() is None or not _is_chat_completion(request):
+            return await self._transport.handle_async_request(request)
+        start_time = time.monotonic()
+        response = await self._transport.handle_async_request(request)
+        if response.status_code == 200:
+            await response.aread()
+            _record_response(request, response, time.monotonic() - start_time)
+        return response
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+def _is_chat_completion(request: httpx.Request) -> bool:
+    return request.method == "POST" and request.url.path.endswith("/chat/completions")
+
+
+def _record_response(
+    request: httpx.Request, response: httpx.Response, latency: float
+) -> None:
+    body = json.loads(request.read())
+    record_call(
+        body["model"],
+        body["messages"],
+        response.json().get("usage") or {},
+        latency,
+        # Answered by the ResponseCache
+        cache_hit=response.headers.get("x-cache") == "hit",
+    )
@@ -0,0 +1,73 @@
+import time
+from dataclasses import dataclass, field
+from statistics import median
+
+
+@dataclass
+class ConcurrencyController:
+    """
+    AIMD controller of the number of LLM calls in flight on one backend.
+
+    After every window of ``limit`` completed calls, roughly one round trip of
+    all the calls in flight, it compares the median latency per token with
+    the lowest one seen so far. If the latency grew past ``latency_tolerance``
+    times that baseline, or too many calls failed, the limit is cut by
+    ``decrease_factor``. Otherwise it grows by one, up to ``max_limit``. Calls
+    started before the last change are ignored, because they ran under the
+    old limit.
+    """
+
+    max_limit: int
+    min_limit: int = 1
+    latency_tolerance: float = 2.0
+    max_error_rate: float = 0.1
+    decrease_factor: float = 0.5
+    # How fast the baseline forgets an old minimum, since prompts keep growing
+    baseline_drift: float = 1.02
+
+    limit: int = field(init=False)
+    baseline: float | None = field(init=False, default=None)
+    _latencies: list[float] = field(init=False, default_factory=list)
+    _errors: int = field(init=False, default=0)
+    _changed_at: float = field(init=False, default_factory=time.monotonic)
+
+    def __post_init__(self) -> None:
+        self.max_limit = max(self.max_limit, self.min_limit)
+        # Start halfway, so that both directions are explored early
+        self.limit = max(self.min_limit, self.max_limit // 2)
+
+    def record(
+        self, latency_per_token: float, failed: bool, started_at: float
+    ) -> int | None:
+        """
+        Records a completed call and returns the new limit when it changes.
+        """
+        if started_at < self._changed_at:
+            return None
+        if failed:
+            self._errors += 1
+        else:
+            self._latencies.append(latency_per_token)
+        if len(self._latencies) + self._errors < self.limit:
+            return None
+        error_rate = self._errors / (len(self._latencies) + self._errors)
+        latency = median(self._latencies) if self._latencies else None
+        self._latencies = []
+        self._errors = 0
+        if latency is not None:
+            if self.baseline is None or latency < self.baseline:
+                self.baseline = latency
+            else:
+                self.baseline *= self.baseline_drift
+        congested = latency is not None and latency > (
+            self.latency_tolerance * self.baseline  # type: ignore
+        )
+        if error_rate > self.max_error_rate or congested:
+            new_limit = max(self.min_limit, int(self.limit * self.decrease_factor))
+        else:
+            new_limit = min(self.max_limit, self.limit + 1)
+        if new_limit == self.limit:
+            return None
+        self.limit = new_limit
+        self._changed_at = time.monotonic()
+        return new_limit
@@ -0,0 +1,236 @@
+import functools
+import threading
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, ClassVar
+
+import tiktoken
+from itakello_logging import ItakelloLogging
+
+from ...utility.consts import MAX_CONTEXT_LEN
+from ...utility.custom_os import CustomOS
+from .rate_limiter import EXPECTED_COMPLETION_TOKENS, estimate_tokens
+
+logger = ItakelloLogging().get_logger(__name__)
+
+CONTEXT_POLICIES = ("truncate", "summarize")
+# Tokens the chat template adds around every message (role and separators)
+TOKENS_PER_MESSAGE = 4
+# Sizes num_ctx is rounded up to, within the budget of the requests
+NUM_CTX_STEPS = (2048, 4096, 8192, 16384, 32768, 65536, 131072)
+# Room over the estimated largest request, whose replies may be longer
+NUM_CTX_MARGIN = 1.25
+# Used for the models without a tokenizer of their own, i.e. Ollama's
+FALLBACK_ENCODING = "cl100k_base"
+FOLDED_PREFIX = "Summary of the earlier messages:\n"
+
+# Summarize the given messages, continuing the previous summary (may be "")
+Fold = Callable[[list[dict], str], str]
+AsyncFold = Callable[[list[dict], str], Awaitable[str]]
+
+
+@functools.lru_cache(maxsize=None)
+def get_tokenizer(model: str) -> Callable[[str], int]:
+    """
+    Token counter of a model: its own tiktoken encoding for OpenAI models,
+    cl100k_base as an approximation for the others. When no encoding can be
+    loaded (tiktoken downloads them once), tokens are estimated from the
+    length of the text.
+    """
+    try:
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoding = tiktoken.get_encoding(FALLBACK_ENCODING)
+    except Exception as e:
+        logger.warning(f"No tokenizer for [{model}], estimating tokens from text: {e}")
+        return estimate_tokens
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+def count_tokens(model: str, messages: list[dict]) -> int:
+    tokenizer = get_tokenizer(model)
+    return sum(
+        tokenizer(str(message.get("content") or "")) + TOKENS_PER_MESSAGE
+        for message in messages
+    )
+
+
+@dataclass
+class ContextWindow:
+    """
+    Token budget of the requests of one conversation to its model.
+
+    When a prompt and the tokens reserved for the completion do not fit in
+    ``max_tokens``, the oldest turns are dropped (``truncate``) or folded
+    into a rolling summary by the given ``fold`` (``summarize``), which
+    extends the summary with the newly dropped turns at every request
+    instead of rewriting it. The system messages, the starting message and
+    the last message are always kept.
+
+    The ``num_ctx`` sent to Ollama is sized once per sweep from its
+    estimated largest request and stored with it (see ``get_num_ctx``), so
+    every request, process and worker of the sweep sends the same one:
+    Ollama reloads a model whenever its num_ctx changes. The budget of the
+    window is then that num_ctx, so no request overflows it.
+    """
+
+    model: str
+    max_tokens: int | None = MAX_CONTEXT_LEN
+    policy: str = "truncate"
+    completion_tokens: int = EXPECTED_COMPLETION_TOKENS
+
+    summary: str = field(init=False, default="")
+    _folded: list[str] = field(init=False, default_factory=list)
+
+    # Model -> [trimmed requests, dropped messages]
+    _trimmed: ClassVar[dict[str, list[int]]] = {}
+    _lock: ClassVar[threading.Lock] = threading.Lock()
+
+    def __post_init__(self) -> None:
+        assert self.policy in CONTEXT_POLICIES, logger.error(
+            f"LLM_CONTEXT_POLICY must be one of {CONTEXT_POLICIES} [{self.policy}]"
+        )
+
+    def count(self, messages: list[dict]) -> int:
+        return count_tokens(self.model, messages)
+
+    def fit(self, messages: list[dict], fold: Fold | None = None) -> list[dict]:
+        head, middle, tail, dropped = self._split(messages)
+        if dropped and self.policy == "summarize" and fold is not None:
+            new, previous = self._get_unfolded(dropped)
+            summary = fold(new, previous) if new else self.summary
+            self._set_summary(dropped, summary)
+            head = head + [self._get_summary_message()]
+        return self._finish(messages, head + middle + tail, len(dropped))
+
+    async def afit(
+        self, messages: list[dict], afold: AsyncFold | None = None
+    ) -> list[dict]:
+        head, middle, tail, dropped = self._split(messages)
+        if dropped and self.policy == "summarize" and afold is not None:
+            new, previous = self._get_unfolded(dropped)
+            summary = await afold(new, previous) if new else self.summary
+            self._set_summary(dropped, summary)
+            head = head + [self._get_summary_message()]
+        return self._finish(messages, head + middle + tail, len(dropped))
+
+    def _split(
+        self, messages: list[dict]
+    ) -> tuple[list[dict], list[dict], list[dict], list[dict]]:
+        # Returns the kept head, the kept middle, the tail and the dropped turns
+        if self.max_tokens is None or self._get_need(messages) <= self.max_tokens:
+            return messages, [], [], []
+        n_system = 0
+        while n_system < len(messages) and messages[n_system]["role"] == "system":
+            n_system += 1
+        head = messages[: n_system + 1]
+        middle = messages[n_system + 1 : -1]
+        tail = messages[-1:] if len(messages) > n_system + 1 else []
+        budget = self.max_tokens - self._get_need(head + tail)
+        if self.policy == "summarize":
+            # Room for the summary, which is at most one completion long
+            budget -= self.completion_tokens + TOKENS_PER_MESSAGE
+        # Newest turns first, until the budget is spent
+        n_kept = 0
+        for message in reversed(middle):
+            budget -= self.count([message])
+            if budget < 0:
+                break
+            n_kept += 1
+        n_dropped = len(middle) - n_kept
+        return head, middle[n_dropped:], tail, middle[:n_dropped]
+
+    def _get_unfolded(self, dropped: list[dict]) -> tuple[list[dict], str]:
+        # The turns are dropped oldest first, so the folded ones are a prefix,
+        # unless the history changed (e.g. a new day started)
+        contents = [str(message.get("content") or "") for message in dropped]
+        if contents[: len(self._folded)] == self._folded and self._folded:
+            return dropped[len(self._folded) :], self.summary
+        return dropped, ""
+
+    def _set_summary(self, dropped: list[dict], summary: str) -> None:
+        self._folded = [str(message.get("content") or "") for message in dropped]
+        self.summary = summary
+
+    def _get_summary_message(self) -> dict:
+        return {"content": FOLDED_PREFIX + self.summary, "role": "user"}
+
+    def _get_need(self, messages: list[dict]) -> int:
+        return self.count(messages) + self.completion_tokens
+
+    def _finish(
+        self, messages: list[dict], fitted: list[dict], n_dropped: int
+    ) -> list[dict]:
+        need = self._get_need(fitted)
+        if self.max_tokens is not None and need > self.max_tokens:
+            logger.warning(
+                f"[{self.model}] request of {need} tokens does not fit in "
+                + f"{self.max_tokens} even without its older turns"
+            )
+        if n_dropped:
+            logger.debug(
+                f"[{self.model}] {self.policy}: {n_dropped} of {len(messages)} "
+                + f"messages left out ({self._get_need(messages)} -> {need} tokens)"
+            )
+        if n_dropped:
+            self._record(n_dropped)
+        return fitted
+
+    def _record(self, n_dropped: int) -> None:
+        with self._lock:
+            trimmed = self._trimmed.setdefault(self.model, [0, 0])
+            trimmed[0] += 1
+            trimmed[1] += n_dropped
+
+    @classmethod
+    def from_env(
+        cls, model: str, is_local: bool, num_ctx: int | None = None
+    ) -> "ContextWindow":
+        """
+        LLM_CONTEXT_TOKENS is the budget of every request, by default the
+        context of the local models (MAX_CONTEXT_LEN) and none for OpenAI's,
+        and at most the num_ctx of the sweep. LLM_CONTEXT_POLICY sets what
+        happens to the older turns of a longer conversation (truncate or
+        summarize).
+        """
+        max_tokens = cls.get_budget() if is_local else cls._get_env_budget()
+        if num_ctx is not None:
+            max_tokens = min(max_tokens, num_ctx) if max_tokens else num_ctx
+        return cls(
+            model=model,
+            max_tokens=max_tokens,
+            policy=CustomOS.getenv("LLM_CONTEXT_POLICY", "truncate").lower(),
+        )
+
+    @staticmethod
+    def _get_env_budget() -> int | None:
+        max_tokens = CustomOS.getenv("LLM_CONTEXT_TOKENS", "")
+        return int(max_tokens) if max_tokens else None
+
+    @classmethod
+    def get_budget(cls) -> int:
+        # Budget of the requests to the local models
+        return cls._get_env_budget() or MAX_CONTEXT_LEN
+
+    @classmethod
+    def get_num_ctx(cls, need: int | None = None) -> int:
+        """
+        The num_ctx of a sweep whose largest request is estimated at ``need``
+        tokens: rounded up to ``NUM_CTX_STEPS`` with some margin, and never
+        over the budget. Without an estimate, the budget itself.
+        """
+        budget = cls.get_budget()
+        if need is None:
+            return budget
+        need = int(need * NUM_CTX_MARGIN)
+        return min(next((step for step in NUM_CTX_STEPS if step >= need), need), budget)
+
+    @classmethod
+    def log_metrics(cls) -> None:
+        with cls._lock:
+            trimmed = dict(cls._trimmed)
+        for model, (requests, messages) in trimmed.items():
+            logger.info(
+                f"Context [{model}] trimmed requests: {requests} | "
+                + f"messages left out: {messages}"
+            )
@@ -0,0 +1,248 @@
+import hashlib
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import ClassVar
+
+import httpx
+import ollama
+from itakello_logging import ItakelloLogging
+
+from ...utility.custom_os import CustomOS
+
+logger = ItakelloLogging().get_logger(__name__)
+
+ROUTING_POLICIES = ("least_outstanding", "affinity")
+# Timeout of the health checks, a server slower than this to list its models
+# is too busy to take more requests
+CHECK_TIMEOUT_SECONDS = 5.0
+
+
+def get_ollama_hosts() -> list[str]:
+    # OLLAMA_HOSTS lists the servers of the pool, OLLAMA_HOST the single one
+    # the Ollama client uses by default (e.g. the fake server)
+    hosts = os.getenv("OLLAMA_HOSTS", "") or os.getenv(
+        "OLLAMA_HOST", "http://localhost:11434"
+    )
+    urls = []
+    for host in hosts.split(","):
+        host = host.strip().rstrip("/")
+        if host:
+            urls.append(host if "://" in host else f"http://{host}")
+    return list(dict.fromkeys(urls))
+
+
+def _with_tag(model: str) -> str:
+    # Ollama lists the models without a tag as :latest
+    return model if ":" in model else f"{model}:latest"
+
+
+@dataclass
+class Endpoint:
+    url: str
+
+    client: ollama.Client = field(init=False)
+    healthy: bool = field(init=False, default=True)
+    # None until the first health check lists them
+    models: set[str] | None = field(init=False, default=None)
+    outstanding: int = field(init=False, default=0)
+    requests: int = field(init=False, default=0)
+    errors: int = field(init=False, default=0)
+    removals: int = field(init=False, default=0)
+    _failures: int = field(init=False, default=0)
+
+    def __post_init__(self) -> None:
+        self.client = ollama.Client(host=self.url)
+
+    def __str__(self) -> str:
+        return (
+            f"Endpoint [{self.url}] {'healthy' if self.healthy else 'removed'} | "
+            + f"requests: {self.requests} | errors: {self.errors} | removals: {self.removals}"
+        )
+
+    def has_model(self, model: str) -> bool:
+        return self.models is None or _with_tag(model) in self.models
+
+
+@dataclass
+class EndpointPool:
+    """
+    The Ollama servers the local models are served by.
+
+    Every request goes to one of the healthy servers that have its model:
+    the one with the fewest requests in flight (``least_outstanding``), or
+    always the same one for a model (``affinity``), so that each server only
+    loads some of the models. The choice only depends on the model and the
+    servers, so the workers of a distributed sweep agree on it.
+
+    A server is removed after ``max_failures`` failed requests in a row or a
+    failed health check, and admitted again by the first health check it
+    passes. The checks run every ``check_seconds`` and also list the models
+    of every server. Pulls and derived models are made on every server.
+    """
+
+    endpoints: list[Endpoint]
+    routing: str = "least_outstanding"
+    check_seconds: float = 30.0
+    max_failures: int = 3
+
+    _lock: threading.Lock = field(init=False, default_factory=threading.Lock)
+    _checking: threading.Thread | None = field(init=False, default=None)
+
+    _instance: ClassVar["EndpointPool | None"] = None
+    _instance_lock: ClassVar[threading.Lock] = threading.Lock()
+
+    def __post_init__(self) -> None:
+        assert self.endpoints, logger.error("No Ollama server in OLLAMA_HOSTS")
+        assert self.routing in ROUTING_POLICIES, logger.error(
+            f"OLLAMA_ROUTING must be one of {ROUTING_POLICIES} [{self.routing}]"
+        )
+
+    @property
+    def url(self) -> str:
+        # The requests are addressed to the first server, then routed
+        return self.endpoints[0].url
+
+    @property
+    def is_balanced(self) -> bool:
+        return len(self.endpoints) > 1
+
+    def get_endpoints(self, model: str | None = None) -> list[Endpoint]:
+        """
+        The servers the requests of the model are routed to, or every healthy
+        server without a model (e.g. to pull one).
+        """
+        with self._lock:
+            return self._get_candidates(model)
+
+    def acquire(self, model: str | None) -> Endpoint:
+        with self._lock:
+            candidates = self._get_candidates(model)
+            if self.routing == "affinity" or model is None:
+                endpoint = candidates[0]
+            else:
+                endpoint = min(candidates, key=lambda endpoint: endpoint.outstanding)
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+        return endpoint
+
+    def release(self, endpoint: Endpoint, success: bool) -> None:
+        with self._lock:
+            endpoint.outstanding -= 1
+            if success:
+                endpoint._failures = 0
+                return
+            endpoint.errors += 1
+            endpoint._failures += 1
+            if endpoint._failures < self.max_failures:
+                return
+        self.remove(endpoint, f"{endpoint._failures} failed requests in a row")
+
+    def remove(self, endpoint: Endpoint, reason: str) -> None:
+        with self._lock:
+            if not endpoint.healthy:
+                return
+            endpoint.healthy = False
+            endpoint.removals += 1
+        logger.warning(f"Ollama server [{endpoint.url}] removed from the pool: {reason}")
+
+    def add_model(self, url: str, model: str) -> None:
+        with self._lock:
+            for endpoint in self.endpoints:
+                if endpoint.url == url and endpoint.models is not None:
+                    endpoint.models.add(_with_tag(model))
+
+    def check(self) -> None:
+        for endpoint in self.endpoints:
+            try:
+                response = httpx.get(
+                    f"{endpoint.url}/api/tags", timeout=CHECK_TIMEOUT_SECONDS
+                )
+                response.raise_for_status()
+                models = {model["model"] for model in response.json()["models"] or []}
+            except (httpx.HTTPError, ValueError, KeyError) as e:
+                self.remove(endpoint, f"health check failed: {e}")
+                continue
+            with self._lock:
+                endpoint.models = models
+                readmitted = not endpoint.healthy
+                endpoint.healthy = True
+                endpoint._failures = 0
+            if readmitted:
+                logger.confirmation(f"Ollama server [{endpoint.url}] back in the pool")
+
+    def _get_candidates(self, model: str | None) -> list[Endpoint]:
+        # When every server was removed they are all tried, the retries of
+        # the requests then wait for one to come back
+        candidates = [endpoint for endpoint in self.endpoints if endpoint.healthy]
+        candidates = candidates or list(self.endpoints)
+        if model is None:
+            return candidates
+        candidates = [
+            endpoint for endpoint in candidates if endpoint.has_model(model)
+        ] or candidates
+        if self.routing == "affinity":
+            # Rendezvous hashing: a removed server only moves its own models
+            candidates.sort(key=lambda endpoint: self._get_weight(endpoint, model))
+            return candidates[:1]
+        return candidates
+
+    @staticmethod
+    def _get_weight(endpoint: Endpoint, model: str) -> str:
+        return hashlib.sha256(f"{_with_tag(model)}@{endpoint.url}".encode()).hexdigest()
+
+    def _start_checks(self) -> None:
+        self._checking = threading.Thread(
+            target=self._check_loop, name="ollama-health-checks", daemon=True
+        )
+        self._checking.start()
+
+    def _check_loop(self) -> None:
+        while True:
+            self.check()
+            time.sleep(self.check_seconds)
+
+    @classmethod
+    def get_instance(cls) -> "EndpointPool":
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls._from_env()
+                if cls._instance.is_balanced:
+                    logger.info(
+                        f"Balancing the Ollama requests over {len(cls._instance.endpoints)} "
+                        + f"servers ({cls._instance.routing})"
+                    )
+                    cls._instance._start_checks()
+            return cls._instance
+
+    @classmethod
+    def for_url(cls, base_url: str) -> "EndpointPool | None":
+        # The pool the requests to base_url are balanced over, if any
+        pool = cls.get_instance()
+        if pool.is_balanced and base_url.startswith(pool.url):
+            return pool
+        return None
+
+    @classmethod
+    def _from_env(cls) -> "EndpointPool":
+        """
+        OLLAMA_HOSTS lists the servers of the pool, separated by commas (by
+        default the single OLLAMA_HOST). OLLAMA_ROUTING sets how the requests
+        are spread (least_outstanding or affinity), OLLAMA_HEALTH_SECONDS how
+        often the servers are checked (30) and OLLAMA_MAX_FAILURES after how
+        many failed requests in a row a server is removed (3).
+        """
+        return cls(
+            endpoints=[Endpoint(url=url) for url in get_ollama_hosts()],
+            routing=CustomOS.getenv("OLLAMA_ROUTING", "least_outstanding").lower(),
+            check_seconds=float(CustomOS.getenv("OLLAMA_HEALTH_SECONDS", "30")),
+            max_failures=int(CustomOS.getenv("OLLAMA_MAX_FAILURES", "3")),
+        )
+
+    @classmethod
+    def log_metrics(cls) -> None:
+        if cls._instance is None or not cls._instance.is_balanced:
+            return
+        for endpoint in cls._instance.endpoints:
+            logger.info(str(endpoint))
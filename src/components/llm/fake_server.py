@@ -0,0 +1,499 @@
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import ClassVar
+
+from itakello_logging import ItakelloLogging
+
+from ...utility.custom_os import CustomOS
+from .rate_limiter import estimate_prompt_tokens, estimate_tokens
+
+logger = ItakelloLogging().get_logger(__name__)
+
+LATENCY_DISTRIBUTIONS = ("fixed", "uniform", "exponential", "lognormal")
+# Statuses of the injected errors, the last two with a Retry-After header
+ERROR_STATUSES = (500, 503, 429)
+RETRY_AFTER_SECONDS = 1
+# Size reported for every fake model, as if it were a quantized 7B one
+MODEL_SIZE = 4_000_000_000
+# The reply to the auto speaker selection prompt of autogen is one of the agents
+SELECT_SPEAKER_PATTERN = re.compile(r"select the next role from \[([^\]]*)\]")
+CANNED_SENTENCES = (
+    "I think we should keep to the rules we agreed on.",
+    "That is not how I remember what happened yesterday.",
+    "Let us see what the others have to say about it.",
+    "I will do what is asked, but I do not like it.",
+    "Nobody told me anything about that.",
+    "We can talk about it again tomorrow.",
+    "I am tired of waiting for an answer.",
+    "Fine, but this is the last time.",
+)
+
+
+@dataclass
+class FakeLLM:
+    """
+    Deterministic stand-in of a model, shared by the in-process fake backend
+    and the fake server.
+
+    The reply only depends on the model and the messages: it names the model
+    and counts the messages, then adds canned sentences up to
+    ``reply_tokens``. The latency is the time to the first token, drawn from
+    ``latency`` (seconds: ``fixed:MEAN``, ``uniform:LOW:HIGH``,
+    ``exponential:MEAN`` or ``lognormal:MEAN:SIGMA``), plus the reply
+    generated at ``tokens_per_second``. A share ``error_rate`` of the
+    requests fails. The draws come from a generator seeded with ``seed``.
+    """
+
+    latency: str = "fixed:0"
+    tokens_per_second: float | None = None
+    reply_tokens: int = 0
+    error_rate: float = 0.0
+    seed: int = 0
+
+    _distribution: str = field(init=False)
+    _parameters: list[float] = field(init=False)
+    _random: random.Random = field(init=False)
+    _lock: threading.Lock = field(init=False, default_factory=threading.Lock)
+
+    def __post_init__(self) -> None:
+        distribution, *parameters = self.latency.split(":")
+        self._distribution = distribution.lower()
+        self._parameters = [float(parameter) for parameter in parameters]
+        expected = {"fixed": 1, "uniform": 2, "exponential": 1, "lognormal": 2}
+        assert self._distribution in LATENCY_DISTRIBUTIONS, logger.error(
+            f"Invalid latency distribution [{distribution}], expected one of {LATENCY_DISTRIBUTIONS}"
+        )
+        assert len(self._parameters) == expected[self._distribution], logger.error(
+            f"Invalid latency [{self.latency}], e.g. fixed:0.5, uniform:0.2:1, "
+            + "exponential:0.5 or lognormal:0.5:0.3"
+        )
+        self._random = random.Random(self.seed)
+
+    def get_reply(self, model: str, messages: list[dict]) -> str:
+        last = str(messages[-1].get("content") or "") if messages else ""
+        digest = hashlib.sha256(
+            json.dumps([model, messages], sort_keys=True).encode()
+        ).digest()
+        match = SELECT_SPEAKER_PATTERN.search(last)
+        if match:
+            names = [name.strip() for name in match.group(1).split(",")]
+            return names[digest[0] % len(names)]
+        system = next(
+            (message["content"] for message in messages if message["role"] == "system"),
+            "",
+        )
+        reply = f"Fake reply of {model} after {len(messages)} messages ({system[:40]!r})"
+        # Canned sentences picked by the digest of the request
+        index = 0
+        while estimate_tokens(reply) < self.reply_tokens:
+            sentence = CANNED_SENTENCES[digest[index % len(digest)] % len(CANNED_SENTENCES)]
+            reply += " " + sentence
+            index += 1
+        return reply
+
+    def get_delay(self, completion_tokens: int) -> float:
+        with self._lock:
+            first_token = self._sample_latency()
+        if not self.tokens_per_second:
+            return first_token
+        return first_token + completion_tokens / self.tokens_per_second
+
+    def get_error(self) -> int | None:
+        if not self.error_rate:
+            return None
+        with self._lock:
+            if self._random.random() >= self.error_rate:
+                return None
+            return self._random.choice(ERROR_STATUSES)
+
+    def _sample_latency(self) -> float:
+        if self._distribution == "fixed":
+            return self._parameters[0]
+        if self._distribution == "uniform":
+            return self._random.uniform(*self._parameters)
+        if self._distribution == "exponential":
+            mean = self._parameters[0]
+            return self._random.expovariate(1 / mean) if mean else 0.0
+        mean, sigma = self._parameters
+        # Mean of the distribution, not of its logarithm
+        return self._random.lognormvariate(math.log(mean) - sigma**2 / 2, sigma)
+
+    def chat_completion(self, body: dict) -> dict:
+        messages = body["messages"]
+        content = self.get_reply(body["model"], messages)
+        prompt_tokens = estimate_prompt_tokens(messages)
+        completion_tokens = estimate_tokens(content)
+        return {
+            "id": f"chatcmpl-{time.time_ns()}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    def native_chat(self, body: dict) -> dict:
+        completion = self.chat_completion(body)
+        return {
+            "model": body["model"],
+            "created_at": _now(),
+            "message": completion["choices"][0]["message"],
+            "done": True,
+            "done_reason": "stop",
+            "prompt_eval_count": completion["usage"]["prompt_tokens"],
+            "eval_count": completion["usage"]["completion_tokens"],
+        }
+
+    @classmethod
+    def from_env(cls) -> "FakeLLM":
+        """
+        FAKE_LLM_LATENCY (fixed:0), FAKE_LLM_TOKENS_PER_SECOND (unlimited),
+        FAKE_LLM_REPLY_TOKENS (0, only the header), FAKE_LLM_ERROR_RATE (0)
+        and FAKE_LLM_SEED (0) set the behaviour of the fake models.
+        """
+        tokens_per_second = CustomOS.getenv("FAKE_LLM_TOKENS_PER_SECOND", "")
+        return cls(
+            latency=CustomOS.getenv("FAKE_LLM_LATENCY", "fixed:0"),
+            tokens_per_second=float(tokens_per_second) if tokens_per_second else None,
+            reply_tokens=int(CustomOS.getenv("FAKE_LLM_REPLY_TOKENS", "0")),
+            error_rate=float(CustomOS.getenv("FAKE_LLM_ERROR_RATE", "0")),
+            seed=int(CustomOS.getenv("FAKE_LLM_SEED", "0")),
+        )
+
+
+@dataclass
+class FakeServer:
+    """
+    HTTP server that answers like Ollama, both through its native API
+    (``/api/*``) and its OpenAI compatible one (``/v1/chat/completions``),
+    with the replies, latency and errors of a ``FakeLLM``.
+
+    Pulls always succeed, and the pulled, created, loaded and deleted models
+    are tracked, so the whole sweep path (registry, puller, scheduler) can
+    run against it with ``OLLAMA_HOST`` pointing at it.
+    """
+
+    llm: FakeLLM
+    host: str = "127.0.0.1"
+    port: int = 11435
+    models: list[str] = field(default_factory=lambda: ["llama3:latest"])
+
+    requests: int = field(init=False, default=0)
+    errors: int = field(init=False, default=0)
+    # Model -> expiry of its keep-alive, None when it never expires
+    _loaded: dict[str, datetime | None] = field(init=False, default_factory=dict)
+    _server: ThreadingHTTPServer = field(init=False)
+    _lock: threading.Lock = field(init=False, default_factory=threading.Lock)
+
+    DEFAULT_KEEP_ALIVE: ClassVar[timedelta] = timedelta(minutes=5)
+
+    def __post_init__(self) -> None:
+        self.models = [_with_tag(model) for model in self.models]
+        handler = type("FakeRequestHandler", (FakeRequestHandler,), {"fake_server": self})
+        self._server = ThreadingHTTPServer((self.host, self.port), handler)
+        self._server.daemon_threads = True
+
+    def __str__(self) -> str:
+        return (
+            f"Fake server [http://{self.host}:{self.port}] requests: {self.requests} | "
+            + f"injected errors: {self.errors}"
+        )
+
+    def serve_forever(self) -> None:
+        logger.confirmation(f"Fake LLM server listening on http://{self.host}:{self.port}")
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            logger.info(str(self))
+
+    def start(self) -> threading.Thread:
+        # In a background thread, e.g. for benchmarks in the same process
+        thread = threading.Thread(
+            target=self._server.serve_forever, name="fake-server", daemon=True
+        )
+        thread.start()
+        return thread
+
+    def shutdown(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def handle(self, method: str, path: str, body: dict) -> tuple[int, object]:
+        with self._lock:
+            self.requests += 1
+        if path.endswith("/chat/completions") or path == "/api/chat":
+            return self._chat(path, body)
+        routes = {
+            ("GET", "/"): lambda: (200, "Ollama is running"),
+            ("HEAD", "/"): lambda: (200, ""),
+            ("GET", "/api/version"): lambda: (200, {"version": "0.0.0-fake"}),
+            ("GET", "/api/tags"): self._tags,
+            ("GET", "/v1/models"): self._openai_models,
+            ("GET", "/api/ps"): self._ps,
+            ("POST", "/api/show"): lambda: self._show(body),
+            ("POST", "/api/pull"): lambda: self._pull(body),
+            ("POST", "/api/create"): lambda: self._create(body),
+            ("DELETE", "/api/delete"): lambda: self._delete(body),
+            ("POST", "/api/generate"): lambda: self._generate(body),
+        }
+        if (method, path) in routes:
+            return routes[(method, path)]()
+        if path.startswith("/api/blobs/"):
+            # Every blob is accepted, and already there when checked
+            return (201 if method == "POST" else 200), ""
+        return 404, {"error": f"{method} {path} not found"}
+
+    def _chat(self, path: str, body: dict) -> tuple[int, object]:
+        model = _with_tag(body.get("model", ""))
+        with self._lock:
+            installed = model in self.models
+        if not installed:
+            return 404, {"error": f"model '{body.get('model')}' not found"}
+        status = self.llm.get_error()
+        if status is not None:
+            with self._lock:
+                self.errors += 1
+            return status, {"error": "injected error"}
+        if path == "/api/chat":
+            response = self.llm.native_chat(body)
+            completion_tokens = response["eval_count"]
+        else:
+            response = self.llm.chat_completion(body)
+            completion_tokens = response["usage"]["completion_tokens"]
+        self._load(model, body.get("keep_alive"))
+        time.sleep(self.llm.get_delay(completion_tokens))
+        return 200, response
+
+    def _tags(self) -> tuple[int, object]:
+        with self._lock:
+            models = list(self.models)
+        return 200, {"models": [_describe(model) for model in models]}
+
+    def _openai_models(self) -> tuple[int, object]:
+        with self._lock:
+            models = list(self.models)
+        return 200, {
+            "object": "list",
+            "data": [
+                {"id": model, "object": "model", "created": 0, "owned_by": "fake"}
+                for model in models
+            ],
+        }
+
+    def _ps(self) -> tuple[int, object]:
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            for model, expiry in list(self._loaded.items()):
+                if expiry is not None and expiry <= now:
+                    del self._loaded[model]
+            loaded = dict(self._loaded)
+        return 200, {
+            "models": [
+                {
+                    **_describe(model),
+                    "expires_at": (expiry or now + timedelta(days=365)).isoformat(),
+                    "size_vram": MODEL_SIZE,
+                }
+                for model, expiry in loaded.items()
+            ]
+        }
+
+    def _show(self, body: dict) -> tuple[int, object]:
+        model = _with_tag(body.get("model") or body.get("name", ""))
+        with self._lock:
+            installed = model in self.models
+        if not installed:
+            return 404, {"error": f"model '{model}' not found"}
+        return 200, {
+            "modelfile": f"FROM {model}",
+            "parameters": "",
+            "template": "{{ .Prompt }}",
+            "details": _describe(model)["details"],
+            "modified_at": _now(),
+        }
+
+    def _pull(self, body: dict) -> tuple[int, object]:
+        model = _with_tag(body.get("model") or body.get("name", ""))
+        digest = f"sha256:{hashlib.sha256(model.encode()).hexdigest()}"
+        updates: list[dict] = [{"status": "pulling manifest"}]
+        for step in range(1, 5):
+            updates.append(
+                {
+                    "status": f"pulling {digest[7:19]}",
+                    "digest": digest,
+                    "total": MODEL_SIZE,
+                    "completed": MODEL_SIZE * step // 4,
+                }
+            )
+        updates.append({"status": "success"})
+        with self._lock:
+            if model not in self.models:
+                self.models.append(model)
+        if body.get("stream", True):
+            return 200, updates
+        return 200, updates[-1]
+
+    def _create(self, body: dict) -> tuple[int, object]:
+        model = _with_tag(body.get("model") or body.get("name", ""))
+        source = _with_tag(body.get("from") or model)
+        with self._lock:
+            if source not in self.models:
+                return 404, {"error": f"model '{source}' not found"}
+            if model not in self.models:
+                self.models.append(model)
+        if body.get("stream", True):
+            return 200, [{"status": "success"}]
+        return 200, {"status": "success"}
+
+    def _delete(self, body: dict) -> tuple[int, object]:
+        model = _with_tag(body.get("model") or body.get("name", ""))
+        with self._lock:
+            if model not in self.models:
+                return 404, {"error": f"model '{model}' not found"}
+            self.models.remove(model)
+            self._loaded.pop(model, None)
+        return 200, ""
+
+    def _generate(self, body: dict) -> tuple[int, object]:
+        # Only used to load and unload models, with an empty prompt
+        model = _with_tag(body.get("model", ""))
+        with self._lock:
+            installed = model in self.models
+        if not installed:
+            return 404, {"error": f"model '{body.get('model')}' not found"}
+        self._load(model, body.get("keep_alive"))
+        response = {
+            "model": model,
+            "created_at": _now(),
+            "response": "",
+            "done": True,
+            "done_reason": "load",
+        }
+        return 200, response
+
+    def _load(self, model: str, keep_alive: object) -> None:
+        duration = _parse_keep_alive(keep_alive)
+        with self._lock:
+            if duration is not None and duration <= timedelta(0):
+                self._loaded.pop(model, None)
+            elif duration is None and keep_alive is not None:
+                # Negative keep-alive: loaded until told otherwise
+                self._loaded[model] = None
+            else:
+                self._loaded[model] = datetime.now(timezone.utc) + (
+                    duration or self.DEFAULT_KEEP_ALIVE
+                )
+
+
+class FakeRequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive connections, like the pooled clients of the backends
+    protocol_version = "HTTP/1.1"
+    fake_server: FakeServer
+
+    def do_GET(self) -> None:
+        self._respond("GET")
+
+    def do_HEAD(self) -> None:
+        self._respond("HEAD")
+
+    def do_POST(self) -> None:
+        self._respond("POST")
+
+    def do_DELETE(self) -> None:
+        self._respond("DELETE")
+
+    def _respond(self, method: str) -> None:
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        path = self.path.split("?")[0].rstrip("/") or "/"
+        try:
+            # Blobs are uploaded as is
+            body = json.loads(raw) if raw and not path.startswith("/api/blobs/") else {}
+        except json.JSONDecodeError:
+            self._send(400, {"error": "invalid JSON body"})
+            return
+        status, payload = self.fake_server.handle(method, path, body)
+        self._send(status, payload)
+
+    def _send(self, status: int, payload: object) -> None:
+        if isinstance(payload, list):
+            # Streamed answers of Ollama are one JSON object per line
+            content = "".join(json.dumps(part) + "\n" for part in payload).encode()
+            content_type = "application/x-ndjson"
+        elif isinstance(payload, str):
+            content = payload.encode()
+            content_type = "text/plain"
+        else:
+            content = json.dumps(payload).encode()
+            content_type = "application/json"
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        if status in (429, 503):
+            self.send_header("Retry-After", str(RETRY_AFTER_SECONDS))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(content)
+
+    def log_message(self, format: str, *args) -> None:
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+def _with_tag(model: str) -> str:
+    return model if ":" in model or not model else f"{model}:latest"
+
+
+def _describe(model: str) -> dict:
+    return {
+        "name": model,
+        "model": model,
+        "modified_at": _now(),
+        "size": MODEL_SIZE,
+        "digest": hashlib.sha256(model.encode()).hexdigest(),
+        "details": {
+            "format": "gguf",
+            "family": "fake",
+            "families": ["fake"],
+            "parameter_size": "7B",
+            "quantization_level": "Q4_0",
+        },
+    }
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _parse_keep_alive(keep_alive: object) -> timedelta | None:
+    # Seconds or a duration such as "30m"; None for the default or negative
+    if keep_alive is None:
+        return None
+    if isinstance(keep_alive, (int, float)):
+        return None if keep_alive < 0 else timedelta(seconds=keep_alive)
+    match = re.fullmatch(r"(-?\d+(?:\.\d+)?)(ms|s|m|h)?", str(keep_alive))
+    if match is None:
+        return None
+    value = float(match.group(1))
+    if value < 0:
+        return None
+    unit = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[match.group(2) or "s"]
+    return timedelta(seconds=value * unit)
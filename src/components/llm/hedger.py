@@ -0,0 +1,176 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, ClassVar, TypeVar
+
+from itakello_logging import ItakelloLogging
+from openai import AsyncOpenAI
+
+from ...utility.custom_os import CustomOS
+from .batch_client import BatchClient
+from .rate_limiter import RateLimiter, estimate_prompt_tokens
+
+logger = ItakelloLogging().get_logger(__name__)
+
+T = TypeVar("T")
+
+# Latencies kept to compute the hedging delay
+LATENCY_WINDOW = 200
+# The delay is only trusted after this many calls
+MIN_SAMPLES = 20
+
+
+@dataclass
+class Hedger:
+    """
+    Deadlines and hedged requests of the LLM calls made to one backend,
+    identified by its base_url.
+
+    A call that takes longer than ``deadline`` seconds is abandoned with a
+    ``TimeoutError``, which the ``RetryPolicy`` retries. With ``hedge``, the
+    async engine sends a duplicate of a call still running after the
+    ``quantile`` of the recent latencies, to another slot of the server, and
+    keeps the first answer: the other one is cancelled and its prompt is
+    counted as wasted. No duplicate is sent while calls are queued by the
+    ``RateLimiter``, since the backend is already saturated.
+    """
+
+    name: str
+    limiter: RateLimiter
+    deadline: float | None = None
+    hedge: bool = False
+    quantile: float = 0.95
+
+    calls: int = field(init=False, default=0)
+    hedged: int = field(init=False, default=0)
+    hedge_wins: int = field(init=False, default=0)
+    wasted_tokens: int = field(init=False, default=0)
+    timeouts: int = field(init=False, default=0)
+    _latencies: deque = field(
+        init=False, default_factory=lambda: deque(maxlen=LATENCY_WINDOW)
+    )
+    _lock: threading.Lock = field(init=False, default_factory=threading.Lock)
+
+    _registry: ClassVar[dict[str, "Hedger"]] = {}
+    _registry_lock: ClassVar[threading.Lock] = threading.Lock()
+
+    def __str__(self) -> str:
+        hit_rate = 100 * self.hedge_wins / self.hedged if self.hedged else 0.0
+        return (
+            f"Hedging [{self.name}] calls: {self.calls} | hedged: {self.hedged} | "
+            + f"won by the hedge: {self.hedge_wins} ({hit_rate:.1f}%) | "
+            + f"wasted prompt tokens: {self.wasted_tokens:,} | deadline exceeded: {self.timeouts}"
+        )
+
+    def get_hedge_delay(self) -> float | None:
+        with self._lock:
+            if not self.hedge or len(self._latencies) < MIN_SAMPLES:
+                return None
+            latencies = sorted(self._latencies)
+        return latencies[int(self.quantile * (len(latencies) - 1))]
+
+    async def arun(
+        self,
+        function: Callable[[], Awaitable[T]],
+        messages: list[dict],
+        client: AsyncOpenAI | BatchClient,
+    ) -> T:
+        # Batches are expected to take hours, they are never hedged
+        if isinstance(client, BatchClient):
+            return await function()
+        with self._lock:
+            self.calls += 1
+        primary = asyncio.create_task(self._run(function))
+        delay = self.get_hedge_delay()
+        if delay is None:
+            return await primary
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+        except asyncio.CancelledError:
+            primary.cancel()
+            raise
+        if done or not self.limiter.has_capacity():
+            return await primary
+        hedge = asyncio.create_task(self._run(function))
+        with self._lock:
+            self.hedged += 1
+        logger.debug(f"[{self.name}] call still running after {delay:.2f}s, hedged")
+        return await self._race(primary, hedge, estimate_prompt_tokens(messages))
+
+    async def _run(self, function: Callable[[], Awaitable[T]]) -> T:
+        start_time = time.monotonic()
+        try:
+            result = await asyncio.wait_for(function(), self.deadline)
+        except asyncio.TimeoutError:
+            with self._lock:
+                self.timeouts += 1
+            raise TimeoutError(
+                f"LLM call to [{self.name}] exceeded its deadline of {self.deadline}s"
+            ) from None
+        with self._lock:
+            self._latencies.append(time.monotonic() - start_time)
+        return result
+
+    async def _race(
+        self, primary: asyncio.Task, hedge: asyncio.Task, prompt_tokens: int
+    ) -> T:
+        pending = {primary, hedge}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                winner = next(
+                    (task for task in done if task.exception() is None), None
+                )
+                if winner is not None:
+                    break
+            else:
+                # Both failed, the primary's error is reported
+                return primary.result()
+        finally:
+            for task in pending:
+                task.cancel()
+        with self._lock:
+            if winner is hedge:
+                self.hedge_wins += 1
+            # The other call was sent, and was cancelled or failed
+            self.wasted_tokens += prompt_tokens
+        return winner.result()
+
+    @classmethod
+    def for_config(cls, config: dict) -> "Hedger":
+        base_url = config["base_url"]
+        with cls._registry_lock:
+            if base_url not in cls._registry:
+                cls._registry[base_url] = cls._from_env(
+                    base_url, RateLimiter.for_config(config)
+                )
+            return cls._registry[base_url]
+
+    @classmethod
+    def _from_env(cls, base_url: str, limiter: RateLimiter) -> "Hedger":
+        """
+        LLM_CALL_DEADLINE sets the deadline of every LLM call in seconds (by
+        default none, only the LLM_TIMEOUT of the connections). LLM_HEDGE=y
+        enables the hedged requests of the async engine, sent after the
+        LLM_HEDGE_QUANTILE (0.95) of the latencies.
+        """
+        deadline = CustomOS.getenv("LLM_CALL_DEADLINE", "")
+        return cls(
+            name=base_url,
+            limiter=limiter,
+            deadline=float(deadline) if deadline else None,
+            hedge=CustomOS.getenv("LLM_HEDGE", "n") == "y",
+            quantile=float(CustomOS.getenv("LLM_HEDGE_QUANTILE", "0.95")),
+        )
+
+    @classmethod
+    def log_metrics(cls) -> None:
+        with cls._registry_lock:
+            hedgers = [hedger for hedger in cls._registry.values() if hedger.calls]
+        for hedger in hedgers:
+            if hedger.hedge or hedger.timeouts:
+                logger.info(str(hedger))
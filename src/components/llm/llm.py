@@ -1,61 +1,179 @@
-import asyncio
 import os
 import tempfile
-from collections.abc import AsyncIterator
+import threading
 from dataclasses import dataclass, field
-from typing import Mapping
+from typing import ClassVar
 
-import ollama
 from itakello_logging import ItakelloLogging
-from tqdm import tqdm
 
 from ...interfaces.mongo_model import MongoModel
 from ...utility.consts import MAX_CONTEXT_LEN
+from .backend import Backend
+from .context_window import ContextWindow
+from .endpoint_pool import EndpointPool, get_ollama_hosts
+from .hedger import Hedger
+from .model_puller import ModelPuller
+from .model_registry import ModelRegistry
 
 logger = ItakelloLogging().get_logger(__name__)
 
+# "request": sampling parameters are sent with every request to the base model
+# "model": a derived model is created for every set of sampling parameters
+SAMPLING_MODES = ("request", "model")
+
 
 @dataclass
 class LLM(MongoModel):
+    """
+    Description of an LLM and of its sampling parameters.
+
+    Creating one (e.g. from a document) never contacts the inference server:
+    ``ensure_available`` pulls the model and creates its custom Modelfile
+    model, and it runs only right before the LLM generates.
+
+    With Ollama, the sampling parameters and the context length are sent with
+    every request by default, through the native API (the OpenAI compatible
+    one ignores ``top_k`` and ``num_ctx``), so LLMs that only differ in them
+    share the same loaded model. ``OLLAMA_SAMPLING=model`` falls back to one
+    derived model per set of parameters, for servers that ignore the request
+    options.
+    """
+
     model: str
     temperature: float = 0.7
     top_k: int = 40
     top_p: float = 0.9
-    name: str = field(init=False)
     config: dict = field(init=False)
+    sampling: str = field(init=False)
+    backend: str = field(init=False)
+    available: bool = field(init=False, default=False)
+    # Sized for the sweep the LLM performs (see ContextWindow.get_num_ctx)
+    num_ctx: int | None = field(init=False, default=None)
+
+    # Two conversations must not pull or create the same model at once
+    _availability_lock: ClassVar[threading.Lock] = threading.Lock()
 
     def __post_init__(self) -> None:
         self.model = self.model.lower()
+        self.sampling = os.getenv("OLLAMA_SAMPLING", "request").lower()
+        assert self.sampling in SAMPLING_MODES, logger.error(
+            f"OLLAMA_SAMPLING must be one of {SAMPLING_MODES} [{self.sampling}]"
+        )
+        # Ollama models without a tag use the latest one
+        if not self.is_openai and ":" not in self.model:
+            self.model = f"{self.model}:latest"
+        # How the requests reach the server, see Backend
+        if self.is_openai:
+            self.backend = os.getenv("OPENAI_BACKEND", "openai").lower()
+        else:
+            # Only the native API honours the options sent with the requests
+            default_backend = "ollama" if self.sampling == "request" else "openai"
+            self.backend = os.getenv("OLLAMA_BACKEND", default_backend).lower()
+        self._set_config()
+        logger.debug(
+            f"Created an {'OpenAI' if self.is_openai else 'Ollama'} LLM instance: {self.model}"
+        )
 
+    def _set_config(self) -> None:
         # If this is an OpenAI GPT model, configure for OpenAI API instead of Ollama
-        if self.model.startswith("gpt-"):
-            # Configure for OpenAI API (e.g., gpt-3.5-turbo) and set instance name
+        if self.is_openai:
+            # Configure for OpenAI API (e.g., gpt-3.5-turbo)
             self.config = {
                 "model": self.model,
                 "api_key": os.getenv("OPENAI_API_KEY", ""),
                 "base_url": os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1"),
                 "cache_seed": None,
             }
-            # Use the model identifier as the name for token-summary lookup and selection
-            self.name = self.model
-            logger.debug(f"Created an OpenAI LLM instance: {self.model}")
+            self.available = True
             return
 
         # Otherwise, treat as an Ollama model
-        if ":" not in self.model:
-            self.model = f"{self.model}:latest"
-
-        self.create_custom_model()
         self.config = {
-            "model": self.model,
-            "base_url": "http://localhost:11434/v1",
+            "model": self.model if self.sampling == "request" else self._create_name(),
+            "base_url": f"{self._get_ollama_host()}/v1",
             "api_key": "ollama",
             "cache_seed": None,
             # Price per 1k tokens: [prompt_price_per_1k, completion_price_per_1k]
             # Local models are free by default
             "price": [0.0, 0.0],
+            **self.request_params,
         }
-        logger.debug(f"Created a new Ollama LLM instance: {self.model}")
+        # The model for the new parameters may not exist yet
+        self.available = not self.is_local
+
+    def set_parameters(self, temperature: float, top_k: int, top_p: float) -> None:
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self._set_config()
+
+    def set_num_ctx(self, num_ctx: int | None) -> None:
+        if num_ctx == self.num_ctx:
+            return
+        self.num_ctx = num_ctx
+        # The model is the same, only the options of its requests change
+        self.config.update(self.request_params)
+
+    @property
+    def name(self) -> str:
+        # OpenAI models are named after the model, for token-summary lookup and selection
+        if self.is_openai:
+            return self.model
+        return self._create_name()
+
+    @property
+    def is_openai(self) -> bool:
+        return self.model.startswith("gpt-")
+
+    @property
+    def is_local(self) -> bool:
+        # Served by Ollama, which has to pull and load the model
+        return not self.is_openai and self.backend != "fake"
+
+    @property
+    def client_config(self) -> dict:
+        # Config of the clients, with the pooled HTTP client shared by the process
+        backend = Backend.for_config(self.backend, self.config["base_url"])
+        # Retried by the RetryPolicy of the backend, not by the OpenAI client
+        client_config = {
+            **self.config,
+            "http_client": backend.http_client,
+            "max_retries": 0,
+        }
+        # The synchronous calls cannot be hedged, they only get the deadline
+        deadline = Hedger.for_config(self.config).deadline
+        if deadline is not None:
+            client_config["timeout"] = deadline
+        return client_config
+
+    @property
+    def resolved_model(self) -> str:
+        # Name of the model the requests are actually sent to
+        return self.config["model"]
+
+    @property
+    def options(self) -> dict:
+        # Native Ollama options of the requests, empty when the model holds them
+        if self.is_openai or self.sampling == "model":
+            return {}
+        return {"top_k": self.top_k, "num_ctx": self.num_ctx or ContextWindow.get_num_ctx()}
+
+    @property
+    def request_params(self) -> dict:
+        # Extra arguments of every chat completion request
+        if self.is_openai or self.sampling == "model":
+            return {}
+        return {
+            "temperature": self.temperature,
+            "top_p": self.top_p,
+            # Not part of the OpenAI API, read by the native Ollama backend
+            "extra_body": {"options": self.options},
+        }
+
+    def create_context_window(self) -> ContextWindow:
+        return ContextWindow.from_env(
+            self.model, is_local=not self.is_openai, num_ctx=self.num_ctx
+        )
 
     @classmethod
     def from_document(cls, doc: dict) -> "LLM":
@@ -77,48 +195,24 @@ class LLM(MongoModel):
             "top_p": self.top_p,
         }
 
-    async def show_async_progress_tqdm(self, iterator: AsyncIterator) -> None:
-        pbar = None
-        async for update in iterator:
-            # Initialize the progress bar upon receiving the total size
-            if "total" in update and pbar is None:
-                pbar = tqdm(
-                    total=update["total"] / 1e9,
-                    bar_format="{l_bar}{bar}| {n:.3f}/{total:.3f} {unit} [elapsed: {elapsed}]",
-                    unit="GB",
-                    colour="green",
-                )
-            # Update the progress bar based on the 'completed' bytes
-            if pbar is not None and "completed" in update:
-                pbar.n = update["completed"] / 1e9
-                pbar.refresh()
-
-        if pbar is not None:
-            pbar.clear()
-            pbar.close()
-
-    async def _download_model(self) -> None:
-        iterator = await ollama.AsyncClient().pull(model=self.model, stream=True)
-        if isinstance(iterator, Mapping):
-            raise TypeError("Error while pulling the model")
-        await self.show_async_progress_tqdm(iterator)
+    def ensure_available(self) -> None:
+        if self.available:
+            return
+        with self._availability_lock:
+            if not self.available:
+                self.create_custom_model()
+                self.available = True
 
     def create_custom_model(self) -> None:
-        available_models = ollama.list()["models"]
-        if not available_models:
-            curr_models = []
-        else:
-            # The 'model' attribute holds the model name in the Ollama list response
-            curr_models = [model["model"] for model in available_models]
-        if self.model not in curr_models:
-            logger.warning(
-                f"Model [{self.model}] does not exist, pulling it. Please wait..."
-            )
-            asyncio.run(self._download_model())
-            logger.confirmation(f"Model [{self.model}] pulled successfully")
-        self.name = self._create_name()
-        if self.name not in curr_models:
+        if not ModelRegistry.has_model(self.model):
+            errors = ModelPuller.from_env().pull([self.model])
+            if errors:
+                raise errors[self.model]
+        if self.sampling == "request":
+            return
+        if not ModelRegistry.has_model(self.name):
             self._create_vai_modelfile()
+            ModelRegistry.add(self.name)
             logger.debug(f"Model [{self.name}] created successfully")
 
     def _create_vai_modelfile(self) -> None:
@@ -133,13 +227,24 @@ class LLM(MongoModel):
         with tempfile.NamedTemporaryFile(mode="w", delete=False) as tmp:
             tmp.write(modelfile_content)
             tmp_path = tmp.name
-        # Upload the Modelfile blob and create a custom model from it
-        # Use the same client instance for blob upload and model creation
-        client = ollama.Client()
-        digest = client.create_blob(tmp_path)
-        # Create the custom model from the uploaded Modelfile blob
-        client.create(model=self.name, from_=self.model, files={"Modelfile": digest})
-        os.remove(tmp_path)
+        # Upload the Modelfile blob and create a custom model from it, on
+        # every server the requests may be routed to
+        pool = EndpointPool.get_instance()
+        try:
+            for endpoint in pool.get_endpoints():
+                digest = endpoint.client.create_blob(tmp_path)
+                endpoint.client.create(
+                    model=self.name, from_=self.model, files={"Modelfile": digest}
+                )
+                pool.add_model(endpoint.url, self.name)
+        finally:
+            os.remove(tmp_path)
+
+    @staticmethod
+    def _get_ollama_host() -> str:
+        # Same variable as the Ollama client, e.g. to use the fake server. The
+        # requests to the first server of a pool are spread over the others
+        return get_ollama_hosts()[0]
 
     def _create_name(self) -> str:
         # Replace colons with underscores in the model name
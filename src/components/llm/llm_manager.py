@@ -8,6 +8,8 @@ from ...interfaces import BaseManager
 from ...core.input_manager import InputManager
 from ...utility.custom_os import CustomOS
 from .llm import LLM
+from .model_puller import ModelPuller
+from .model_registry import ModelRegistry
 
 logger = ItakelloLogging().get_logger(__name__)
 
@@ -25,8 +27,11 @@ class LLMManager(BaseManager):
                 "If you want to use the same LLM with different parameters (temperature, top_p and/or top_k) insert it multiple times",
             ]
         )
+        # The LLMs of the development mode come from LLMS: asking again would
+        # give the same ones, so an error stops instead of looping
+        development = CustomOS.getenv("APP_MODE", "") == "development"
         while True:
-            if CustomOS.getenv("APP_MODE", "") == "development":
+            if development:
                 llms_names = CustomOS.getenv("LLMS")
                 llms_names = llms_names.split(",")
             else:
@@ -38,9 +43,29 @@ class LLMManager(BaseManager):
                     default=default,
                 )
             try:
+                # Models may have been pulled or removed outside the app
+                if not all(name.strip().lower().startswith("gpt-") for name in llms_names):
+                    ModelRegistry.refresh()
                 llms = [LLM(model=name) for name in llms_names]
+                # All the missing models are pulled together
+                errors = ModelPuller.from_env().pull(
+                    [
+                        llm.model
+                        for llm in llms
+                        if llm.is_local and not ModelRegistry.has_model(llm.model)
+                    ]
+                )
+                if errors:
+                    logger.error(
+                        f"Could not pull {list(errors)}, the other models are ready"
+                    )
+                    if development:
+                        raise ValueError(f"Could not pull the LLMs {list(errors)}")
+                    continue
+                for llm in llms:
+                    llm.ensure_available()
                 break
-            except httpx.ConnectError:
+            except (ConnectionError, httpx.ConnectError):
                 logger.error("Ollama is not currently running. Please start it.")
                 self.input_m.input_str(
                     "Press Enter when Ollama is running again", optional=True
@@ -48,6 +73,8 @@ class LLMManager(BaseManager):
                 continue
             except ollama.ResponseError as e:
                 logger.error(e)
+                if development:
+                    raise
         if CustomOS.getenv("APP_MODE", "") == "development":
             set_parameters = CustomOS.getenv("SET_PARAMETERS")
             set_parameters = True if set_parameters == "y" else False
@@ -62,17 +89,18 @@ class LLMManager(BaseManager):
 
     def _ask_for_parameters(self, llm: LLM) -> None:
         logger.info(f"Setting parameters for [{llm.model}]")
-        llm.temperature = self.input_m.input_float(
+        temperature = self.input_m.input_float(
             f"Enter temperature (default: {llm.temperature})",
             positive_requirement=True,
             max_value=1,
         )
-        llm.top_k = self.input_m.input_int(
+        top_k = self.input_m.input_int(
             f"Enter top_k (default: {llm.top_k})", positive_requirement=True
         )
-        llm.top_p = self.input_m.input_float(
+        top_p = self.input_m.input_float(
             f"Enter top_p (default: {llm.top_p})",
             positive_requirement=True,
             max_value=1,
         )
-        llm.create_custom_model()
+        llm.set_parameters(temperature, top_k, top_p)
+        llm.ensure_available()
@@ -0,0 +1,156 @@
+import asyncio
+from collections.abc import AsyncIterator
+from dataclasses import dataclass, field
+from typing import Mapping
+
+import ollama
+from itakello_logging import ItakelloLogging
+from tqdm import tqdm
+
+from ...utility.custom_os import CustomOS
+from .endpoint_pool import EndpointPool
+from .model_registry import ModelRegistry
+
+logger = ItakelloLogging().get_logger(__name__)
+
+BAR_FORMAT = "{l_bar}{bar}| {n:.3f}/{total:.3f} {unit} [elapsed: {elapsed}]"
+
+
+@dataclass
+class ModelPuller:
+    """
+    Pulls models from Ollama, at most ``max_parallel`` at the same time.
+
+    Every model has its own progress bar and a last bar shows the total. The
+    total grows while the pulls discover the layers of their models. A failed
+    pull does not stop the others: the errors are returned by model.
+
+    With a pool of servers, every model is pulled on all of them at once.
+    A model pulled by some of the servers only is not an error, its requests
+    are routed to those.
+    """
+
+    max_parallel: int = 3
+
+    # Server and layer digest -> (completed, total) bytes, for the total bar
+    _layers: dict[str, tuple[int, int]] = field(init=False, default_factory=dict)
+
+    def pull(self, models: list[str]) -> dict[str, BaseException]:
+        models = list(dict.fromkeys(models))
+        if not models:
+            return {}
+        errors = asyncio.run(self._pull_all(models))
+        # Refreshed instead of added, to know the size of the new models
+        ModelRegistry.refresh()
+        for model in models:
+            if model in errors:
+                logger.error(f"Could not pull model [{model}]: {errors[model]}")
+            else:
+                logger.confirmation(f"Model [{model}] pulled successfully")
+        return errors
+
+    async def _pull_all(self, models: list[str]) -> dict[str, BaseException]:
+        logger.warning(
+            f"Models {models} do not exist, pulling them. Please wait..."
+        )
+        self._layers = {}
+        semaphore = asyncio.Semaphore(self.max_parallel)
+        total_bar = self._create_bar("Total", position=len(models))
+        results = await asyncio.gather(
+            *[
+                self._pull_model(model, position, semaphore, total_bar)
+                for position, model in enumerate(models)
+            ],
+            return_exceptions=True,
+        )
+        total_bar.close()
+        return {
+            model: result
+            for model, result in zip(models, results)
+            if isinstance(result, BaseException)
+        }
+
+    async def _pull_model(
+        self,
+        model: str,
+        position: int,
+        semaphore: asyncio.Semaphore,
+        total_bar: tqdm,
+    ) -> None:
+        pool = EndpointPool.get_instance()
+        urls = [endpoint.url for endpoint in pool.get_endpoints()]
+        pbar = self._create_bar(model, position)
+        # Each layer of the model reports its own total and completed bytes
+        layers: dict[str, tuple[int, int]] = {}
+        try:
+            async with semaphore:
+                results = await asyncio.gather(
+                    *[
+                        self._pull_from(url, model, layers, pbar, total_bar)
+                        for url in urls
+                    ],
+                    return_exceptions=True,
+                )
+        finally:
+            pbar.close()
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if len(errors) == len(urls):
+            raise errors[0]
+        for url, result in zip(urls, results):
+            if isinstance(result, BaseException):
+                logger.warning(f"Could not pull model [{model}] on [{url}]: {result}")
+            else:
+                pool.add_model(url, model)
+
+    async def _pull_from(
+        self,
+        url: str,
+        model: str,
+        layers: dict[str, tuple[int, int]],
+        pbar: tqdm,
+        total_bar: tqdm,
+    ) -> None:
+        iterator = await ollama.AsyncClient(host=url).pull(model=model, stream=True)
+        if isinstance(iterator, Mapping):
+            raise TypeError("Error while pulling the model")
+        await self._show_progress(iterator, url, layers, pbar, total_bar)
+
+    async def _show_progress(
+        self,
+        iterator: AsyncIterator,
+        url: str,
+        layers: dict[str, tuple[int, int]],
+        pbar: tqdm,
+        total_bar: tqdm,
+    ) -> None:
+        async for update in iterator:
+            if "total" not in update or "digest" not in update:
+                continue
+            completed = update.get("completed") or 0
+            # The servers download the same layers on their own
+            key = f"{url}/{update['digest']}"
+            layers[key] = (completed, update["total"])
+            self._layers[key] = (completed, update["total"])
+            self._update_bar(pbar, layers)
+            self._update_bar(total_bar, self._layers)
+
+    def _create_bar(self, desc: str, position: int) -> tqdm:
+        return tqdm(
+            total=0,
+            desc=desc,
+            position=position,
+            bar_format=BAR_FORMAT,
+            unit="GB",
+            colour="green",
+            leave=False,
+        )
+
+    def _update_bar(self, pbar: tqdm, layers: dict[str, tuple[int, int]]) -> None:
+        pbar.total = sum(total for _, total in layers.values()) / 1e9
+        pbar.n = sum(completed for completed, _ in layers.values()) / 1e9
+        pbar.refresh()
+
+    @classmethod
+    def from_env(cls) -> "ModelPuller":
+        # OLLAMA_MAX_PULLS sets how many models are pulled at the same time
+        return cls(max_parallel=int(CustomOS.getenv("OLLAMA_MAX_PULLS", "3")))
@@ -0,0 +1,79 @@
+import threading
+from typing import ClassVar
+
+import httpx
+import ollama
+from itakello_logging import ItakelloLogging
+
+from .endpoint_pool import EndpointPool
+
+logger = ItakelloLogging().get_logger(__name__)
+
+
+class ModelRegistry:
+    """
+    Process-wide cache of the models installed on Ollama.
+
+    The list is fetched once, on first use, and shared by every LLM of the
+    process. Pulls and custom model creations add their model to it, and
+    ``refresh`` fetches it again when it may be out of date (e.g. right
+    before the user picks the LLMs). With a pool of servers, a model is only
+    installed when every server of the pool has it, so that the missing
+    ones pull it.
+    """
+
+    # Model name -> size in bytes (0 until the next refresh for new models)
+    _models: ClassVar[dict[str, int] | None] = None
+    _lock: ClassVar[threading.Lock] = threading.Lock()
+
+    @classmethod
+    def has_model(cls, model: str) -> bool:
+        return model in cls._get_models()
+
+    @classmethod
+    def get_size(cls, model: str) -> int:
+        return cls._get_models().get(model, 0)
+
+    @classmethod
+    def get_sizes(cls) -> dict[str, int]:
+        return dict(cls._get_models())
+
+    @classmethod
+    def add(cls, model: str) -> None:
+        with cls._lock:
+            if cls._models is not None:
+                cls._models.setdefault(model, 0)
+        logger.debug(f"Model [{model}] added to the registry")
+
+    @classmethod
+    def refresh(cls) -> None:
+        pool = EndpointPool.get_instance()
+        endpoints = pool.get_endpoints()
+        installed: dict[str, int] | None = None
+        for endpoint in endpoints:
+            try:
+                models = endpoint.client.list()["models"] or []
+            except (ConnectionError, httpx.HTTPError, ollama.ResponseError) as e:
+                # The other servers are enough, unless there are none
+                if len(endpoints) == 1:
+                    raise
+                pool.remove(endpoint, f"could not list its models: {e}")
+                continue
+            sizes = {model["model"]: model["size"] for model in models}
+            if installed is None:
+                installed = sizes
+            else:
+                installed = {
+                    model: size for model, size in installed.items() if model in sizes
+                }
+        if installed is None:
+            raise ConnectionError("No Ollama server of the pool could be reached")
+        with cls._lock:
+            cls._models = installed
+        logger.debug(f"Model registry refreshed: {len(installed)} models")
+
+    @classmethod
+    def _get_models(cls) -> dict[str, int]:
+        if cls._models is None:
+            cls.refresh()
+        return cls._models  # type: ignore
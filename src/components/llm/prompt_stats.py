@@ -0,0 +1,94 @@
+import threading
+from dataclasses import dataclass
+from typing import ClassVar
+
+from itakello_logging import ItakelloLogging
+
+from .context_window import count_tokens
+
+logger = ItakelloLogging().get_logger(__name__)
+
+
+def split_prompt_tokens(
+    model: str, messages: list[dict], usage: dict
+) -> tuple[int, int, bool]:
+    """
+    Size of a prompt, how many of its tokens the server evaluated, the
+    others being served from its prefix (KV) cache, and whether the size is
+    estimated. OpenAI reports both, Ollama only the evaluated ones: the
+    prompt is then counted with a local tokenizer (see ``count_tokens``),
+    so the cached tokens are an estimate that also absorbs the differences
+    between that tokenizer and the model's.
+    """
+    reported = usage.get("prompt_tokens") or 0
+    cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+    if cached is not None:
+        return reported, reported - cached, False
+    return max(count_tokens(model, messages), reported), reported, True
+
+
+@dataclass
+class PromptStats:
+    """
+    Prompt tokens sent to a server (base_url) and how many of them it had to
+    evaluate, the others being served from its prefix (KV) cache.
+
+    OpenAI reports the cached tokens of every request. Ollama only reports
+    the evaluated ones, so the prompt is counted with a local tokenizer and
+    the cached tokens are the difference, logged as an estimate (see
+    ``split_prompt_tokens``). The counts of every call are also kept in the
+    ``CallLedger`` of its conversation.
+    """
+
+    name: str
+    calls: int = 0
+    prompt_tokens: int = 0
+    evaluated_tokens: int = 0
+    estimated_calls: int = 0
+
+    _registry: ClassVar[dict[str, "PromptStats"]] = {}
+    _lock: ClassVar[threading.Lock] = threading.Lock()
+
+    @property
+    def cached_tokens(self) -> int:
+        return self.prompt_tokens - self.evaluated_tokens
+
+    @property
+    def cached_share(self) -> float:
+        return self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"Prompt tokens [{self.name}] calls: {self.calls} | prompt: {self.prompt_tokens:,} | "
+            + f"evaluated: {self.evaluated_tokens:,} | "
+            + f"from cache{' (estimated)' if self.estimated_calls else ''}: "
+            + f"{self.cached_tokens:,} ({100 * self.cached_share:.1f}%)"
+        )
+
+    def record(self, model: str, messages: list[dict], usage: dict) -> None:
+        prompt_tokens, evaluated, estimated = split_prompt_tokens(model, messages, usage)
+        with self._lock:
+            self.calls += 1
+            self.prompt_tokens += prompt_tokens
+            self.evaluated_tokens += evaluated
+            self.estimated_calls += estimated
+        share = 100 * (prompt_tokens - evaluated) / prompt_tokens if prompt_tokens else 0.0
+        logger.debug(
+            f"[{model}] prompt: {prompt_tokens} tokens, evaluated: {evaluated}, "
+            + f"from cache: {prompt_tokens - evaluated} ({share:.0f}%)"
+            + (" (estimated)" if estimated else "")
+        )
+
+    @classmethod
+    def for_url(cls, base_url: str) -> "PromptStats":
+        with cls._lock:
+            if base_url not in cls._registry:
+                cls._registry[base_url] = cls(name=base_url)
+            return cls._registry[base_url]
+
+    @classmethod
+    def log_metrics(cls) -> None:
+        with cls._lock:
+            stats = [stat for stat in cls._registry.values() if stat.calls]
+        for stat in stats:
+            logger.info(str(stat))
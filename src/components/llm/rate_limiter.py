@@ -0,0 +1,370 @@
+import asyncio
+import json
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator, ClassVar, Iterator
+
+from itakello_logging import ItakelloLogging
+
+from ...utility.custom_os import CustomOS
+from .concurrency_controller import ConcurrencyController
+from .endpoint_pool import get_ollama_hosts
+
+logger = ItakelloLogging().get_logger(__name__)
+
+# Rough number of characters per token, used to size requests before sending them
+CHARS_PER_TOKEN = 4
+# Completion tokens reserved for a request until its actual usage is known
+EXPECTED_COMPLETION_TOKENS = 256
+# How often the async engine checks for a free slot
+SLOT_POLL_SECONDS = 0.05
+# Number of recent queueing delays used for the percentiles
+WAIT_WINDOW = 1000
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN
+
+
+def estimate_prompt_tokens(messages: list[dict]) -> int:
+    return sum(estimate_tokens(str(message.get("content") or "")) for message in messages)
+
+
+@dataclass
+class TokenBucket:
+    """
+    Token bucket refilled at ``rate_per_minute`` up to ``capacity``.
+
+    ``reserve`` takes the tokens right away, going into debt if needed, and
+    returns how long the caller has to wait before the debt is repaid. Callers
+    are therefore served in the order they arrive.
+    """
+
+    rate_per_minute: float
+    capacity: float = 0
+    tokens: float = field(init=False)
+    updated: float = field(init=False, default_factory=time.monotonic)
+    _lock: threading.Lock = field(init=False, default_factory=threading.Lock)
+
+    def __post_init__(self) -> None:
+        if not self.capacity:
+            self.capacity = self.rate_per_minute
+        self.tokens = self.capacity
+
+    def reserve(self, amount: float) -> float:
+        with self._lock:
+            self._refill()
+            self.tokens -= min(amount, self.capacity)
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens * 60 / self.rate_per_minute
+
+    def adjust(self, amount: float) -> None:
+        # Positive amounts take more tokens, negative ones give them back
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (now - self.updated) * self.rate_per_minute / 60,
+        )
+        self.updated = now
+
+
+@dataclass
+class LimitedCall:
+    prompt_tokens: int
+    queued_at: float = field(default_factory=time.monotonic)
+    started_at: float = 0.0
+    total_tokens: int | None = None
+    failed: bool = False
+
+    @property
+    def reserved_tokens(self) -> int:
+        return self.prompt_tokens + EXPECTED_COMPLETION_TOKENS
+
+    @property
+    def wait(self) -> float:
+        return self.started_at - self.queued_at
+
+    def record_usage(self, total_tokens: int) -> None:
+        self.total_tokens = total_tokens
+
+    def record_reply(self, reply: str) -> None:
+        self.total_tokens = self.prompt_tokens + estimate_tokens(reply)
+
+
+@dataclass
+class RateLimiter:
+    """
+    Limits the calls made to one backend, identified by its base_url.
+
+    Every LLM call (agent replies, speaker selection and summaries, on both
+    engines) goes through ``limit`` or ``alimit``, which wait for the
+    requests/min and tokens/min buckets and for a free in-flight slot. Limits
+    set to None are not enforced. The limiters are shared by every thread of
+    the process through ``for_config``. In adaptive mode, a
+    ``ConcurrencyController`` moves the in-flight limit between 1 and the
+    configured one, following the latency and the errors of the calls.
+    """
+
+    name: str
+    max_concurrency: int | None = None
+    requests_per_minute: float | None = None
+    tokens_per_minute: float | None = None
+
+    configured_concurrency: int | None = field(init=False)
+    controller: ConcurrencyController | None = field(init=False, default=None)
+    in_flight: int = field(init=False, default=0)
+    waiting: int = field(init=False, default=0)
+    calls: int = field(init=False, default=0)
+    total_wait: float = field(init=False, default=0.0)
+    max_wait: float = field(init=False, default=0.0)
+    _waits: deque = field(init=False, default_factory=lambda: deque(maxlen=WAIT_WINDOW))
+    _request_bucket: TokenBucket | None = field(init=False, default=None)
+    _token_bucket: TokenBucket | None = field(init=False, default=None)
+    _condition: threading.Condition = field(
+        init=False, default_factory=threading.Condition
+    )
+
+    _registry: ClassVar[dict[str, "RateLimiter"]] = {}
+    _registry_lock: ClassVar[threading.Lock] = threading.Lock()
+    # Upper bound of the adaptive limits, None when the limits are fixed
+    _adaptive_max: ClassVar[int | None] = None
+
+    def __post_init__(self) -> None:
+        self.configured_concurrency = self.max_concurrency
+        if self.requests_per_minute:
+            self._request_bucket = TokenBucket(self.requests_per_minute)
+        if self.tokens_per_minute:
+            self._token_bucket = TokenBucket(self.tokens_per_minute)
+        logger.debug(f"Created rate limiter: {self._limits_label()}")
+
+    @contextmanager
+    def limit(self, messages: list[dict]) -> Iterator[LimitedCall]:
+        call = LimitedCall(prompt_tokens=estimate_prompt_tokens(messages))
+        delay = self._reserve(call)
+        if delay:
+            time.sleep(delay)
+        with self._condition:
+            self.waiting += 1
+            while not self._has_free_slot():
+                self._condition.wait()
+            self.waiting -= 1
+            self.in_flight += 1
+        self._start(call)
+        try:
+            yield call
+        except Exception:
+            call.failed = True
+            raise
+        finally:
+            self._finish(call)
+
+    @asynccontextmanager
+    async def alimit(self, messages: list[dict]) -> AsyncIterator[LimitedCall]:
+        call = LimitedCall(prompt_tokens=estimate_prompt_tokens(messages))
+        delay = self._reserve(call)
+        if delay:
+            await asyncio.sleep(delay)
+        with self._condition:
+            self.waiting += 1
+        # The condition cannot be awaited, so the event loop polls for a slot
+        try:
+            while not self._try_acquire_slot():
+                await asyncio.sleep(SLOT_POLL_SECONDS)
+        except asyncio.CancelledError:
+            with self._condition:
+                self.waiting -= 1
+            raise
+        self._start(call)
+        try:
+            yield call
+        except Exception:
+            call.failed = True
+            raise
+        finally:
+            self._finish(call)
+
+    def has_capacity(self) -> bool:
+        # True when a new call would not wait for a slot
+        with self._condition:
+            return self.waiting == 0 and self._has_free_slot()
+
+    def set_max_concurrency(self, max_concurrency: int | None) -> None:
+        with self._condition:
+            self.max_concurrency = max_concurrency
+            self._condition.notify_all()
+
+    def metrics(self) -> dict:
+        with self._condition:
+            waits = sorted(self._waits)
+            return {
+                "backend": self.name,
+                "calls": self.calls,
+                "in_flight": self.in_flight,
+                "waiting": self.waiting,
+                "max_concurrency": self.max_concurrency,
+                "avg_wait": self.total_wait / self.calls if self.calls else 0.0,
+                "p95_wait": waits[int(0.95 * (len(waits) - 1))] if waits else 0.0,
+                "max_wait": self.max_wait,
+            }
+
+    def __str__(self) -> str:
+        metrics = self.metrics()
+        return (
+            f"[{self.name}] calls: {metrics['calls']} | "
+            + f"queue wait avg {metrics['avg_wait']:.2f}s, "
+            + f"p95 {metrics['p95_wait']:.2f}s, max {metrics['max_wait']:.2f}s | "
+            + f"in flight: {metrics['in_flight']}/{self.max_concurrency or '∞'}, "
+            + f"waiting: {metrics['waiting']}"
+        )
+
+    def _reserve(self, call: LimitedCall) -> float:
+        delay = 0.0
+        if self._request_bucket is not None:
+            delay = max(delay, self._request_bucket.reserve(1))
+        if self._token_bucket is not None:
+            delay = max(delay, self._token_bucket.reserve(call.reserved_tokens))
+        return delay
+
+    def _has_free_slot(self) -> bool:
+        return self.max_concurrency is None or self.in_flight < self.max_concurrency
+
+    def _try_acquire_slot(self) -> bool:
+        with self._condition:
+            if not self._has_free_slot():
+                return False
+            self.waiting -= 1
+            self.in_flight += 1
+            return True
+
+    def _start(self, call: LimitedCall) -> None:
+        call.started_at = time.monotonic()
+        with self._condition:
+            self.calls += 1
+            self.total_wait += call.wait
+            self.max_wait = max(self.max_wait, call.wait)
+            self._waits.append(call.wait)
+        if call.wait > 1:
+            logger.debug(f"[{self.name}] call queued for {call.wait:.2f}s")
+
+    def _finish(self, call: LimitedCall) -> None:
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+            if self.controller is not None:
+                latency = time.monotonic() - call.started_at
+                tokens = max(call.total_tokens or call.reserved_tokens, 1)
+                new_limit = self.controller.record(
+                    latency / tokens, call.failed, call.started_at
+                )
+                if new_limit is not None:
+                    logger.debug(
+                        f"[{self.name}] concurrency {self.max_concurrency} -> {new_limit}"
+                    )
+                    self.max_concurrency = new_limit
+                    self._condition.notify_all()
+        if self._token_bucket is not None and call.total_tokens is not None:
+            self._token_bucket.adjust(call.total_tokens - call.reserved_tokens)
+
+    def _set_adaptive(self, max_limit: int | None) -> None:
+        with self._condition:
+            if max_limit is None:
+                self.controller = None
+                self.max_concurrency = self.configured_concurrency
+            else:
+                self.controller = ConcurrencyController(
+                    max_limit=min(max_limit, self.configured_concurrency or max_limit)
+                )
+                self.max_concurrency = self.controller.limit
+            self._condition.notify_all()
+
+    def _limits_label(self) -> str:
+        return (
+            f"[{self.name}] max concurrency: {self.max_concurrency or '∞'}, "
+            + f"requests/min: {self.requests_per_minute or '∞'}, "
+            + f"tokens/min: {self.tokens_per_minute or '∞'}"
+        )
+
+    @classmethod
+    def for_config(cls, config: dict) -> "RateLimiter":
+        base_url = config["base_url"]
+        with cls._registry_lock:
+            if base_url not in cls._registry:
+                limiter = cls._from_env(
+                    base_url, is_openai=config["model"].startswith("gpt-")
+                )
+                if cls._adaptive_max is not None:
+                    limiter._set_adaptive(cls._adaptive_max)
+                cls._registry[base_url] = limiter
+            return cls._registry[base_url]
+
+    @classmethod
+    def _from_env(cls, base_url: str, is_openai: bool) -> "RateLimiter":
+        """
+        Defaults come from OPENAI_MAX_CONCURRENCY, OPENAI_RPM and OPENAI_TPM for
+        OpenAI and from OLLAMA_NUM_PARALLEL for every Ollama server. LLM_RATE_LIMITS can
+        override them per base_url with a JSON object such as
+        {"http://host:11434/v1": {"max_concurrency": 2}}. A limit of 0 disables it.
+        """
+        if is_openai:
+            limits = {
+                "max_concurrency": int(CustomOS.getenv("OPENAI_MAX_CONCURRENCY", "16")),
+                "requests_per_minute": float(CustomOS.getenv("OPENAI_RPM", "500")),
+                "tokens_per_minute": float(CustomOS.getenv("OPENAI_TPM", "30000")),
+            }
+        else:
+            # Per server, a pool of Ollama servers takes as many requests each
+            limits = {
+                "max_concurrency": int(CustomOS.getenv("OLLAMA_NUM_PARALLEL", "4"))
+                * len(get_ollama_hosts()),
+                "requests_per_minute": 0,
+                "tokens_per_minute": 0,
+            }
+        overrides = json.loads(CustomOS.getenv("LLM_RATE_LIMITS", "{}"))
+        limits.update(overrides.get(base_url, {}))
+        return cls(
+            name=base_url,
+            max_concurrency=limits["max_concurrency"] or None,
+            requests_per_minute=limits["requests_per_minute"] or None,
+            tokens_per_minute=limits["tokens_per_minute"] or None,
+        )
+
+    @classmethod
+    def enable_adaptive(cls, max_limit: int) -> None:
+        with cls._registry_lock:
+            cls._adaptive_max = max_limit
+            for limiter in cls._registry.values():
+                limiter._set_adaptive(max_limit)
+
+    @classmethod
+    def disable_adaptive(cls) -> None:
+        with cls._registry_lock:
+            cls._adaptive_max = None
+            for limiter in cls._registry.values():
+                limiter._set_adaptive(None)
+
+    @classmethod
+    def concurrency_label(cls) -> str:
+        return ", ".join(
+            f"{limiter.name}: {limiter.in_flight}/{limiter.max_concurrency or '∞'} in flight"
+            for limiter in cls.all()
+        )
+
+    @classmethod
+    def all(cls) -> list["RateLimiter"]:
+        with cls._registry_lock:
+            return list(cls._registry.values())
+
+    @classmethod
+    def log_metrics(cls) -> None:
+        for limiter in cls.all():
+            if limiter.calls:
+                logger.info(f"LLM calls {limiter}")
@@ -0,0 +1,282 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import ClassVar
+
+import httpx
+from itakello_logging import ItakelloLogging
+
+from ...utility.custom_os import CustomOS
+
+logger = ItakelloLogging().get_logger(__name__)
+
+# "deterministic" only caches requests with temperature 0 or a seed, so that
+# the replicates of a sweep do not all get the same reply
+CACHE_MODES = ("off", "deterministic", "all")
+# Eviction scans the store once every this many new responses
+EVICTION_INTERVAL = 100
+
+
+@dataclass
+class ResponseCache:
+    """
+    On-disk cache of the chat completions, shared by the threads and the
+    processes of this machine (SQLite in WAL mode).
+
+    A response is keyed on the server and the whole request body: model,
+    sampling parameters and options, messages and seed. Entries older than
+    ``ttl_seconds`` are misses, and the least recently used ones are evicted
+    when the store grows past ``max_bytes``. The cache is off unless
+    ``LLM_CACHE`` enables it, and a sweep can bypass it with ``bypass``.
+    """
+
+    path: str
+    mode: str = "deterministic"
+    max_bytes: int = 512 * 1024 * 1024
+    ttl_seconds: float | None = None
+
+    hits: int = field(init=False, default=0)
+    misses: int = field(init=False, default=0)
+    stores: int = field(init=False, default=0)
+    evictions: int = field(init=False, default=0)
+    _local: threading.local = field(init=False, default_factory=threading.local)
+    _counters_lock: threading.Lock = field(init=False, default_factory=threading.Lock)
+
+    _instance: ClassVar["ResponseCache | None"] = None
+    _loaded: ClassVar[bool] = False
+    _bypass: ClassVar[bool] = False
+    _instance_lock: ClassVar[threading.Lock] = threading.Lock()
+
+    def __post_init__(self) -> None:
+        assert self.mode in CACHE_MODES, logger.error(
+            f"LLM_CACHE must be one of {CACHE_MODES} [{self.mode}]"
+        )
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                + "key TEXT PRIMARY KEY, model TEXT, content BLOB, "
+                + "size INTEGER, created REAL, accessed REAL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)"
+            )
+        logger.debug(f"Response cache at {self.path} ({self.mode})")
+
+    def __str__(self) -> str:
+        requests = self.hits + self.misses
+        hit_rate = 100 * self.hits / requests if requests else 0.0
+        return (
+            f"Response cache [{self.path}] hits: {self.hits} | misses: {self.misses} "
+            + f"({hit_rate:.1f}% hit rate) | stored: {self.stores} | evicted: {self.evictions}"
+        )
+
+    def is_cacheable(self, body: dict) -> bool:
+        if body.get("stream"):
+            return False
+        if self.mode == "all":
+            return True
+        options = body.get("options", {})
+        temperature = body.get("temperature", options.get("temperature"))
+        seed = body.get("seed", options.get("seed"))
+        return temperature == 0 or seed is not None
+
+    def get_key(self, request: httpx.Request, body: dict) -> str:
+        # The scheme and host tell servers with the same model names apart
+        payload = json.dumps(
+            [str(request.url), body], sort_keys=True, separators=(",", ":")
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def lookup(self, key: str) -> bytes | None:
+        now = time.time()
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT content, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and self._is_expired(row[1], now):
+                connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                row = None
+            if row is not None:
+                connection.execute(
+                    "UPDATE responses SET accessed = ? WHERE key = ?", (now, key)
+                )
+        with self._counters_lock:
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return None if row is None else row[0]
+
+    def store(self, key: str, model: str, content: bytes) -> None:
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, content, len(content), now, now),
+            )
+        with self._counters_lock:
+            self.stores += 1
+            evict = self.stores % EVICTION_INTERVAL == 0
+        if evict:
+            self.evict()
+
+    def evict(self) -> None:
+        evicted = 0
+        with self._connect() as connection:
+            if self.ttl_seconds is not None:
+                evicted += connection.execute(
+                    "DELETE FROM responses WHERE created < ?",
+                    (time.time() - self.ttl_seconds,),
+                ).rowcount
+            total_size = connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()[0]
+            if total_size > self.max_bytes:
+                # Least recently used first, until the store fits again
+                excess = total_size - self.max_bytes
+                rows = connection.execute(
+                    "SELECT key, size FROM responses ORDER BY accessed"
+                )
+                keys = []
+                for key, size in rows:
+                    if excess <= 0:
+                        break
+                    keys.append((key,))
+                    excess -= size
+                connection.executemany("DELETE FROM responses WHERE key = ?", keys)
+                evicted += len(keys)
+        with self._counters_lock:
+            self.evictions += evicted
+        if evicted:
+            logger.debug(f"Evicted {evicted} responses from the cache")
+
+    def _is_expired(self, created: float, now: float) -> bool:
+        return self.ttl_seconds is not None and created < now - self.ttl_seconds
+
+    def _connect(self) -> sqlite3.Connection:
+        # SQLite connections cannot be shared between threads, nor between a
+        # process and the workers forked from it
+        if getattr(self._local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    @classmethod
+    def get_instance(cls) -> "ResponseCache | None":
+        if cls._bypass or not cls.is_enabled():
+            return None
+        return cls._instance
+
+    @classmethod
+    def _from_env(cls) -> "ResponseCache | None":
+        """
+        LLM_CACHE enables the cache (off, deterministic or all) and
+        LLM_CACHE_PATH sets its file (.cache/llm_responses.sqlite).
+        LLM_CACHE_MAX_MB (512) and LLM_CACHE_TTL_HOURS (no expiry) bound it.
+        """
+        mode = CustomOS.getenv("LLM_CACHE", "off").lower()
+        if mode == "off":
+            return None
+        ttl_hours = CustomOS.getenv("LLM_CACHE_TTL_HOURS", "")
+        return cls(
+            path=CustomOS.getenv("LLM_CACHE_PATH", ".cache/llm_responses.sqlite"),
+            mode=mode,
+            max_bytes=int(float(CustomOS.getenv("LLM_CACHE_MAX_MB", "512")) * 1024**2),
+            ttl_seconds=float(ttl_hours) * 3600 if ttl_hours else None,
+        )
+
+    @classmethod
+    def is_enabled(cls) -> bool:
+        with cls._instance_lock:
+            if not cls._loaded:
+                cls._instance = cls._from_env()
+                cls._loaded = True
+            return cls._instance is not None
+
+    @classmethod
+    def set_bypass(cls, bypass: bool) -> None:
+        cls._bypass = bypass
+
+    @classmethod
+    def log_metrics(cls) -> None:
+        if cls._instance is not None and not cls._bypass:
+            logger.info(str(cls._instance))
+
+
+class CachingTransport(httpx.BaseTransport):
+    def __init__(self, transport: httpx.BaseTransport) -> None:
+        self._transport = transport
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        cache, key, body = _get_cache_key(request)
+        if cache is None:
+            return self._transport.handle_request(request)
+        content = cache.lookup(key)
+        if content is not None:
+            return _cached_response(request, content)
+        response = self._transport.handle_request(request)
+        if response.status_code == 200:
+            cache.store(key, body["model"], response.read())
+        return response
+
+    def close(self) -> None:
+        self._transport.close()
+
+
+class AsyncCachingTransport(httpx.AsyncBaseTransport):
+    def __init__(self, transport: httpx.AsyncBaseTransport) -> None:
+        self._transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        cache, key, body = _get_cache_key(request)
+        if cache is None:
+            return await self._transport.handle_async_request(request)
+        # SQLite blocks, so it is kept off the event loop (its connections are
+        # per thread)
+        content = await asyncio.to_thread(cache.lookup, key)
+        if content is not None:
+            return _cached_response(request, content)
+        response = await self._transport.handle_async_request(request)
+        if response.status_code == 200:
+            content = await response.aread()
+            await asyncio.to_thread(cache.store, key, body["model"], content)
+        return response
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+def _get_cache_key(
+    request: httpx.Request,
+) -> tuple[ResponseCache | None, str, dict]:
+    cache = ResponseCache.get_instance()
+    if (
+        cache is None
+        or request.method != "POST"
+        or not request.url.path.endswith("/chat/completions")
+    ):
+        return None, "", {}
+    body = json.loads(request.read())
+    if not cache.is_cacheable(body):
+        return None, "", {}
+    return cache, cache.get_key(request, body), body
+
+
+def _cached_response(request: httpx.Request, content: bytes) -> httpx.Response:
+    return httpx.Response(
+        200,
+        content=content,
+        headers={"content-type": "application/json", "x-cache": "hit"},
+        request=request,
+    )
@@ -0,0 +1,291 @@
+import asyncio
+import email.utils
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, ClassVar, TypeVar
+
+import httpx
+import ollama
+import openai
+from itakello_logging import ItakelloLogging
+
+from ...utility.custom_os import CustomOS
+
+logger = ItakelloLogging().get_logger(__name__)
+
+T = TypeVar("T")
+
+# Statuses of the errors a later attempt may not get
+RETRYABLE_STATUSES = (408, 409, 429, 500, 502, 503, 504)
+# How often the calls waiting for a half-open breaker check its probe
+PROBE_POLL_SECONDS = 1.0
+
+
+def is_retryable(error: BaseException) -> bool:
+    # Timeouts, lost connections and overloaded servers; not invalid requests
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUSES
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in RETRYABLE_STATUSES
+    if isinstance(error, ollama.ResponseError):
+        return error.status_code in RETRYABLE_STATUSES
+    return isinstance(
+        error,
+        (
+            openai.APIConnectionError,
+            httpx.TransportError,
+            # Raised by autogen on timeouts and by Ollama when it is down
+            TimeoutError,
+            ConnectionError,
+        ),
+    )
+
+
+def get_retry_after(error: BaseException) -> float | None:
+    # Seconds the server asked to wait before the next attempt, if any
+    response = getattr(error, "response", None)
+    if not isinstance(response, httpx.Response):
+        return None
+    retry_after_ms = response.headers.get("retry-after-ms")
+    if retry_after_ms is not None:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = response.headers.get("retry-after")
+    if retry_after is None:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    # Or an HTTP date
+    try:
+        date = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(date.timestamp() - time.time(), 0.0)
+
+
+@dataclass
+class CircuitBreaker:
+    """
+    Stops the calls to a backend after ``failure_threshold`` consecutive
+    failures, for ``open_seconds``. Then a single call probes the backend:
+    the breaker closes if it succeeds, and opens again if it fails.
+    """
+
+    name: str
+    failure_threshold: int = 5
+    open_seconds: float = 30.0
+
+    state: str = field(init=False, default="closed")
+    opens: int = field(init=False, default=0)
+    _failures: int = field(init=False, default=0)
+    _opened_at: float = field(init=False, default=0.0)
+    _probe_started_at: float = field(init=False, default=0.0)
+    _lock: threading.Lock = field(init=False, default_factory=threading.Lock)
+
+    def get_wait(self) -> float:
+        # 0 when the call can go, otherwise how long to wait before asking again
+        now = time.monotonic()
+        with self._lock:
+            if self.state == "closed":
+                return 0.0
+            if self.state == "open":
+                remaining = self._opened_at + self.open_seconds - now
+                if remaining > 0:
+                    return remaining
+                self.state = "half_open"
+            elif now < self._probe_started_at + self.open_seconds:
+                return PROBE_POLL_SECONDS
+            # This call is the probe (again, if the previous one never ended)
+            self._probe_started_at = now
+            return 0.0
+
+    def record_success(self) -> None:
+        with self._lock:
+            closed = self.state != "closed"
+            self.state = "closed"
+            self._failures = 0
+        if closed:
+            logger.confirmation(f"[{self.name}] backend healthy again, circuit closed")
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self.state == "open" or (
+                self.state == "closed" and self._failures < self.failure_threshold
+            ):
+                return
+            self.state = "open"
+            self.opens += 1
+            self._opened_at = time.monotonic()
+        logger.warning(
+            f"[{self.name}] {self._failures} failed calls in a row, "
+            + f"pausing its calls for {self.open_seconds:g}s"
+        )
+
+
+@dataclass
+class RetryPolicy:
+    """
+    Retries of the LLM calls made to one backend, identified by its base_url.
+
+    Only the errors a later attempt may not get are retried (see
+    ``is_retryable``), at most ``max_attempts`` times per call. The delays
+    grow exponentially from ``base_delay`` with full jitter, so that the
+    calls that failed together do not come back together, and they are at
+    least the ``Retry-After`` of the server. Every call adds ``retry_ratio``
+    to a budget of ``max_budget`` retries shared by the process: when a
+    backend fails most calls, they fail fast instead of multiplying the
+    load. The ``CircuitBreaker`` of the backend holds the calls back while
+    it is unhealthy.
+    """
+
+    name: str
+    max_attempts: int = 3
+    base_delay: float = 1.0
+    max_delay: float = 30.0
+    retry_ratio: float = 0.2
+    max_budget: float = 10.0
+    breaker: CircuitBreaker = field(init=False)
+
+    calls: int = field(init=False, default=0)
+    retries: int = field(init=False, default=0)
+    exhausted: int = field(init=False, default=0)
+    _budget: float = field(init=False)
+    _lock: threading.Lock = field(init=False, default_factory=threading.Lock)
+
+    _registry: ClassVar[dict[str, "RetryPolicy"]] = {}
+    _registry_lock: ClassVar[threading.Lock] = threading.Lock()
+
+    def __post_init__(self) -> None:
+        self._budget = self.max_budget
+        self.breaker = CircuitBreaker(name=self.name, **self._breaker_from_env())
+
+    def __str__(self) -> str:
+        return (
+            f"Retries [{self.name}] calls: {self.calls} | retries: {self.retries} | "
+            + f"out of budget: {self.exhausted} | circuit opened: {self.breaker.opens}"
+        )
+
+    def call(self, function: Callable[[], T], action: str) -> T:
+        self._start()
+        attempt = 0
+        while True:
+            wait = self.breaker.get_wait()
+            while wait:
+                time.sleep(wait)
+                wait = self.breaker.get_wait()
+            attempt += 1
+            try:
+                result = function()
+            except Exception as e:
+                delay = self._on_failure(e, attempt, action)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            self.breaker.record_success()
+            return result
+
+    async def acall(self, function: Callable[[], Awaitable[T]], action: str) -> T:
+        self._start()
+        attempt = 0
+        while True:
+            wait = self.breaker.get_wait()
+            while wait:
+                await asyncio.sleep(wait)
+                wait = self.breaker.get_wait()
+            attempt += 1
+            try:
+                result = await function()
+            except Exception as e:
+                delay = self._on_failure(e, attempt, action)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            self.breaker.record_success()
+            return result
+
+    def _start(self) -> None:
+        with self._lock:
+            self.calls += 1
+            self._budget = min(self.max_budget, self._budget + self.retry_ratio)
+
+    def _on_failure(self, error: Exception, attempt: int, action: str) -> float | None:
+        # Delay before the next attempt, None to give up
+        if not is_retryable(error):
+            # The server answered, the request itself is wrong
+            self.breaker.record_success()
+            logger.error(f"Error {action}, not retried: {error}")
+            return None
+        self.breaker.record_failure()
+        if attempt >= self.max_attempts:
+            logger.error(f"Failed {action} after {attempt} attempts: {error}")
+            return None
+        with self._lock:
+            if self._budget < 1:
+                self.exhausted += 1
+                out_of_budget = True
+            else:
+                self._budget -= 1
+                self.retries += 1
+                out_of_budget = False
+        if out_of_budget:
+            logger.error(f"Error {action}, retry budget of [{self.name}] spent: {error}")
+            return None
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        logger.warning(
+            f"Error {action} (attempt {attempt}/{self.max_attempts}): {error}. "
+            + f"Retrying in {delay:.1f}s..."
+        )
+        return delay
+
+    @classmethod
+    def for_config(cls, config: dict) -> "RetryPolicy":
+        base_url = config["base_url"]
+        with cls._registry_lock:
+            if base_url not in cls._registry:
+                cls._registry[base_url] = cls._from_env(base_url)
+            return cls._registry[base_url]
+
+    @classmethod
+    def _from_env(cls, base_url: str) -> "RetryPolicy":
+        """
+        LLM_MAX_ATTEMPTS (3) bounds the attempts of a call, and the delays
+        grow from LLM_RETRY_BASE_SECONDS (1) up to LLM_RETRY_MAX_SECONDS
+        (30). LLM_RETRY_RATIO (0.2) is the share of the calls that can be
+        retried, with up to LLM_RETRY_BUDGET (10) retries in a burst.
+        """
+        return cls(
+            name=base_url,
+            max_attempts=int(CustomOS.getenv("LLM_MAX_ATTEMPTS", "3")),
+            base_delay=float(CustomOS.getenv("LLM_RETRY_BASE_SECONDS", "1")),
+            max_delay=float(CustomOS.getenv("LLM_RETRY_MAX_SECONDS", "30")),
+            retry_ratio=float(CustomOS.getenv("LLM_RETRY_RATIO", "0.2")),
+            max_budget=float(CustomOS.getenv("LLM_RETRY_BUDGET", "10")),
+        )
+
+    @staticmethod
+    def _breaker_from_env() -> dict:
+        # LLM_BREAKER_FAILURES (5) failures in a row pause a backend for
+        # LLM_BREAKER_SECONDS (30)
+        return {
+            "failure_threshold": int(CustomOS.getenv("LLM_BREAKER_FAILURES", "5")),
+            "open_seconds": float(CustomOS.getenv("LLM_BREAKER_SECONDS", "30")),
+        }
+
+    @classmethod
+    def log_metrics(cls) -> None:
+        with cls._registry_lock:
+            policies = [policy for policy in cls._registry.values() if policy.calls]
+        for policy in policies:
+            logger.info(str(policy))
@@ -117,18 +117,19 @@ class SectionManager(BaseManager):
         new_placeholders = section.set_content(content)
         return new_placeholders
 
+    @staticmethod
     def get_agent_combinations(
-        self, role_agents_num: list[tuple[str, int]], try_each_combination: bool
+        role_agents_num: list[tuple[str, int]], try_each_combination: bool
     ) -> list[list[tuple[str, int]]]:
         agent_combinations = []
         if try_each_combination:
-            self.generate_combinations(role_agents_num, [], 0, agent_combinations)
+            SectionManager.generate_combinations(role_agents_num, [], 0, agent_combinations)
         else:
             agent_combinations.append(role_agents_num)
         return agent_combinations
 
+    @staticmethod
     def generate_combinations(
-        self,
         nums: list[Any],
         current_combination: list[Any],
         index: int,
@@ -139,5 +140,7 @@ class SectionManager(BaseManager):
             return
         for i in range(1, nums[index][1] + 1):
             current_combination.append((nums[index][0], i))
-            self.generate_combinations(nums, current_combination, index + 1, result)
+            SectionManager.generate_combinations(
+                nums, current_combination, index + 1, result
+            )
             current_combination.pop()
@@ -0,0 +1,45 @@
+from dataclasses import dataclass
+
+from ...interfaces.mongo_model import MongoModel
+
+
+@dataclass
+class ConversationSpec(MongoModel):
+    llm_name: str
+    n_messages: int
+    days: int
+    agent_combination: list[tuple[str, int]]
+    speaker_selection_method: str
+    replicate: int = 0
+
+    def __str__(self) -> str:
+        agent_combination = ", ".join(
+            f"{role.capitalize()}:{num}" for role, num in self.agent_combination
+        )
+        return (
+            f"LLM: {self.llm_name} | Days: {self.days} | Agents: {agent_combination}"
+            + f" | Replicate: {self.replicate + 1}"
+        )
+
+    @classmethod
+    def from_document(cls, doc: dict) -> "ConversationSpec":
+        return cls(
+            llm_name=doc["llm_name"],
+            n_messages=doc["n_messages"],
+            days=doc["days"],
+            agent_combination=[
+                (role, num) for role, num in doc["agent_combination"]
+            ],
+            speaker_selection_method=doc["speaker_selection_method"],
+            replicate=doc["replicate"],
+        )
+
+    def to_document(self) -> dict:
+        return {
+            "llm_name": self.llm_name,
+            "n_messages": self.n_messages,
+            "days": self.days,
+            "agent_combination": self.agent_combination,
+            "speaker_selection_method": self.speaker_selection_method,
+            "replicate": self.replicate,
+        }
@@ -0,0 +1,71 @@
+from dataclasses import dataclass, field
+from datetime import datetime
+
+from bson.objectid import ObjectId
+
+from ...interfaces.mongo_model import MongoModel
+from ...utility.consts import TIME_FORMAT
+from ...utility.enums import JobStatus
+from .conversation_spec import ConversationSpec
+
+
+@dataclass
+class Job(MongoModel):
+    experiment_id: ObjectId
+    spec: ConversationSpec
+    sweep_id: ObjectId | None = None
+    sweep_index: int | None = None
+    status: JobStatus = JobStatus.PENDING
+    worker: str | None = None
+    attempts: int = 0
+    lease_expires_at: datetime | None = None
+    heartbeat_at: datetime | None = None
+    conversation_id: ObjectId | None = None
+    error: str | None = None
+    # num_ctx of the requests, sized for the whole sweep
+    num_ctx: int | None = None
+    id: ObjectId = field(default_factory=ObjectId)
+    creation_date: datetime = field(default_factory=datetime.now)
+
+    def __str__(self) -> str:
+        return (
+            f"Job {self.id} [{self.status.value}] "
+            + f"created {self.creation_date.strftime(TIME_FORMAT)} ({self.spec})"
+        )
+
+    @classmethod
+    def from_document(cls, doc: dict) -> "Job":
+        return cls(
+            id=doc["_id"],
+            experiment_id=doc["experiment_id"],
+            spec=ConversationSpec.from_document(doc["spec"]),
+            sweep_id=doc.get("sweep_id"),
+            sweep_index=doc.get("sweep_index"),
+            status=JobStatus(doc["status"]),
+            worker=doc["worker"],
+            attempts=doc["attempts"],
+            lease_expires_at=doc["lease_expires_at"],
+            heartbeat_at=doc["heartbeat_at"],
+            conversation_id=doc["conversation_id"],
+            error=doc["error"],
+            num_ctx=doc.get("num_ctx"),
+            creation_date=doc["creation_date"],
+        )
+
+    def to_document(self) -> dict:
+        return {
+            "_id": self.id,
+            "experiment_id": self.experiment_id,
+            "spec": self.spec.to_document(),
+            "sweep_id": self.sweep_id,
+            "sweep_index": self.sweep_index,
+            "status": self.status.value,
+            "worker": self.worker,
+            "attempts": self.attempts,
+            "lease_expires_at": self.lease_expires_at,
+            "heartbeat_at": self.heartbeat_at,
+            "conversation_id": self.conversation_id,
+            "error": self.error,
+            "num_ctx": self.num_ctx,
+            "creation_date": self.creation_date,
+        }
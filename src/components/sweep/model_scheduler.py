@@ -0,0 +1,300 @@
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from urllib.parse import urlsplit
+
+import httpx
+import ollama
+from itakello_logging import ItakelloLogging
+
+from ...utility.custom_os import CustomOS
+from ..experiment.experiment import Experiment
+from ..llm.endpoint_pool import EndpointPool
+from ..llm.llm import LLM
+from ..llm.model_registry import ModelRegistry
+from .conversation_spec import ConversationSpec
+
+logger = ItakelloLogging().get_logger(__name__)
+
+# Ollama needs some memory on top of the weights (KV cache, graph buffers)
+MODEL_MEMORY_OVERHEAD = 1.2
+# Requests through the OpenAI API reset the keep-alive of a model to the
+# server default, so the pinned models are touched again this often
+KEEP_ALIVE_REFRESH_SECONDS = 60.0
+# Hosts of the Ollama servers that run on this machine
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "::1", "0.0.0.0")
+
+
+@dataclass
+class ModelGroup:
+    model: str
+    size: int
+    local: bool = True
+    # Ollama options the requests are sent with (only the native API honours
+    # them), the model is loaded with them
+    options: dict = field(default_factory=dict)
+    # Any LLM of the group, they all send their requests to the same model
+    llm: LLM | None = None
+    specs: list[ConversationSpec] = field(default_factory=list)
+
+    def __str__(self) -> str:
+        if not self.local:
+            return f"{self.model} ({len(self.specs)} conversations)"
+        return f"{self.model} ({self.size / 1e9:.1f} GB, {len(self.specs)} conversations)"
+
+
+@dataclass
+class ModelWave:
+    groups: list[ModelGroup] = field(default_factory=list)
+
+    @property
+    def specs(self) -> list[ConversationSpec]:
+        return [spec for group in self.groups for spec in group.specs]
+
+    @property
+    def size(self) -> int:
+        return sum(group.size for group in self.groups)
+
+    @property
+    def local_groups(self) -> list[ModelGroup]:
+        return [group for group in self.groups if group.local]
+
+    @property
+    def local_models(self) -> list[str]:
+        return [group.model for group in self.local_groups]
+
+    def __str__(self) -> str:
+        return ", ".join(str(group) for group in self.groups)
+
+
+@dataclass
+class ModelScheduler:
+    """
+    Orders the conversations of a sweep so that Ollama does not keep swapping
+    models in and out of memory.
+
+    Conversations are grouped by the model their requests are sent to and the
+    groups are packed into waves of models that fit together in memory. A wave
+    is drained completely before the models of the next one are loaded, and
+    the time spent loading them is kept apart from the generation time.
+    OpenAI models take no memory and fit in any wave.
+
+    Before a wave starts its models are pulled if needed and warmed up, so no
+    conversation pays for a cold model. They are kept resident with
+    ``keep_alive`` while the wave runs and unloaded once it is drained,
+    unless they were already loaded before. With a pool of Ollama servers,
+    a model is loaded and unloaded on the servers its requests are routed to.
+    """
+
+    memory_budget: int | None = None
+    # The budget is the free memory of this machine, which does not count
+    # the models its Ollama server already loaded
+    free_memory: bool = False
+    max_loaded_models: int = 3
+    keep_alive: str = "30m"
+    unload: bool = True
+
+    load_time: float = field(init=False, default=0.0)
+    generation_time: float = field(init=False, default=0.0)
+    loads: int = field(init=False, default=0)
+    _loaded: list[str] = field(init=False, default_factory=list)
+    _stop_pinning: threading.Event = field(init=False, default_factory=threading.Event)
+    _pinning: threading.Thread | None = field(init=False, default=None)
+
+    def plan(
+        self, experiment: Experiment, specs: list[ConversationSpec]
+    ) -> list[ModelWave]:
+        memory_budget = self.memory_budget
+        if not any(experiment.llms[spec.llm_name].is_local for spec in specs):
+            model_sizes = {}
+        else:
+            model_sizes = self._get_model_sizes()
+            if self.free_memory and memory_budget is not None:
+                # They are unloaded when other models need their memory
+                memory_budget += self._get_loaded_size()
+        groups: dict[str, ModelGroup] = {}
+        for spec in specs:
+            llm = experiment.llms[spec.llm_name]
+            model = llm.resolved_model
+            if model not in groups:
+                groups[model] = ModelGroup(
+                    model=model,
+                    size=model_sizes.get(model, 0),
+                    local=llm.is_local,
+                    options=llm.options if llm.backend == "ollama" else {},
+                    llm=llm,
+                )
+            groups[model].specs.append(spec)
+        waves: list[ModelWave] = []
+        for group in groups.values():
+            wave = next(
+                (wave for wave in waves if self._fits(wave, group, memory_budget)),
+                None,
+            )
+            if wave is None:
+                wave = ModelWave()
+                waves.append(wave)
+            wave.groups.append(group)
+        return waves
+
+    def load(self, wave: ModelWave) -> None:
+        if not wave.local_models:
+            return
+        loaded = self._get_loaded_models()
+        for group in wave.local_groups:
+            model = group.model
+            start_time = time.monotonic()
+            try:
+                # Pulls and model creations also count as loading time
+                if group.llm is not None:
+                    group.llm.ensure_available()
+                # Also applies the keep-alive to the models already loaded
+                self._touch(group)
+            except (ConnectionError, httpx.HTTPError, ollama.ResponseError) as e:
+                logger.warning(f"Could not preload model [{model}]: {e}")
+                continue
+            if model in loaded:
+                continue
+            elapsed = time.monotonic() - start_time
+            self.load_time += elapsed
+            self.loads += 1
+            self._loaded.append(model)
+            logger.info(f"Model [{model}] loaded in {elapsed:.1f}s")
+        self._pin(wave)
+
+    def release(self, wave: ModelWave) -> None:
+        self._unpin()
+        if not self.unload:
+            return
+        for group in wave.local_groups:
+            if group.model not in self._loaded:
+                continue
+            try:
+                for endpoint in EndpointPool.get_instance().get_endpoints(group.model):
+                    endpoint.client.generate(model=group.model, prompt="", keep_alive=0)
+            except (ConnectionError, httpx.HTTPError, ollama.ResponseError) as e:
+                logger.warning(f"Could not unload model [{group.model}]: {e}")
+                continue
+            self._loaded.remove(group.model)
+            logger.debug(f"Model [{group.model}] unloaded")
+
+    def _touch(self, group: ModelGroup) -> None:
+        # An empty prompt only loads the model into memory. A different
+        # context length than the requests' would load it again
+        for endpoint in EndpointPool.get_instance().get_endpoints(group.model):
+            endpoint.client.generate(
+                model=group.model,
+                prompt="",
+                options=group.options,
+                keep_alive=self.keep_alive,
+            )
+
+    def _pin(self, wave: ModelWave) -> None:
+        self._stop_pinning.clear()
+        self._pinning = threading.Thread(
+            target=self._pin_loop, args=(wave,), name="model-pinning", daemon=True
+        )
+        self._pinning.start()
+
+    def _pin_loop(self, wave: ModelWave) -> None:
+        while not self._stop_pinning.wait(KEEP_ALIVE_REFRESH_SECONDS):
+            for group in wave.local_groups:
+                try:
+                    self._touch(group)
+                except (ConnectionError, httpx.HTTPError, ollama.ResponseError) as e:
+                    logger.debug(f"Could not refresh the keep-alive of [{group.model}]: {e}")
+
+    def _unpin(self) -> None:
+        if self._pinning is None:
+            return
+        self._stop_pinning.set()
+        self._pinning.join()
+        self._pinning = None
+
+    def add_generation_time(self, elapsed: float) -> None:
+        self.generation_time += elapsed
+
+    def report(self) -> None:
+        total_time = self.load_time + self.generation_time
+        if not total_time:
+            return
+        logger.info(
+            f"Model loads: {self.loads} in {self.load_time:.1f}s | "
+            + f"generation: {self.generation_time:.1f}s | "
+            + f"loading share: {100 * self.load_time / total_time:.1f}%"
+        )
+
+    def _fits(
+        self, wave: ModelWave, group: ModelGroup, memory_budget: int | None
+    ) -> bool:
+        if not group.local:
+            return True
+        if len(wave.local_models) >= self.max_loaded_models:
+            return False
+        if memory_budget is None:
+            return True
+        required = (wave.size + group.size) * MODEL_MEMORY_OVERHEAD
+        return required <= memory_budget
+
+    def _get_model_sizes(self) -> dict[str, int]:
+        try:
+            return ModelRegistry.get_sizes()
+        except (ConnectionError, httpx.HTTPError, ollama.ResponseError) as e:
+            logger.warning(f"Could not read the model sizes from Ollama: {e}")
+            return {}
+
+    def _get_loaded_models(self) -> list[str]:
+        # Loaded on any server of the pool
+        loaded: list[str] = []
+        for endpoint in EndpointPool.get_instance().get_endpoints():
+            try:
+                models = endpoint.client.ps()["models"] or []
+            except (ConnectionError, httpx.HTTPError, ollama.ResponseError):
+                continue
+            loaded.extend(model["model"] for model in models)
+        return list(dict.fromkeys(loaded))
+
+    def _get_loaded_size(self) -> int:
+        # Memory of the models loaded by the Ollama servers of this machine
+        size = 0
+        for endpoint in EndpointPool.get_instance().get_endpoints():
+            if urlsplit(endpoint.url).hostname not in LOCAL_HOSTS:
+                continue
+            try:
+                models = endpoint.client.ps()["models"] or []
+            except (ConnectionError, httpx.HTTPError, ollama.ResponseError):
+                continue
+            size += sum(model["size"] for model in models)
+        return size
+
+    @classmethod
+    def from_env(cls) -> "ModelScheduler":
+        """
+        OLLAMA_MEMORY_GB sets the memory available to the models (by default,
+        the free memory of this machine plus the models its Ollama server
+        already loaded) and OLLAMA_MAX_LOADED_MODELS how
+        many of them can be loaded at the same time (3, as in Ollama).
+        SWEEP_KEEP_ALIVE sets how long the models of a wave stay loaded
+        without requests (30m) and SWEEP_UNLOAD_MODELS=n keeps them loaded
+        after their wave.
+        """
+        memory_gb = CustomOS.getenv("OLLAMA_MEMORY_GB", "")
+        if memory_gb:
+            memory_budget = int(float(memory_gb) * 1e9)
+        else:
+            memory_budget = cls._get_available_memory()
+        return cls(
+            memory_budget=memory_budget,
+            free_memory=not memory_gb,
+            max_loaded_models=int(CustomOS.getenv("OLLAMA_MAX_LOADED_MODELS", "3")),
+            keep_alive=CustomOS.getenv("SWEEP_KEEP_ALIVE", "30m"),
+            unload=CustomOS.getenv("SWEEP_UNLOAD_MODELS", "y") != "n",
+        )
+
+    @staticmethod
+    def _get_available_memory() -> int | None:
+        try:
+            return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+        except (ValueError, OSError, AttributeError):
+            return None
@@ -0,0 +1,84 @@
+from dataclasses import dataclass
+
+from ...interfaces.mongo_model import MongoModel
+from ..conversation.conversation import Conversation
+from ..conversation.message import Message
+from ..llm.rate_limiter import estimate_tokens
+
+
+@dataclass
+class ModelStats(MongoModel):
+    """
+    Totals of the conversations performed with a model, used to estimate
+    the length and duration of future ones. Tokens are estimated from the
+    text, like the limiter does. Each conversation stores its own share,
+    summed by model when read, so that deleting it also removes its share.
+    """
+
+    model: str
+    conversations: int = 0
+    seconds: float = 0.0
+    replies: int = 0
+    reply_tokens: int = 0
+    summaries: int = 0
+    summary_tokens: int = 0
+
+    @property
+    def avg_reply_tokens(self) -> float | None:
+        return self.reply_tokens / self.replies if self.replies else None
+
+    @property
+    def avg_summary_tokens(self) -> float | None:
+        return self.summary_tokens / self.summaries if self.summaries else None
+
+    @property
+    def tokens_per_second(self) -> float | None:
+        # Generated tokens per second of a single conversation, waits included
+        if not self.seconds:
+            return None
+        return (self.reply_tokens + self.summary_tokens) / self.seconds
+
+    @classmethod
+    def from_conversation(
+        cls,
+        model: str,
+        conversation: Conversation,
+        messages: list[Message],
+        seconds: float,
+    ) -> "ModelStats":
+        # The first message of every day is the researcher's, not generated
+        replies = [message for message in messages if message.index > 0]
+        days = sorted({message.day for message in messages})
+        summaries = [conversation.summaries[day - 1] for day in days]
+        return cls(
+            model=model,
+            conversations=1,
+            seconds=seconds,
+            replies=len(replies),
+            reply_tokens=sum(estimate_tokens(message.content) for message in replies),
+            summaries=len(summaries),
+            summary_tokens=sum(estimate_tokens(summary) for summary in summaries),
+        )
+
+    @classmethod
+    def from_document(cls, doc: dict) -> "ModelStats":
+        return cls(
+            model=doc["_id"],
+            conversations=doc["conversations"],
+            seconds=doc["seconds"],
+            replies=doc["replies"],
+            reply_tokens=doc["reply_tokens"],
+            summaries=doc["summaries"],
+            summary_tokens=doc["summary_tokens"],
+        )
+
+    def to_document(self) -> dict:
+        return {
+            "_id": self.model,
+            "conversations": self.conversations,
+            "seconds": self.seconds,
+            "replies": self.replies,
+            "reply_tokens": self.reply_tokens,
+            "summaries": self.summaries,
+            "summary_tokens": self.summary_tokens,
+        }
@@ -0,0 +1,119 @@
+from dataclasses import dataclass, field
+from datetime import datetime
+
+from bson.objectid import ObjectId
+
+from ...interfaces.mongo_model import MongoModel
+from ...utility.consts import TIME_FORMAT
+from .conversation_spec import ConversationSpec
+
+
+@dataclass
+class Sweep(MongoModel):
+    experiment_id: ObjectId
+    specs: list[ConversationSpec]
+    n_replicates: int
+    creator: str
+    # Index of the completed spec -> ID of the conversation that fulfilled it
+    completed: dict[int, ObjectId] = field(default_factory=dict)
+    # Index of the spec -> ID of its checkpointed, not yet completed, conversation
+    in_progress: dict[int, ObjectId] = field(default_factory=dict)
+    # Model -> num_ctx of its requests, the same for every worker of the sweep
+    num_ctx: dict[str, int] = field(default_factory=dict)
+    id: ObjectId = field(default_factory=ObjectId)
+    creation_date: datetime = field(default_factory=datetime.now)
+
+    @classmethod
+    def from_grid(
+        cls,
+        experiment_id: ObjectId,
+        creator: str,
+        llm_names: list[str],
+        n_messages: int,
+        days_list: list[int],
+        agent_combinations: list[list[tuple[str, int]]],
+        speaker_selection_method: str,
+        n_replicates: int,
+    ) -> "Sweep":
+        specs = [
+            ConversationSpec(
+                llm_name=llm_name,
+                n_messages=n_messages,
+                days=days,
+                agent_combination=agent_combination,
+                speaker_selection_method=speaker_selection_method,
+                replicate=replicate,
+            )
+            for llm_name in llm_names
+            for days in days_list
+            for agent_combination in agent_combinations
+            for replicate in range(n_replicates)
+        ]
+        return cls(
+            experiment_id=experiment_id,
+            specs=specs,
+            n_replicates=n_replicates,
+            creator=creator,
+        )
+
+    @property
+    def missing_specs(self) -> list[ConversationSpec]:
+        return [
+            spec for i, spec in enumerate(self.specs) if i not in self.completed
+        ]
+
+    def spec_index(self, spec: ConversationSpec) -> int:
+        return self.specs.index(spec)
+
+    def to_selection(self) -> str:
+        llms = ", ".join(dict.fromkeys(spec.llm_name for spec in self.specs))
+        days = ", ".join(str(day) for day in dict.fromkeys(spec.days for spec in self.specs))
+        return (
+            f"Completed: {len(self.completed)}/{len(self.specs)}\t"
+            + f"Creator: {self.creator} [{self.creation_date.strftime(TIME_FORMAT)}]\t"
+            + f"LLMs: {llms}\t"
+            + f"Days: {days}\t"
+            + f"Replicates: {self.n_replicates}\t"
+        )
+
+    @classmethod
+    def from_document(cls, doc: dict) -> "Sweep":
+        return cls(
+            id=doc["_id"],
+            experiment_id=doc["experiment_id"],
+            specs=[ConversationSpec.from_document(spec) for spec in doc["specs"]],
+            n_replicates=doc["n_replicates"],
+            creator=doc["creator"],
+            completed={
+                cell["index"]: cell["conversation_id"] for cell in doc["completed"]
+            },
+            in_progress={
+                cell["index"]: cell["conversation_id"]
+                for cell in doc.get("in_progress", [])
+            },
+            num_ctx={cell["model"]: cell["num_ctx"] for cell in doc.get("num_ctx", [])},
+            creation_date=doc["creation_date"],
+        )
+
+    def to_document(self) -> dict:
+        return {
+            "_id": self.id,
+            "experiment_id": self.experiment_id,
+            "specs": [spec.to_document() for spec in self.specs],
+            "n_replicates": self.n_replicates,
+            "creator": self.creator,
+            "completed": [
+                {"index": index, "conversation_id": conversation_id}
+                for index, conversation_id in self.completed.items()
+            ],
+            "in_progress": [
+                {"index": index, "conversation_id": conversation_id}
+                for index, conversation_id in self.in_progress.items()
+            ],
+            # Model names may contain dots, which cannot be keys
+            "num_ctx": [
+                {"model": model, "num_ctx": num_ctx}
+                for model, num_ctx in self.num_ctx.items()
+            ],
+            "creation_date": self.creation_date,
+        }
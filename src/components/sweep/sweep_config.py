@@ -0,0 +1,173 @@
+import json
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import yaml
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from itakello_logging import ItakelloLogging
+
+from ..experiment.experiment import Experiment
+from ..section.section_manager import SectionManager
+from .sweep import Sweep
+from .sweep_executor import ENGINE_TYPES, EXECUTOR_TYPES
+
+logger = ItakelloLogging().get_logger(__name__)
+
+SPEAKER_SELECTION_METHODS = ("auto", "random", "round_robin")
+
+
+@dataclass
+class SweepConfig:
+    """
+    Declarative description of a sweep, read from a YAML or JSON file by
+    ``run_sweep.py``. It holds the same settings the interactive prompts ask
+    for, plus the way the conversations are run.
+
+    The agents are given either as ``agent_combinations``, a list of
+    ``{role: number}`` mappings, or as the maximum number of agents per role
+    in ``agents``, optionally expanded to every combination.
+    """
+
+    experiment_id: ObjectId
+    llms: list[str]
+    total_messages: int
+    days: list[int]
+    speaker_selection_method: str = "auto"
+    replicates: int = 1
+    agents: dict[str, int] = field(default_factory=dict)
+    try_each_combination: bool = False
+    agent_combinations: list[dict[str, int]] = field(default_factory=list)
+    engine: str = "autogen"
+    max_workers: int = 1
+    executor_type: str = "thread"
+    adaptive: bool = False
+    # False to regenerate every response even when LLM_CACHE is enabled
+    cache: bool = True
+    # Async engine only: the LLM calls go through a Batch API (see BATCH_API)
+    batch: bool = False
+    # Set to resume the missing conversations of an existing sweep
+    sweep_id: ObjectId | None = None
+
+    @classmethod
+    def from_file(cls, path: str | Path) -> "SweepConfig":
+        path = Path(path)
+        with open(path, "r") as file:
+            if path.suffix == ".json":
+                doc = json.load(file)
+            else:
+                doc = yaml.safe_load(file)
+        if not isinstance(doc, dict):
+            raise ValueError(f"The sweep spec {path} must be a mapping")
+        return cls.from_document(doc)
+
+    @classmethod
+    def from_document(cls, doc: dict) -> "SweepConfig":
+        doc = dict(doc)
+        try:
+            doc["experiment_id"] = ObjectId(doc["experiment_id"])
+            if doc.get("sweep_id") is not None:
+                doc["sweep_id"] = ObjectId(doc["sweep_id"])
+            if isinstance(doc.get("llms"), str):
+                doc["llms"] = [doc["llms"]]
+            if isinstance(doc.get("days"), int):
+                doc["days"] = [doc["days"]]
+            return cls(**doc)
+        except (KeyError, TypeError, InvalidId) as e:
+            raise ValueError(f"Invalid sweep spec: {e}") from e
+
+    def validate(self, experiment: Experiment) -> None:
+        # The other checks compare the values, they need the right types
+        errors = self._get_type_errors()
+        if errors:
+            raise ValueError("Invalid sweep spec:\n- " + "\n- ".join(errors))
+        missing_llms = [llm for llm in self.llms if llm not in experiment.llms]
+        if missing_llms:
+            errors.append(
+                f"LLMs {missing_llms} are not in the experiment (available: {list(experiment.llms)})"
+            )
+        if self.total_messages <= 0 or self.total_messages % 2:
+            errors.append(f"total_messages must be even and positive [{self.total_messages}]")
+        for days in self.days:
+            if not 0 < days <= self.total_messages // 2:
+                errors.append(f"Invalid number of days [{days}]")
+        if self.speaker_selection_method not in SPEAKER_SELECTION_METHODS:
+            errors.append(
+                f"speaker_selection_method must be one of {SPEAKER_SELECTION_METHODS}"
+            )
+        if self.replicates <= 0:
+            errors.append(f"replicates must be positive [{self.replicates}]")
+        if self.agents and self.agent_combinations:
+            errors.append("Set either agents or agent_combinations, not both")
+        for combination in self.agent_combinations or [self.agents]:
+            missing_roles = [role for role in combination if role not in experiment.roles]
+            if missing_roles:
+                errors.append(f"Roles {missing_roles} are not in the experiment")
+        if self.engine not in ENGINE_TYPES:
+            errors.append(f"engine must be one of {ENGINE_TYPES}")
+        if self.executor_type not in EXECUTOR_TYPES:
+            errors.append(f"executor_type must be one of {EXECUTOR_TYPES}")
+        if self.batch and self.engine != "async":
+            errors.append("batch needs the async engine")
+        if self.max_workers <= 0:
+            errors.append(f"max_workers must be positive [{self.max_workers}]")
+        if errors:
+            raise ValueError("Invalid sweep spec:\n- " + "\n- ".join(errors))
+
+    def _get_type_errors(self) -> list[str]:
+        errors = []
+
+        def is_int(value: object) -> bool:
+            return isinstance(value, int) and not isinstance(value, bool)
+
+        def is_role_agents(value: object) -> bool:
+            return isinstance(value, dict) and all(
+                isinstance(role, str) and is_int(num) for role, num in value.items()
+            )
+
+        if not isinstance(self.llms, list) or not all(
+            isinstance(llm, str) for llm in self.llms
+        ):
+            errors.append(f"llms must be a list of LLM names [{self.llms!r}]")
+        if not isinstance(self.days, list) or not all(is_int(days) for days in self.days):
+            errors.append(f"days must be a list of integers [{self.days!r}]")
+        for name in ("total_messages", "replicates", "max_workers"):
+            if not is_int(getattr(self, name)):
+                errors.append(f"{name} must be an integer [{getattr(self, name)!r}]")
+        for name in ("try_each_combination", "adaptive", "cache", "batch"):
+            if not isinstance(getattr(self, name), bool):
+                errors.append(f"{name} must be true or false [{getattr(self, name)!r}]")
+        for name in ("speaker_selection_method", "engine", "executor_type"):
+            if not isinstance(getattr(self, name), str):
+                errors.append(f"{name} must be a string [{getattr(self, name)!r}]")
+        if not is_role_agents(self.agents):
+            errors.append(f"agents must map roles to numbers of agents [{self.agents!r}]")
+        if not isinstance(self.agent_combinations, list) or not all(
+            is_role_agents(combination) for combination in self.agent_combinations
+        ):
+            errors.append(
+                "agent_combinations must be a list of mappings of roles to "
+                + f"numbers of agents [{self.agent_combinations!r}]"
+            )
+        return errors
+
+    def get_agent_combinations(
+        self, experiment: Experiment
+    ) -> list[list[tuple[str, int]]]:
+        if self.agent_combinations:
+            return [list(combination.items()) for combination in self.agent_combinations]
+        # Same order as the roles of the experiment, one agent if not given
+        max_nums = [(role, self.agents.get(role, 1)) for role in experiment.roles]
+        return SectionManager.get_agent_combinations(max_nums, self.try_each_combination)
+
+    def to_sweep(self, experiment: Experiment, creator: str) -> Sweep:
+        return Sweep.from_grid(
+            experiment_id=experiment.id,
+            creator=creator,
+            llm_names=self.llms,
+            n_messages=self.total_messages,
+            days_list=self.days,
+            agent_combinations=self.get_agent_combinations(experiment),
+            speaker_selection_method=self.speaker_selection_method,
+            n_replicates=self.replicates,
+        )
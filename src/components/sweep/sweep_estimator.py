@@ -0,0 +1,244 @@
+from dataclasses import dataclass, field
+
+from autogen.oai.client import OAI_PRICE1K
+from itakello_logging import ItakelloLogging
+
+from ...core.database_manager import DatabaseManager
+from ..conversation.chat import Chat
+from ..experiment.experiment import Experiment
+from ..llm.context_window import ContextWindow
+from ..llm.llm import LLM
+from ..llm.rate_limiter import estimate_tokens
+from .conversation_spec import ConversationSpec
+from .model_stats import ModelStats
+from .sweep import Sweep
+from .sweep_executor import _prepare_conversation
+
+logger = ItakelloLogging().get_logger(__name__)
+
+# Used until a model has performed some conversations
+DEFAULT_REPLY_TOKENS = 120
+DEFAULT_SUMMARY_TOKENS = 250
+DEFAULT_TOKENS_PER_SECOND = {"ollama": 15.0, "openai": 50.0}
+# The selector only answers with the name of the next speaker
+SELECTION_COMPLETION_TOKENS = 5
+
+
+@dataclass
+class CellEstimate:
+    """
+    Estimate for the replicates of one cell of the grid (LLM, messages, days,
+    agents and speaker selection method).
+    Cost is None when the price of the model is unknown.
+    """
+
+    spec: ConversationSpec
+    model: str
+    conversations: int = 0
+    calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cost: float | None = 0.0
+    seconds: float = 0.0
+    # Prompt and completion of the largest request of a conversation
+    max_request_tokens: int = 0
+
+    def __str__(self) -> str:
+        agents = ", ".join(
+            f"{role.capitalize()}:{num}" for role, num in self.spec.agent_combination
+        )
+        cost = "n/a" if self.cost is None else f"${self.cost:.4f}"
+        return (
+            f"{self.model} | Days: {self.spec.days} | Agents: {agents} | "
+            + f"Selection: {self.spec.speaker_selection_method} | "
+            + f"x{self.conversations} | calls: {self.calls} | "
+            + f"prompt: {self.prompt_tokens:,} | completion: {self.completion_tokens:,} | "
+            + f"cost: {cost} | time: {_format_duration(self.seconds)}"
+        )
+
+    def to_document(self) -> dict:
+        return {
+            "llm_name": self.spec.llm_name,
+            "model": self.model,
+            "days": self.spec.days,
+            "agent_combination": self.spec.agent_combination,
+            "speaker_selection_method": self.spec.speaker_selection_method,
+            "conversations": self.conversations,
+            "calls": self.calls,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cost": self.cost,
+            "seconds": round(self.seconds, 1),
+        }
+
+
+@dataclass
+class SweepEstimator:
+    """
+    Dry run of a sweep: estimates tokens, cost and time of every cell without
+    calling any LLM.
+
+    Each conversation is replayed on paper. Every reply sends the agent's
+    system message, the researcher message (starting message plus the
+    previous daily summaries) and the replies of the day so far. In ``auto``
+    mode every turn also has a speaker selection request, and every day ends
+    with a summary request. Reply and summary lengths and the generation
+    speed come from the conversations already performed with each model,
+    or from defaults when there are none.
+    """
+
+    db_m: DatabaseManager
+
+    model_stats: dict[str, ModelStats] = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.model_stats = self.db_m.get_model_stats()
+
+    def estimate(
+        self, experiment: Experiment, specs: list[ConversationSpec]
+    ) -> list[CellEstimate]:
+        cells: dict[tuple, CellEstimate] = {}
+        for spec in specs:
+            key = (
+                spec.llm_name,
+                spec.n_messages,
+                spec.days,
+                tuple(spec.agent_combination),
+                spec.speaker_selection_method,
+            )
+            if key not in cells:
+                cells[key] = self._estimate_cell(experiment, spec)
+            cells[key].conversations += 1
+        estimates = list(cells.values())
+        for estimate in estimates:
+            # Per conversation until now, scaled by the replicates
+            estimate.calls *= estimate.conversations
+            estimate.prompt_tokens *= estimate.conversations
+            estimate.completion_tokens *= estimate.conversations
+            estimate.seconds *= estimate.conversations
+            if estimate.cost is not None:
+                estimate.cost *= estimate.conversations
+        return estimates
+
+    def size_context(self, experiment: Experiment, sweep: Sweep) -> bool:
+        """
+        Sets the num_ctx of the local models of the sweep, from its largest
+        estimated request. Once per sweep, so that its workers all send the
+        same: returns False when the sweep was already sized.
+        """
+        if sweep.num_ctx:
+            return False
+        for estimate in self.estimate(experiment, sweep.specs):
+            llm = experiment.llms[estimate.spec.llm_name]
+            # Only sent with the requests, the derived models have their own
+            if "num_ctx" not in llm.options:
+                continue
+            sweep.num_ctx[estimate.model] = max(
+                sweep.num_ctx.get(estimate.model, 0),
+                ContextWindow.get_num_ctx(estimate.max_request_tokens),
+            )
+        if sweep.num_ctx:
+            logger.info(
+                "Context of the models: "
+                + ", ".join(f"{model}: {n}" for model, n in sweep.num_ctx.items())
+            )
+        return True
+
+    def log_estimates(self, estimates: list[CellEstimate], max_workers: int) -> dict:
+        for estimate in estimates:
+            logger.info(str(estimate))
+        costs = [estimate.cost for estimate in estimates]
+        total = {
+            "conversations": sum(estimate.conversations for estimate in estimates),
+            "calls": sum(estimate.calls for estimate in estimates),
+            "prompt_tokens": sum(estimate.prompt_tokens for estimate in estimates),
+            "completion_tokens": sum(
+                estimate.completion_tokens for estimate in estimates
+            ),
+            "cost": None if None in costs else sum(costs),  # type: ignore
+            # Conversations run side by side, as long as the backends keep up
+            "wall_seconds": sum(estimate.seconds for estimate in estimates)
+            / max_workers,
+        }
+        cost = "n/a" if total["cost"] is None else f"${total['cost']:.4f}"
+        logger.info(
+            f"Total: {total['conversations']} conversations | calls: {total['calls']:,} | "
+            + f"prompt: {total['prompt_tokens']:,} | completion: {total['completion_tokens']:,} | "
+            + f"cost: {cost} | wall time with {max_workers} workers: "
+            + f"{_format_duration(total['wall_seconds'])}"
+        )
+        return {
+            "cells": [estimate.to_document() for estimate in estimates],
+            "total": total,
+        }
+
+    def _estimate_cell(
+        self, experiment: Experiment, spec: ConversationSpec
+    ) -> CellEstimate:
+        llm = experiment.llms[spec.llm_name]
+        stats = self.model_stats.get(llm.resolved_model)
+        reply_tokens = (stats and stats.avg_reply_tokens) or DEFAULT_REPLY_TOKENS
+        summary_tokens = (stats and stats.avg_summary_tokens) or DEFAULT_SUMMARY_TOKENS
+        # Same agents and summarizer the conversation would use
+        conversation, agents, summarizer = _prepare_conversation(
+            experiment, spec, creator="", conversation=None
+        )
+        system_tokens = sum(
+            estimate_tokens(agent.system_message) for agent in agents
+        ) / len(agents)
+        summarizer_tokens = estimate_tokens(summarizer.system_message_oai["content"])
+        selection_tokens = 0
+        if spec.speaker_selection_method == "auto":
+            chat = Chat(agents=agents, selection_method="auto")
+            selection_tokens = estimate_tokens(
+                chat.select_speaker_msg(chat.agents)
+                + chat.select_speaker_prompt(chat.agents)
+            )
+        replies = conversation.n_messages // conversation.days - 1
+        estimate = CellEstimate(spec=spec, model=llm.resolved_model)
+        start_tokens = estimate_tokens(conversation.starting_message)
+        for _ in range(conversation.days):
+            for reply in range(replies):
+                history = start_tokens + reply * reply_tokens
+                self._add_call(estimate, system_tokens + history, reply_tokens)
+                if selection_tokens:
+                    self._add_call(
+                        estimate, selection_tokens + history, SELECTION_COMPLETION_TOKENS
+                    )
+            # The summarizer reads the replies of the day, without the researcher
+            self._add_call(estimate, summarizer_tokens + replies * reply_tokens, summary_tokens)
+            start_tokens += summary_tokens
+        estimate.cost = self._get_cost(llm, estimate)
+        estimate.seconds = estimate.completion_tokens / self._get_speed(llm, stats)
+        return estimate
+
+    def _add_call(self, estimate: CellEstimate, prompt: float, completion: float) -> None:
+        estimate.calls += 1
+        estimate.max_request_tokens = max(
+            estimate.max_request_tokens, int(prompt + completion)
+        )
+        estimate.prompt_tokens += int(prompt)
+        estimate.completion_tokens += int(completion)
+
+    def _get_cost(self, llm: LLM, estimate: CellEstimate) -> float | None:
+        price = llm.config.get("price", OAI_PRICE1K.get(llm.resolved_model))
+        if price is None:
+            return None
+        if isinstance(price, (int, float)):
+            price = (price, price)
+        prompt_price, completion_price = price
+        return (
+            estimate.prompt_tokens * prompt_price
+            + estimate.completion_tokens * completion_price
+        ) / 1000
+
+    def _get_speed(self, llm: LLM, stats: ModelStats | None) -> float:
+        if stats is not None and stats.tokens_per_second:
+            return stats.tokens_per_second
+        return DEFAULT_TOKENS_PER_SECOND["openai" if llm.is_openai else "ollama"]
+
+
+def _format_duration(seconds: float) -> str:
+    hours, remainder = divmod(int(seconds), 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return f"{hours}h {minutes:02d}m {seconds:02d}s"
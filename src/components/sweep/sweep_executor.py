@@ -0,0 +1,471 @@
+import asyncio
+import time
+from concurrent.futures import (
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
+from dataclasses import dataclass, field
+from typing import Callable
+
+from itakello_logging import ItakelloLogging
+
+from ...core.database_manager import DatabaseManager
+from ...utility.enums import ConversationStatus
+from ..conversation.agent import CustomAgent
+from ..conversation.conversation import Conversation
+from ..conversation.message import Message
+from ..conversation.summarizer import Summarizer
+from ..experiment.experiment import Experiment
+from ..llm.batch_client import BatchClient
+from ..llm.context_window import ContextWindow
+from ..llm.endpoint_pool import EndpointPool
+from ..llm.hedger import Hedger
+from ..llm.prompt_stats import PromptStats
+from ..llm.rate_limiter import RateLimiter
+from ..llm.retry_policy import RetryPolicy
+from ..llm.response_cache import ResponseCache
+from .conversation_spec import ConversationSpec
+from .model_scheduler import ModelScheduler
+from .model_stats import ModelStats
+from .sweep import Sweep
+
+logger = ItakelloLogging().get_logger(__name__)
+
+EXECUTOR_TYPES = ("thread", "process")
+
+ENGINE_TYPES = ("autogen", "async")
+
+
+Checkpoint = Callable[[Conversation, list[Message]], None]
+
+
+def _prepare_conversation(
+    experiment: Experiment,
+    spec: ConversationSpec,
+    creator: str,
+    conversation: Conversation | None,
+) -> tuple[Conversation, list[CustomAgent], Summarizer]:
+    conv_llm = experiment.llms[spec.llm_name]
+    if conversation is None:
+        conversation = Conversation(
+            n_messages=spec.n_messages,
+            speaker_selection_method=spec.speaker_selection_method,
+            starting_message=experiment.starting_message,
+            creator=creator,
+            days=spec.days,
+            llm=conv_llm,
+            agent_combination=spec.agent_combination,
+        )
+    else:
+        logger.info(
+            f"Resuming conversation {conversation.id} after day {conversation.completed_days}/{conversation.days}"
+        )
+    placeholders = experiment.compose_placeholders(spec.agent_combination)
+    conv_agents = conversation.generate_agents(experiment, placeholders)
+    summarizer = Summarizer(
+        sections=list(experiment.summarizer_sections.values()),
+        placeholders=placeholders,
+        llm=conv_llm,
+    )
+    return conversation, conv_agents, summarizer
+
+
+def perform_conversation(
+    experiment: Experiment,
+    spec: ConversationSpec,
+    creator: str,
+    silent: bool,
+    conversation: Conversation | None = None,
+    checkpoint: Checkpoint | None = None,
+) -> tuple[Conversation, list[Message]]:
+    # Module-level so that it can be pickled and sent to a process pool
+    experiment.llms[spec.llm_name].ensure_available()
+    conversation, conv_agents, summarizer = _prepare_conversation(
+        experiment, spec, creator, conversation
+    )
+    messages = conversation.perform(
+        agents=conv_agents,
+        summarizer=summarizer,
+        llm_manager=conversation.llm,
+        silent=silent,
+        checkpoint=checkpoint,
+    )
+    return conversation, messages
+
+
+async def aperform_conversation(
+    experiment: Experiment,
+    spec: ConversationSpec,
+    creator: str,
+    conversation: Conversation | None = None,
+    checkpoint: Checkpoint | None = None,
+) -> tuple[Conversation, list[Message]]:
+    # Pulling or creating a model blocks, so it runs outside the event loop
+    await asyncio.to_thread(experiment.llms[spec.llm_name].ensure_available)
+    conversation, conv_agents, summarizer = _prepare_conversation(
+        experiment, spec, creator, conversation
+    )
+    messages = await conversation.aperform(
+        agents=conv_agents,
+        summarizer=summarizer,
+        llm_manager=conversation.llm,
+        checkpoint=checkpoint,
+    )
+    return conversation, messages
+
+
+def _perform_conversation_timed(
+    experiment: Experiment,
+    spec: ConversationSpec,
+    creator: str,
+    progress: str,
+    conversation: Conversation | None,
+    checkpoint: Checkpoint | None,
+) -> tuple[Conversation, list[Message], float]:
+    logger.info(f"{progress} Started conversation ({spec})")
+    start_time = time.monotonic()
+    conversation, messages = perform_conversation(
+        experiment, spec, creator, True, conversation, checkpoint
+    )
+    return conversation, messages, time.monotonic() - start_time
+
+
+@dataclass
+class SweepExecutor:
+    db_m: DatabaseManager
+    max_workers: int = 1
+    executor_type: str = "thread"
+    engine: str = "autogen"
+    scheduler: ModelScheduler = field(default_factory=ModelScheduler.from_env)
+    adaptive: bool = False
+    # False to regenerate every response even when LLM_CACHE is enabled
+    use_cache: bool = True
+    # Async engine only: the LLM calls go through a Batch API
+    batch: bool = False
+
+    def __post_init__(self) -> None:
+        assert self.executor_type in EXECUTOR_TYPES, logger.error(
+            f"Invalid executor type [{self.executor_type}]"
+        )
+        assert self.engine in ENGINE_TYPES, logger.error(
+            f"Invalid conversation engine [{self.engine}]"
+        )
+        assert self.max_workers > 0, logger.error(
+            f"Invalid number of workers [{self.max_workers}]"
+        )
+        assert not self.batch or self.engine == "async", logger.error(
+            "Batch mode needs the async engine"
+        )
+
+    def run(
+        self,
+        experiment: Experiment,
+        specs: list[ConversationSpec],
+        sweep: Sweep | None = None,
+    ) -> int:
+        if sweep is not None:
+            for llm in experiment.llms.values():
+                llm.set_num_ctx(sweep.num_ctx.get(llm.resolved_model))
+        waves = self.scheduler.plan(experiment, specs)
+        saved = 0
+        done = 0
+        if self.adaptive:
+            # The workers are the upper bound of the LLM calls in flight
+            RateLimiter.enable_adaptive(self.max_workers)
+        ResponseCache.set_bypass(not self.use_cache)
+        if self.batch:
+            BatchClient.enable()
+        try:
+            for index_wave, wave in enumerate(waves, start=1):
+                if len(waves) > 1:
+                    logger.info(f"Models wave [{index_wave}/{len(waves)}]: {wave}")
+                self.scheduler.load(wave)
+                try:
+                    start_time = time.monotonic()
+                    saved += self._run_wave(
+                        experiment, wave.specs, sweep, done, len(specs)
+                    )
+                    self.scheduler.add_generation_time(time.monotonic() - start_time)
+                finally:
+                    self.scheduler.release(wave)
+                done += len(wave.specs)
+        finally:
+            if self.adaptive:
+                RateLimiter.disable_adaptive()
+            if self.batch:
+                BatchClient.disable()
+            ResponseCache.set_bypass(False)
+            # Also logged for an interrupted sweep
+            self.scheduler.report()
+            RateLimiter.log_metrics()
+            RetryPolicy.log_metrics()
+            Hedger.log_metrics()
+            EndpointPool.log_metrics()
+            PromptStats.log_metrics()
+            ContextWindow.log_metrics()
+            ResponseCache.log_metrics()
+            self._log_llm_usage(experiment, sweep)
+        return saved
+
+    def _run_wave(
+        self,
+        experiment: Experiment,
+        specs: list[ConversationSpec],
+        sweep: Sweep | None,
+        offset: int,
+        total_conversations: int,
+    ) -> int:
+        if self.engine == "async":
+            return asyncio.run(
+                self._run_async(experiment, specs, sweep, offset, total_conversations)
+            )
+        if self.max_workers == 1:
+            return self._run_sequential(
+                experiment, specs, sweep, offset, total_conversations
+            )
+        return self._run_parallel(experiment, specs, sweep, offset, total_conversations)
+
+    def _run_sequential(
+        self,
+        experiment: Experiment,
+        specs: list[ConversationSpec],
+        sweep: Sweep | None,
+        offset: int,
+        total_conversations: int,
+    ) -> int:
+        saved = 0
+        failed = 0
+        for index_conv, spec in enumerate(specs, start=offset + 1):
+            progress = f"[{index_conv}/{total_conversations}]"
+            logger.info(f"--- Performing conversation {progress} ---\n")
+            self._log_spec(experiment, spec)
+            start_time = time.monotonic()
+            try:
+                conversation, messages = perform_conversation(
+                    experiment,
+                    spec,
+                    self.db_m.username,
+                    silent=False,
+                    conversation=self._get_resumed_conversation(spec, sweep),
+                    checkpoint=self._create_checkpoint(experiment, spec, sweep),
+                )
+            except Exception as e:
+                failed += 1
+                logger.error(f"{progress} Conversation failed ({spec}): {e}")
+                continue
+            saved += 1
+            self._save_result(
+                experiment,
+                spec,
+                conversation,
+                messages,
+                progress,
+                time.monotonic() - start_time,
+                sweep,
+            )
+        if failed:
+            logger.warning(f"{failed}/{len(specs)} conversations failed")
+        return saved
+
+    def _run_parallel(
+        self,
+        experiment: Experiment,
+        specs: list[ConversationSpec],
+        sweep: Sweep | None,
+        offset: int,
+        total_conversations: int,
+    ) -> int:
+        logger.info(
+            f"Performing {len(specs)} conversations with {self.max_workers} {self.executor_type} workers"
+        )
+        saved = 0
+        failed = 0
+        with self._create_executor() as executor:
+            futures: dict[Future, tuple[str, ConversationSpec]] = {}
+            for index_conv, spec in enumerate(specs, start=offset + 1):
+                progress = f"[{index_conv}/{total_conversations}]"
+                # Process workers cannot reach the database, so they do not checkpoint
+                if self.executor_type == "process":
+                    checkpoint = None
+                else:
+                    checkpoint = self._create_checkpoint(experiment, spec, sweep)
+                future = executor.submit(
+                    _perform_conversation_timed,
+                    experiment,
+                    spec,
+                    self.db_m.username,
+                    progress,
+                    self._get_resumed_conversation(spec, sweep),
+                    checkpoint,
+                )
+                futures[future] = (progress, spec)
+            # Saving happens here, in the main thread, as results come back
+            for future in as_completed(futures):
+                progress, spec = futures[future]
+                try:
+                    conversation, messages, elapsed = future.result()
+                except Exception as e:
+                    failed += 1
+                    logger.error(f"{progress} Conversation failed ({spec}): {e}")
+                    continue
+                saved += 1
+                self._save_result(
+                    experiment, spec, conversation, messages, progress, elapsed, sweep
+                )
+                self._log_done(offset + saved + failed, total_conversations)
+        if failed:
+            logger.warning(f"{failed}/{len(specs)} conversations failed")
+        return saved
+
+    async def _run_async(
+        self,
+        experiment: Experiment,
+        specs: list[ConversationSpec],
+        sweep: Sweep | None,
+        offset: int,
+        total_conversations: int,
+    ) -> int:
+        logger.info(
+            f"Performing {len(specs)} conversations on the async engine, {self.max_workers} at a time"
+        )
+        semaphore = asyncio.Semaphore(self.max_workers)
+
+        async def run_one(
+            progress: str, spec: ConversationSpec
+        ) -> tuple[str, ConversationSpec, tuple | Exception, float]:
+            async with semaphore:
+                logger.info(f"{progress} Started conversation ({spec})")
+                start_time = time.monotonic()
+                try:
+                    result = await aperform_conversation(
+                        experiment,
+                        spec,
+                        self.db_m.username,
+                        self._get_resumed_conversation(spec, sweep),
+                        self._create_checkpoint(experiment, spec, sweep),
+                    )
+                except Exception as e:
+                    result = e
+                return progress, spec, result, time.monotonic() - start_time
+
+        tasks = [
+            run_one(f"[{index_conv}/{total_conversations}]", spec)
+            for index_conv, spec in enumerate(specs, start=offset + 1)
+        ]
+        saved = 0
+        failed = 0
+        for task in asyncio.as_completed(tasks):
+            progress, spec, result, elapsed = await task
+            if isinstance(result, Exception):
+                failed += 1
+                logger.error(f"{progress} Conversation failed ({spec}): {result}")
+                continue
+            conversation, messages = result
+            saved += 1
+            self._save_result(
+                experiment, spec, conversation, messages, progress, elapsed, sweep
+            )
+            self._log_done(offset + saved + failed, total_conversations)
+        if failed:
+            logger.warning(f"{failed}/{len(specs)} conversations failed")
+        return saved
+
+    def _log_llm_usage(self, experiment: Experiment, sweep: Sweep | None) -> None:
+        if sweep is not None:
+            usage = self.db_m.get_llm_usage(sweep_id=sweep.id)
+        else:
+            usage = self.db_m.get_llm_usage(experiment_id=experiment.id)
+        for model, totals in usage.items():
+            logger.info(
+                f"LLM usage [{model}] calls: {totals['calls']} | "
+                + f"prompt tokens: {totals['prompt_tokens']:,} "
+                + f"({totals['cached_tokens']:,} from cache"
+                + f"{', estimated' if totals['estimated_calls'] else ''}) | "
+                + f"completion tokens: {totals['completion_tokens']:,} | "
+                + f"latency: {totals['latency']:.1f}s | cache hits: {totals['cache_hits']}"
+            )
+
+    def _save_result(
+        self,
+        experiment: Experiment,
+        spec: ConversationSpec,
+        conversation: Conversation,
+        messages: list[Message],
+        progress: str,
+        elapsed: float,
+        sweep: Sweep | None,
+    ) -> None:
+        conversation_id = self.db_m.save_conversation(
+            experiment=experiment,
+            conversation=conversation,
+            messages=messages,
+            sweep_id=sweep.id if sweep is not None else None,
+        )
+        self.db_m.add_model_stats(
+            ModelStats.from_conversation(
+                conversation.llm.resolved_model, conversation, messages, elapsed
+            ),
+            conversation_id,
+        )
+        if sweep is not None:
+            index = sweep.spec_index(spec)
+            sweep.completed[index] = conversation_id
+            sweep.in_progress.pop(index, None)
+            self.db_m.complete_sweep_spec(sweep.id, index, conversation_id)
+        logger.info(
+            f"{progress} Saved conversation {conversation.id} ({spec}) in {elapsed:.1f}s"
+        )
+
+    def _get_resumed_conversation(
+        self, spec: ConversationSpec, sweep: Sweep | None
+    ) -> Conversation | None:
+        if sweep is None:
+            return None
+        conversation_id = sweep.in_progress.get(sweep.spec_index(spec))
+        if conversation_id is None:
+            return None
+        conversation = self.db_m.get_conversation(conversation_id)
+        if conversation is None or conversation.status != ConversationStatus.IN_PROGRESS:
+            return None
+        return conversation
+
+    def _create_checkpoint(
+        self, experiment: Experiment, spec: ConversationSpec, sweep: Sweep | None
+    ) -> Checkpoint:
+        def checkpoint(conversation: Conversation, messages: list[Message]) -> None:
+            self.db_m.checkpoint_conversation(
+                experiment,
+                conversation,
+                messages,
+                sweep_id=sweep.id if sweep is not None else None,
+            )
+            if sweep is None:
+                return
+            index = sweep.spec_index(spec)
+            if index not in sweep.in_progress:
+                sweep.in_progress[index] = conversation.id
+                self.db_m.start_sweep_spec(sweep.id, index, conversation.id)
+
+        return checkpoint
+
+    def _create_executor(self) -> Executor:
+        if self.executor_type == "process":
+            return ProcessPoolExecutor(max_workers=self.max_workers)
+        return ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="conversation"
+        )
+
+    def _log_done(self, done: int, total_conversations: int) -> None:
+        progress = f"Done: {done}/{total_conversations}"
+        if self.adaptive:
+            progress += f" | {RateLimiter.concurrency_label()}"
+        logger.info(progress)
+
+    def _log_spec(self, experiment: Experiment, spec: ConversationSpec) -> None:
+        conv_llm = experiment.llms[spec.llm_name]
+        logger.info(
+            f"\033[1mLLM\033[0m: {conv_llm}\n\033[1mDays\033[0m: {spec.days}\n\033[1mAgents\033[0m: {spec.agent_combination}\n"
+        )
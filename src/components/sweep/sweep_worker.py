@@ -0,0 +1,268 @@
+import asyncio
+import os
+import socket
+import threading
+import time
+from dataclasses import dataclass, field
+
+from bson.objectid import ObjectId
+from itakello_logging import ItakelloLogging
+
+from ...core.database_manager import DatabaseManager
+from ...utility.enums import ConversationStatus
+from ..conversation.conversation import Conversation
+from ..conversation.message import Message
+from ..experiment.experiment import Experiment
+from ..llm.context_window import ContextWindow
+from ..llm.endpoint_pool import EndpointPool
+from ..llm.hedger import Hedger
+from ..llm.prompt_stats import PromptStats
+from ..llm.rate_limiter import RateLimiter
+from ..llm.retry_policy import RetryPolicy
+from ..llm.response_cache import ResponseCache
+from .job import Job
+from .model_stats import ModelStats
+from .sweep_executor import (
+    ENGINE_TYPES,
+    Checkpoint,
+    aperform_conversation,
+    perform_conversation,
+)
+
+logger = ItakelloLogging().get_logger(__name__)
+
+
+class LeaseLostError(Exception):
+    pass
+
+
+@dataclass
+class SweepWorker:
+    """
+    Pulls conversation jobs from the ``jobs`` collection until it is told to stop.
+
+    Several workers, on the same or on different machines, can share a queue:
+    each job is claimed atomically and its lease is kept alive by a heartbeat
+    thread, so that the jobs of a crashed worker go back to the queue once
+    their lease expires.
+    """
+
+    db_m: DatabaseManager
+    n_threads: int = 1
+    engine: str = "autogen"
+    lease_seconds: int = 300
+    heartbeat_seconds: int = 60
+    poll_seconds: int = 10
+    max_attempts: int = 3
+    exit_when_empty: bool = False
+    adaptive: bool = False
+    use_cache: bool = True
+
+    name: str = field(init=False)
+    completed: int = field(init=False, default=0)
+    failed: int = field(init=False, default=0)
+    _experiments: dict[ObjectId, Experiment] = field(init=False, default_factory=dict)
+    _lock: threading.Lock = field(init=False, default_factory=threading.Lock)
+    _stop: threading.Event = field(init=False, default_factory=threading.Event)
+
+    def __post_init__(self) -> None:
+        assert self.engine in ENGINE_TYPES, logger.error(
+            f"Invalid conversation engine [{self.engine}]"
+        )
+        assert self.heartbeat_seconds < self.lease_seconds, logger.error(
+            "The heartbeat interval must be shorter than the lease"
+        )
+        self.name = f"{socket.gethostname()}-{os.getpid()}"
+
+    def run(self) -> None:
+        logger.info(f"Worker [{self.name}] started with {self.n_threads} threads")
+        if self.adaptive:
+            RateLimiter.enable_adaptive(self.n_threads)
+        ResponseCache.set_bypass(not self.use_cache)
+        threads = [
+            threading.Thread(
+                target=self._work_loop, name=f"{self.name}-{i}", daemon=True
+            )
+            for i in range(self.n_threads)
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(timeout=1)
+        except KeyboardInterrupt:
+            logger.warning("Stopping after the running jobs (press Ctrl+C again to abort)")
+            self.stop()
+            for thread in threads:
+                thread.join()
+        RateLimiter.log_metrics()
+        RetryPolicy.log_metrics()
+        Hedger.log_metrics()
+        EndpointPool.log_metrics()
+        PromptStats.log_metrics()
+        ContextWindow.log_metrics()
+        ResponseCache.log_metrics()
+        logger.confirmation(
+            f"Worker [{self.name}] finished: {self.completed} completed, {self.failed} failed"
+        )
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _work_loop(self) -> None:
+        worker_name = threading.current_thread().name
+        last_llm = None
+        while not self._stop.is_set():
+            self.db_m.release_stale_jobs(self.max_attempts)
+            job = self.db_m.claim_job(worker_name, self.lease_seconds, last_llm)
+            if job is None:
+                if self.exit_when_empty:
+                    break
+                self._stop.wait(self.poll_seconds)
+                continue
+            self._run_job(job)
+            last_llm = job.spec.llm_name
+
+    def _run_job(self, job: Job) -> None:
+        logger.info(f"[{job.worker}] Running {job} (attempt {job.attempts})")
+        lease_lost = threading.Event()
+        job_done = threading.Event()
+        heartbeat = threading.Thread(
+            target=self._heartbeat_loop,
+            args=(job, job_done, lease_lost),
+            daemon=True,
+        )
+        heartbeat.start()
+        start_time = time.monotonic()
+        try:
+            experiment = self._get_experiment(job.experiment_id)
+            experiment.llms[job.spec.llm_name].set_num_ctx(job.num_ctx)
+            resumed = self._get_resumed_conversation(job)
+            checkpoint = self._create_checkpoint(job, experiment, lease_lost)
+            if self.engine == "async":
+                conversation, messages = asyncio.run(
+                    aperform_conversation(
+                        experiment, job.spec, self.db_m.username, resumed, checkpoint
+                    )
+                )
+            else:
+                conversation, messages = perform_conversation(
+                    experiment,
+                    job.spec,
+                    self.db_m.username,
+                    True,
+                    resumed,
+                    checkpoint,
+                )
+        except LeaseLostError as e:
+            job_done.set()
+            logger.warning(f"[{job.worker}] {e}, aborting its conversation")
+            return
+        except Exception as e:
+            job_done.set()
+            with self._lock:
+                self.failed += 1
+            logger.error(f"[{job.worker}] Job {job.id} failed: {e}")
+            self.db_m.fail_job(job, str(e), self.max_attempts)
+            return
+        job_done.set()
+        # Completed before saving, so that only the worker holding the lease
+        # saves a conversation for the job
+        if lease_lost.is_set() or not self.db_m.complete_job(job, conversation.id):
+            logger.warning(
+                f"[{job.worker}] Lease on job {job.id} was lost, discarding its result"
+            )
+            return
+        try:
+            conversation_id = self.db_m.save_conversation(
+                experiment=experiment,
+                conversation=conversation,
+                messages=messages,
+                sweep_id=job.sweep_id,
+            )
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+            logger.error(f"[{job.worker}] Job {job.id} could not be saved: {e}")
+            self.db_m.fail_job(job, str(e), self.max_attempts)
+            return
+        self.db_m.add_model_stats(
+            ModelStats.from_conversation(
+                conversation.llm.resolved_model,
+                conversation,
+                messages,
+                time.monotonic() - start_time,
+            ),
+            conversation_id,
+        )
+        if job.sweep_id is not None and job.sweep_index is not None:
+            self.db_m.complete_sweep_spec(job.sweep_id, job.sweep_index, conversation_id)
+        with self._lock:
+            self.completed += 1
+        progress = (
+            f"[{job.worker}] Job {job.id} saved as conversation {conversation_id} "
+            + f"in {time.monotonic() - start_time:.1f}s"
+        )
+        if self.adaptive:
+            progress += f" | {RateLimiter.concurrency_label()}"
+        logger.confirmation(progress)
+
+    def _get_resumed_conversation(self, job: Job) -> Conversation | None:
+        # A previous attempt may have checkpointed some days of the conversation
+        if job.conversation_id is None:
+            return None
+        conversation = self.db_m.get_conversation(job.conversation_id)
+        if conversation is None or conversation.status != ConversationStatus.IN_PROGRESS:
+            return None
+        return conversation
+
+    def _create_checkpoint(
+        self, job: Job, experiment: Experiment, lease_lost: threading.Event
+    ) -> Checkpoint:
+        def checkpoint(conversation: Conversation, messages: list[Message]) -> None:
+            # The job may have been handed to another worker since the last heartbeat
+            if lease_lost.is_set() or not self.db_m.heartbeat_job(job, self.lease_seconds):
+                lease_lost.set()
+                raise LeaseLostError(f"Lease on job {job.id} was lost")
+            self.db_m.checkpoint_conversation(
+                experiment, conversation, messages, sweep_id=job.sweep_id
+            )
+            if job.conversation_id != conversation.id:
+                if not self.db_m.set_job_conversation(job, conversation.id):
+                    # No worker would resume it
+                    self._discard_conversation(experiment, conversation)
+                    lease_lost.set()
+                    raise LeaseLostError(f"Lease on job {job.id} was lost")
+                if job.sweep_id is not None and job.sweep_index is not None:
+                    self.db_m.start_sweep_spec(
+                        job.sweep_id, job.sweep_index, conversation.id
+                    )
+
+        return checkpoint
+
+    def _discard_conversation(
+        self, experiment: Experiment, conversation: Conversation
+    ) -> None:
+        with self._lock:
+            if conversation.id in experiment.conversation_ids:
+                experiment.conversation_ids.remove(conversation.id)
+        self.db_m.remove_conversation(experiment.id, conversation.id)
+        self.db_m.delete_conversation(conversation)
+
+    def _heartbeat_loop(
+        self, job: Job, job_done: threading.Event, lease_lost: threading.Event
+    ) -> None:
+        while not job_done.wait(self.heartbeat_seconds):
+            if not self.db_m.heartbeat_job(job, self.lease_seconds):
+                lease_lost.set()
+                return
+
+    def _get_experiment(self, experiment_id: ObjectId) -> Experiment:
+        with self._lock:
+            if experiment_id not in self._experiments:
+                experiment = self.db_m.get_experiment(experiment_id)
+                if experiment is None:
+                    raise ValueError(f"Experiment {experiment_id} does not exist")
+                self._experiments[experiment_id] = experiment
+            return self._experiments[experiment_id]
@@ -51,6 +51,10 @@ class ActionManager(BaseManager):
         go_back = False
         if action == "Perform new conversations":
             self.conversation_m.perform_conversations(experiment)
+        elif action == "Enqueue new conversations for workers":
+            self.conversation_m.enqueue_conversations(experiment)
+        elif action == "Resume interrupted sweep":
+            self.conversation_m.resume_sweep(experiment)
         elif action == "Duplicate and update experiment":
             self.experiment_m.duplicate_and_update_experiment(experiment)
             if experiment != None:
@@ -107,6 +111,8 @@ class ActionManager(BaseManager):
             "Save experiment to file",
             "Select old conversations",
             "Delete experiment",
+            "Enqueue new conversations for workers",
+            "Resume interrupted sweep",
             "Go back",
         ]
         if CustomOS.getenv("APP_MODE", "") == DEV_MODE:
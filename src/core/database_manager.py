@@ -1,8 +1,10 @@
 import os
 from dataclasses import dataclass, field
+from datetime import datetime, timedelta
 
 from bson.objectid import ObjectId
 from itakello_logging import ItakelloLogging
+from pymongo import ASCENDING, ReturnDocument
 from pymongo.database import Database
 from pymongo.errors import (
     ConfigurationError,
@@ -16,8 +18,13 @@ from ..interfaces import BaseManager
 from ..components.conversation.conversation import Conversation
 from ..components.conversation.message import Message
 from ..components.experiment.experiment import Experiment
+from ..components.llm.call_ledger import LLMCall
+from ..components.sweep.job import Job
+from ..components.sweep.model_stats import ModelStats
+from ..components.sweep.sweep import Sweep
 from ..utility.consts import DEFAULT_DATABASE, DEV_MODE
 from ..utility.custom_os import CustomOS
+from ..utility.enums import ConversationStatus, JobStatus
 from .input_manager import InputManager
 
 logger = ItakelloLogging().get_logger(__name__)
@@ -25,7 +32,8 @@ logger = ItakelloLogging().get_logger(__name__)
 
 @dataclass
 class DatabaseManager(BaseManager):
-    input_m: InputManager
+    # Without an InputManager every setting must come from the environment
+    input_m: InputManager | None
 
     username: str = field(init=False)
     db: Database = field(init=False)
@@ -33,6 +41,7 @@ class DatabaseManager(BaseManager):
     def __post_init__(self) -> None:
         self.username, client = self._ask_credentials()
         self._select_database(client)
+        self._create_indexes()
         super().__post_init__()
 
     def _ask_credentials(self) -> tuple[str, MongoClient]:
@@ -49,6 +58,8 @@ class DatabaseManager(BaseManager):
             for var, prompt in env_vars.items():
                 if var in os.environ:
                     new_env_data[var] = os.environ[var]
+                elif self.input_m is None:
+                    new_env_data[var] = CustomOS.getenv(var)
                 else:
                     new_env_data[var] = self.input_m.input_str(prompt)
 
@@ -68,8 +79,12 @@ class DatabaseManager(BaseManager):
                 client = MongoClient(uri, server_api=ServerApi("1"))
             except Exception as e:
                 logger.critical(f"{e}")
+                if self.input_m is None:
+                    raise
                 continue
             connected = self._check_connection(client)
+            if not connected and self.input_m is None:
+                raise ConnectionError("Unable to connect to MongoDB")
             if connected:
                 self._save_authentication(env_vars, new_env_data)
         if client == None:
@@ -105,8 +120,12 @@ class DatabaseManager(BaseManager):
             return False
 
     def _select_database(self, client: MongoClient) -> None:
-        if CustomOS.getenv("APP_MODE", "") == "development":
+        if CustomOS.getenv("DB_NAME", ""):
+            selected_db = CustomOS.getenv("DB_NAME")
+        elif CustomOS.getenv("APP_MODE", "") == "development":
             selected_db = "development"
+        elif self.input_m is None:
+            selected_db = DEFAULT_DATABASE
         else:
             databases = self._list_databases(client)
             if not databases:
@@ -119,6 +138,12 @@ class DatabaseManager(BaseManager):
         self.db = client[selected_db]
         logger.debug(f"Selected database: {selected_db}")
 
+    def _create_indexes(self) -> None:
+        # Once per process: the calls are saved at every checkpoint
+        self.db.llm_calls.create_index([("experiment_id", ASCENDING), ("model", ASCENDING)])
+        self.db.llm_calls.create_index([("sweep_id", ASCENDING), ("model", ASCENDING)])
+        self.db.llm_calls.create_index("conversation_id")
+
     def _list_databases(self, client: MongoClient) -> list[str]:
         databases = client.list_database_names()
         databases.remove("admin")
@@ -138,6 +163,12 @@ class DatabaseManager(BaseManager):
         logger.debug(f"Experiments retrieved: {len(experiments)}")
         return experiments
 
+    def get_experiment(self, experiment_id: ObjectId) -> Experiment | None:
+        experiment_doc = self.db.experiments.find_one({"_id": experiment_id})
+        if experiment_doc is None:
+            return None
+        return Experiment.from_document(experiment_doc)
+
     def get_conversations(
         self, conversation_ids: list[ObjectId]
     ) -> dict[str, Conversation]:
@@ -152,6 +183,12 @@ class DatabaseManager(BaseManager):
         logger.debug(f"Conversations retrieved: {len(conversation_docs)}")
         return conversations
 
+    def get_conversation(self, conversation_id: ObjectId) -> Conversation | None:
+        conversation_doc = self.db.conversations.find_one({"_id": conversation_id})
+        if conversation_doc is None:
+            return None
+        return Conversation.from_document(conversation_doc)
+
     def get_messages(self, message_ids: list[ObjectId]) -> dict[str, Message]:
         # Retrieve the messages from the database
         message_docs = list(self.db.messages.find({"_id": {"$in": message_ids}}))
@@ -160,9 +197,13 @@ class DatabaseManager(BaseManager):
         return messages
 
     def update_experiment(self, experiment: Experiment) -> None:
+        # The conversation IDs are only changed with $push/$pull, as workers
+        # may be adding conversations to the same experiment concurrently
+        document = experiment.to_document()
+        document.pop("conversation_ids")
         self.db.experiments.update_one(
             {"_id": experiment.id},
-            {"$set": experiment.to_document()},
+            {"$set": document},
         )
         logger.debug(f"Experiment updated with ID: {experiment.id}")
 
@@ -173,20 +214,49 @@ class DatabaseManager(BaseManager):
         )
         logger.debug(f"Conversation updated with ID: {conversation.id}")
 
+    def checkpoint_conversation(
+        self,
+        experiment: Experiment,
+        conversation: Conversation,
+        messages: list[Message],
+        sweep_id: ObjectId | None = None,
+    ) -> None:
+        # Saves the messages of the last day and the conversation, still in progress
+        conversation.messages_ids.extend(self._save_messages(messages))
+        self._save_llm_calls(experiment, conversation, sweep_id)
+        self.db.conversations.replace_one(
+            {"_id": conversation.id}, conversation.to_document(), upsert=True
+        )
+        if conversation.id not in experiment.conversation_ids:
+            experiment.conversation_ids.append(conversation.id)
+            self.add_conversation(experiment.id, conversation.id)
+        logger.debug(
+            f"Conversation checkpointed with ID: {conversation.id} [{conversation.completed_days}/{conversation.days} days]"
+        )
+
     def save_conversation(
         self,
         experiment: Experiment,
         conversation: Conversation,
         messages: list[Message],
+        sweep_id: ObjectId | None = None,
     ) -> ObjectId:
-        conversation.messages_ids = self._save_messages(messages)
-        conversation_id = self.db.conversations.insert_one(
-            conversation.to_document()
-        ).inserted_id
-        experiment.conversation_ids.append(conversation_id)
-        self.update_experiment(experiment)
-        logger.debug(f"Conversation saved with ID: {conversation_id}")
-        return conversation_id
+        # Messages already saved by a checkpoint are skipped
+        saved_ids = set(conversation.messages_ids)
+        new_messages = [message for message in messages if message.id not in saved_ids]
+        if new_messages:
+            conversation.messages_ids.extend(self._save_messages(new_messages))
+        self._save_llm_calls(experiment, conversation, sweep_id)
+        conversation.status = ConversationStatus.COMPLETED
+        self.db.conversations.replace_one(
+            {"_id": conversation.id}, conversation.to_document(), upsert=True
+        )
+        # Pushed instead of $set so that concurrent workers do not overwrite each other
+        if conversation.id not in experiment.conversation_ids:
+            experiment.conversation_ids.append(conversation.id)
+            self.add_conversation(experiment.id, conversation.id)
+        logger.debug(f"Conversation saved with ID: {conversation.id}")
+        return conversation.id
 
     def _save_messages(self, messages: list[Message]) -> list[ObjectId]:
         documents = [message.to_document() for message in messages]
@@ -195,13 +265,79 @@ class DatabaseManager(BaseManager):
         logger.debug(f"Messages saved with IDs: {message_ids}")
         return message_ids
 
+    def _save_llm_calls(
+        self,
+        experiment: Experiment,
+        conversation: Conversation,
+        sweep_id: ObjectId | None,
+    ) -> None:
+        # The calls made since the last save, in a single insert
+        calls = conversation.ledger.drain()
+        if not calls:
+            return
+        for call in calls:
+            call.experiment_id = experiment.id
+            call.sweep_id = sweep_id
+        self.db.llm_calls.insert_many([call.to_document() for call in calls])
+        logger.debug(f"LLM calls saved for conversation {conversation.id}: {len(calls)}")
+
+    def get_llm_calls(self, conversation_id: ObjectId) -> list[LLMCall]:
+        call_docs = self.db.llm_calls.find({"conversation_id": conversation_id})
+        return [LLMCall.from_document(doc) for doc in call_docs]
+
+    def get_llm_usage(
+        self,
+        group_by: str = "model",
+        experiment_id: ObjectId | None = None,
+        sweep_id: ObjectId | None = None,
+    ) -> dict[str, dict]:
+        # Totals of the LLM calls by model, call type, agent... of an
+        # experiment or a sweep (of everything by default)
+        match = {}
+        if experiment_id is not None:
+            match["experiment_id"] = experiment_id
+        if sweep_id is not None:
+            match["sweep_id"] = sweep_id
+        usage = {}
+        for group in self.db.llm_calls.aggregate(
+            [
+                {"$match": match},
+                {
+                    "$group": {
+                        "_id": f"${group_by}",
+                        "calls": {"$sum": 1},
+                        "prompt_tokens": {"$sum": "$prompt_tokens"},
+                        "completion_tokens": {"$sum": "$completion_tokens"},
+                        "evaluated_tokens": {"$sum": "$evaluated_tokens"},
+                        "cached_tokens": {"$sum": "$cached_tokens"},
+                        "latency": {"$sum": "$latency"},
+                        "cache_hits": {"$sum": {"$cond": ["$cache_hit", 1, 0]}},
+                        "estimated_calls": {"$sum": {"$cond": ["$estimated", 1, 0]}},
+                    }
+                },
+            ]
+        ):
+            usage[str(group.pop("_id"))] = group
+        return usage
+
     def add_conversation(self, experiment_id: ObjectId, conversation: ObjectId) -> None:
         self.db.experiments.update_one(
             {"_id": experiment_id},
-            {"$push": {"conversations": conversation}},
+            {"$push": {"conversation_ids": conversation}},
         )
         logger.debug(f"Added conversation {conversation} to experiment {experiment_id}")
 
+    def remove_conversation(
+        self, experiment_id: ObjectId, conversation: ObjectId
+    ) -> None:
+        self.db.experiments.update_one(
+            {"_id": experiment_id},
+            {"$pull": {"conversation_ids": conversation}},
+        )
+        logger.debug(
+            f"Removed conversation {conversation} from experiment {experiment_id}"
+        )
+
     def delete_experiment(self, experiment: Experiment) -> None:
         # Delete the conversations and messages associated with the experiment
         for conversation_id in experiment.conversation_ids:
@@ -210,10 +346,270 @@ class DatabaseManager(BaseManager):
             self.db.messages.delete_many({"_id": {"$in": conversation.messages_ids}})
             self.db.conversations.delete_one({"_id": conversation_id})
             logger.debug(f"Deleted conversation with ID: {conversation_id}")
+        self.db.llm_calls.delete_many(
+            {
+                "$or": [
+                    {"experiment_id": experiment.id},
+                    {"conversation_id": {"$in": experiment.conversation_ids}},
+                ]
+            }
+        )
+        self.db.model_stats.delete_many({"_id": {"$in": experiment.conversation_ids}})
+        self.db.sweeps.delete_many({"experiment_id": experiment.id})
+        self.db.jobs.delete_many({"experiment_id": experiment.id})
         self.db.experiments.delete_one({"_id": experiment.id})
         logger.debug(f"Deleted experiment with ID: {experiment.id}")
 
     def delete_conversation(self, conversation: Conversation) -> None:
         self.db.messages.delete_many({"_id": {"$in": conversation.messages_ids}})
         self.db.conversations.delete_one({"_id": conversation.id})
+        self.db.llm_calls.delete_many({"conversation_id": conversation.id})
+        self.db.model_stats.delete_one({"_id": conversation.id})
+        # The sweep cell fulfilled by the conversation becomes missing again
+        self.db.sweeps.update_many(
+            {
+                "$or": [
+                    {"completed.conversation_id": conversation.id},
+                    {"in_progress.conversation_id": conversation.id},
+                ]
+            },
+            {
+                "$pull": {
+                    "completed": {"conversation_id": conversation.id},
+                    "in_progress": {"conversation_id": conversation.id},
+                }
+            },
+        )
         logger.debug(f"Deleted conversation with ID: {conversation.id}")
+
+    def save_sweep(self, sweep: Sweep) -> None:
+        self.db.sweeps.insert_one(sweep.to_document())
+        logger.debug(f"Sweep saved with ID: {sweep.id} [{len(sweep.specs)} conversations]")
+
+    def get_sweeps(self, experiment_id: ObjectId) -> dict[str, Sweep]:
+        sweep_docs = list(self.db.sweeps.find({"experiment_id": experiment_id}))
+        sweeps = {str(doc["_id"]): Sweep.from_document(doc) for doc in sweep_docs}
+        logger.debug(f"Sweeps retrieved: {len(sweeps)}")
+        return sweeps
+
+    def set_sweep_num_ctx(self, sweep: Sweep) -> None:
+        self.db.sweeps.update_one(
+            {"_id": sweep.id}, {"$set": {"num_ctx": sweep.to_document()["num_ctx"]}}
+        )
+
+    def start_sweep_spec(
+        self, sweep_id: ObjectId, index: int, conversation_id: ObjectId
+    ) -> None:
+        # One conversation in progress per spec: a new one replaces the previous
+        result = self.db.sweeps.update_one(
+            {"_id": sweep_id, "in_progress.index": index},
+            {"$set": {"in_progress.$.conversation_id": conversation_id}},
+        )
+        if result.matched_count == 0:
+            self.db.sweeps.update_one(
+                {"_id": sweep_id},
+                {
+                    "$push": {
+                        "in_progress": {"index": index, "conversation_id": conversation_id}
+                    }
+                },
+            )
+        logger.debug(f"Sweep {sweep_id}: spec {index} started by {conversation_id}")
+
+    def complete_sweep_spec(
+        self, sweep_id: ObjectId, index: int, conversation_id: ObjectId
+    ) -> None:
+        # A spec completed twice (e.g. by a worker that lost its lease) keeps
+        # its first conversation
+        result = self.db.sweeps.update_one(
+            {"_id": sweep_id, "completed.index": {"$ne": index}},
+            {
+                "$push": {"completed": {"index": index, "conversation_id": conversation_id}},
+                "$pull": {"in_progress": {"index": index}},
+            },
+        )
+        if result.modified_count == 0:
+            self.db.sweeps.update_one(
+                {"_id": sweep_id}, {"$pull": {"in_progress": {"index": index}}}
+            )
+            logger.warning(f"Sweep {sweep_id}: spec {index} was already completed")
+            return
+        logger.debug(f"Sweep {sweep_id}: spec {index} completed by {conversation_id}")
+
+    def save_jobs(self, jobs: list[Job]) -> list[ObjectId]:
+        self.db.jobs.create_index([("status", ASCENDING), ("creation_date", ASCENDING)])
+        result = self.db.jobs.insert_many([job.to_document() for job in jobs])
+        logger.debug(f"Jobs saved: {len(result.inserted_ids)}")
+        return result.inserted_ids
+
+    def claim_job(
+        self, worker: str, lease_seconds: int, preferred_llm: str | None = None
+    ) -> Job | None:
+        # Jobs on the LLM the worker just used come first, so its model stays loaded
+        if preferred_llm is not None:
+            job = self._claim_job(
+                {"status": JobStatus.PENDING.value, "spec.llm_name": preferred_llm},
+                worker,
+                lease_seconds,
+            )
+            if job is not None:
+                return job
+        return self._claim_job(
+            {"status": JobStatus.PENDING.value}, worker, lease_seconds
+        )
+
+    def _claim_job(self, query: dict, worker: str, lease_seconds: int) -> Job | None:
+        now = datetime.now()
+        job_doc = self.db.jobs.find_one_and_update(
+            query,
+            {
+                "$set": {
+                    "status": JobStatus.RUNNING.value,
+                    "worker": worker,
+                    "heartbeat_at": now,
+                    "lease_expires_at": now + timedelta(seconds=lease_seconds),
+                },
+                "$inc": {"attempts": 1},
+            },
+            sort=[("creation_date", ASCENDING)],
+            return_document=ReturnDocument.AFTER,
+        )
+        if job_doc is None:
+            return None
+        logger.debug(f"Job {job_doc['_id']} claimed by {worker}")
+        return Job.from_document(job_doc)
+
+    def set_job_conversation(self, job: Job, conversation_id: ObjectId) -> bool:
+        result = self.db.jobs.update_one(
+            {"_id": job.id, "worker": job.worker, "status": JobStatus.RUNNING.value},
+            {"$set": {"conversation_id": conversation_id}},
+        )
+        # False means the lease was lost and the job was handed to another worker
+        if result.modified_count != 1:
+            return False
+        job.conversation_id = conversation_id
+        return True
+
+    def heartbeat_job(self, job: Job, lease_seconds: int) -> bool:
+        now = datetime.now()
+        result = self.db.jobs.update_one(
+            {"_id": job.id, "worker": job.worker, "status": JobStatus.RUNNING.value},
+            {
+                "$set": {
+                    "heartbeat_at": now,
+                    "lease_expires_at": now + timedelta(seconds=lease_seconds),
+                }
+            },
+        )
+        # False means the lease was lost and the job was handed to another worker
+        return result.modified_count == 1
+
+    def complete_job(self, job: Job, conversation_id: ObjectId) -> bool:
+        result = self.db.jobs.update_one(
+            {"_id": job.id, "worker": job.worker, "status": JobStatus.RUNNING.value},
+            {
+                "$set": {
+                    "status": JobStatus.DONE.value,
+                    "conversation_id": conversation_id,
+                    "lease_expires_at": None,
+                }
+            },
+        )
+        # False means the lease was lost and the job was handed to another worker
+        if result.modified_count != 1:
+            return False
+        logger.debug(f"Job {job.id} completed with conversation {conversation_id}")
+        return True
+
+    def fail_job(self, job: Job, error: str, max_attempts: int) -> None:
+        status = JobStatus.FAILED if job.attempts >= max_attempts else JobStatus.PENDING
+        self.db.jobs.update_one(
+            {"_id": job.id, "worker": job.worker},
+            {
+                "$set": {
+                    "status": status.value,
+                    "worker": None,
+                    "error": error,
+                    "lease_expires_at": None,
+                }
+            },
+        )
+        logger.debug(f"Job {job.id} failed [{status.value}]: {error}")
+
+    def release_stale_jobs(self, max_attempts: int) -> int:
+        # A job whose worker died on every attempt (e.g. killing it) is failed
+        stale = {
+            "status": JobStatus.RUNNING.value,
+            "lease_expires_at": {"$lt": datetime.now()},
+        }
+        failed = self.db.jobs.update_many(
+            {**stale, "attempts": {"$gte": max_attempts}},
+            {
+                "$set": {
+                    "status": JobStatus.FAILED.value,
+                    "worker": None,
+                    "error": f"Lease expired on all {max_attempts} attempts",
+                    "lease_expires_at": None,
+                }
+            },
+        )
+        released = self.db.jobs.update_many(
+            stale,
+            {
+                "$set": {
+                    "status": JobStatus.PENDING.value,
+                    "worker": None,
+                    "lease_expires_at": None,
+                }
+            },
+        )
+        if failed.modified_count:
+            logger.warning(f"Failed {failed.modified_count} stale jobs out of attempts")
+        if released.modified_count:
+            logger.warning(f"Released {released.modified_count} stale job leases")
+        return failed.modified_count + released.modified_count
+
+    def get_queued_sweep_ids(self, experiment_id: ObjectId) -> set[ObjectId]:
+        # Sweeps with conversations still pending or running on workers
+        return set(
+            self.db.jobs.distinct(
+                "sweep_id",
+                {
+                    "experiment_id": experiment_id,
+                    "status": {
+                        "$in": [JobStatus.PENDING.value, JobStatus.RUNNING.value]
+                    },
+                },
+            )
+        )
+
+    def count_jobs(self, experiment_id: ObjectId | None = None) -> dict[str, int]:
+        match = {} if experiment_id is None else {"experiment_id": experiment_id}
+        counts = {status.value: 0 for status in JobStatus}
+        for group in self.db.jobs.aggregate(
+            [{"$match": match}, {"$group": {"_id": "$status", "count": {"$sum": 1}}}]
+        ):
+            counts[group["_id"]] = group["count"]
+        return counts
+
+    def add_model_stats(self, stats: ModelStats, conversation_id: ObjectId) -> None:
+        # One document per conversation, so that deleting it removes its share
+        contribution = stats.to_document() | {"_id": conversation_id, "model": stats.model}
+        self.db.model_stats.replace_one(
+            {"_id": conversation_id}, contribution, upsert=True
+        )
+
+    def get_model_stats(self) -> dict[str, ModelStats]:
+        counters = [key for key in ModelStats(model="").to_document() if key != "_id"]
+        totals = self.db.model_stats.aggregate(
+            [
+                {
+                    "$group": {
+                        # Totals saved before were already keyed by model
+                        "_id": {"$ifNull": ["$model", "$_id"]},
+                        **{key: {"$sum": f"${key}"} for key in counters},
+                    }
+                }
+            ]
+        )
+        return {doc["_id"]: ModelStats.from_document(doc) for doc in totals}
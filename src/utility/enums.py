@@ -27,3 +27,15 @@ class SectionType(Enum):
             members = list(self.__class__)
             return members.index(self) > members.index(other)
         return NotImplemented
+
+
+class JobStatus(Enum):
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class ConversationStatus(Enum):
+    IN_PROGRESS = "in_progress"
+    COMPLETED = "completed"
@@ -0,0 +1,81 @@
+import argparse
+
+from dotenv import load_dotenv
+from itakello_logging import ItakelloLogging
+
+from src.components.sweep.sweep_executor import ENGINE_TYPES
+from src.components.sweep.sweep_worker import SweepWorker
+from src.core.database_manager import DatabaseManager
+
+logger = ItakelloLogging.get_logger(__name__)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Perform the conversations enqueued in the jobs collection"
+    )
+    parser.add_argument("--threads", type=int, default=1, help="jobs run in parallel")
+    parser.add_argument("--engine", choices=ENGINE_TYPES, default="autogen")
+    parser.add_argument("--lease", type=int, default=300, help="job lease in seconds")
+    parser.add_argument(
+        "--heartbeat", type=int, default=60, help="lease renewal interval in seconds"
+    )
+    parser.add_argument(
+        "--poll", type=int, default=10, help="wait in seconds when the queue is empty"
+    )
+    parser.add_argument(
+        "--max-attempts", type=int, default=3, help="attempts before a job fails"
+    )
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="adapt the LLM calls in flight per backend to the observed latency",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="regenerate every response even when LLM_CACHE is enabled",
+    )
+    parser.add_argument(
+        "--exit-when-empty",
+        action="store_true",
+        help="stop once there are no pending jobs instead of polling",
+    )
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    # The credentials and the database name (DB_NAME) are read from the environment
+    db_m = DatabaseManager(input_m=None)
+    worker = SweepWorker(
+        db_m=db_m,
+        n_threads=args.threads,
+        engine=args.engine,
+        lease_seconds=args.lease,
+        heartbeat_seconds=args.heartbeat,
+        poll_seconds=args.poll,
+        max_attempts=args.max_attempts,
+        exit_when_empty=args.exit_when_empty,
+        adaptive=args.adaptive,
+        use_cache=not args.no_cache,
+    )
+    worker.run()
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    ItakelloLogging(
+        debug=False,
+        excluded_modules=[
+            "docker.utils.config",
+            "docker.auth",
+            "httpx",
+            "httpcore.connection",
+            "httpcore.http11",
+            "autogen.io.base",
+            "asyncio",
+            "openai._base_client",
+        ],
+    )
+    main()